@@ -0,0 +1,709 @@
+from __future__ import annotations
+
+import functools
+import itertools
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import snapshot_utils as snapshots
+from import_utils import lazy_import
+
+np = lazy_import('numpy')
+
+# Queries over follower snapshots (see snapshot_utils). Everything here
+# works on whole columns at once: filters are boolean masks, and bio
+# searches run one regex over the column's whole (memory-mapped) buffer
+# rather than once per bio, so millions of followers take a fraction of a
+# second.
+
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+REGEX_PER_ROW_MAX_FRAC = .05  # see FollowerQuery.mask
+SCORING_CHUNK_BYTES = 16 * 2**20  # see TermScorer.hits
+# below this many texts, checking each term with `in` beats the compiled
+# pass's numpy overhead; see bench_term_scorer
+SCORING_MIN_COMPILED_TEXTS = 200
+
+
+def following_ratio(snap: snapshots.FollowerSnapshot) -> np.ndarray:
+    """How many accounts each follower follows per account following them;
+    low means they're someone people listen to, high means they follow
+    everyone back"""
+    return snap['friends_count'] / np.maximum(snap['followers_count'], 1)
+
+
+def count_mask(snap: snapshots.FollowerSnapshot,
+               min_followers: Optional[int] = None,
+               max_followers: Optional[int] = None) -> np.ndarray:
+    counts = snap['followers_count']
+    mask = np.ones(len(snap), dtype=bool)
+    if min_followers is not None:
+        mask &= counts >= min_followers
+    if max_followers is not None:
+        mask &= counts <= max_followers
+    return mask
+
+
+def ratio_mask(snap: snapshots.FollowerSnapshot,
+               min_ratio: Optional[float] = None,
+               max_ratio: Optional[float] = None) -> np.ndarray:
+    ratio = following_ratio(snap)
+    mask = np.ones(len(snap), dtype=bool)
+    if min_ratio is not None:
+        mask &= ratio >= min_ratio
+    if max_ratio is not None:
+        mask &= ratio <= max_ratio
+    return mask
+
+
+# escapes whose meaning changes if you lowercase them, like \\D or \\S, stay
+# as they are; things like scoped flags or hex escapes get the slow path
+_REGEX_ESCAPE = re.compile(r'\\.', re.DOTALL)
+_REGEX_CASE_SENSITIVE_BITS = re.compile(r'\(\?[a-zA-Z]*-|\\[xX0]|\\[0-7]{3}')
+
+
+def _lower_regex(regex: str) -> Optional[str]:
+    """A regex that matches ascii-lowercased text the way regex with
+    IGNORECASE matches the original, or None if we can't tell"""
+    if _REGEX_CASE_SENSITIVE_BITS.search(regex):
+        return None
+    pieces, pos = [], 0
+    for escape in _REGEX_ESCAPE.finditer(regex):
+        pieces.append(regex[pos:escape.start()].encode('utf-8').lower().decode('utf-8'))
+        pieces.append(escape.group())
+        pos = escape.end()
+    pieces.append(regex[pos:].encode('utf-8').lower().decode('utf-8'))
+    return ''.join(pieces)
+
+
+def _ascii_lower(data: np.ndarray) -> np.ndarray:
+    return np.where((data >= ord('A')) & (data <= ord('Z')), data | 0x20, data)
+
+
+def _rows_of(column: snapshots.StringColumn, starts: np.ndarray,
+             ends: np.ndarray) -> np.ndarray:
+    """Rows whose bytes contain [starts[i], ends[i]); spans that run past
+    the end of the row they start in get dropped"""
+    rows = np.searchsorted(column.offsets, starts, side='right') - 1
+    return rows[ends <= column.offsets[rows + 1]]
+
+
+def _find_all(data: np.ndarray, folded: Optional[np.ndarray],
+              needles: Sequence[bytes]) -> List[np.ndarray]:
+    """Starts of every (possibly overlapping) occurrence of each needle in
+    data, all of which have to start with the same byte.
+
+    Finds where that first byte is, then keeps whichever of those also
+    match the second byte, and so on, so each pass only looks at the
+    survivors of the last one. If folded (data | 0x20) is given, ascii
+    letters in the needles, which must be lowercase, match either case.
+    """
+    def haystack(c: int) -> np.ndarray:
+        return folded if folded is not None and ord('a') <= c <= ord('z') else data
+
+    first = needles[0][0]
+    first_starts = np.flatnonzero(haystack(first) == first)
+    ret = []
+    for needle in needles:
+        starts = first_starts[first_starts <= len(data) - len(needle)]
+        for j in range(1, len(needle)):
+            starts = starts[haystack(needle[j])[starts + j] == needle[j]]
+        ret.append(starts)
+    return ret
+
+
+def keyword_mask(column: snapshots.StringColumn, keywords: Sequence[str],
+                 case_sensitive: bool = False) -> np.ndarray:
+    """Which rows of column contain any of keywords. Case-insensitive
+    matching only folds ascii letters."""
+    mask = np.zeros(len(column), dtype=bool)
+    if not len(column) or not keywords:
+        return mask
+    if any(not kw for kw in keywords):
+        mask[:] = True
+        return mask
+    begin, end = int(column.offsets[0]), int(column.offsets[-1])
+    data = column.data[begin:end]
+    folded = None if case_sensitive else data | 0x20
+    needles = {(kw if case_sensitive else kw.lower()).encode('utf-8') for kw in keywords}
+    by_first_byte = {}  # one pass over the data per distinct first byte
+    for needle in sorted(needles):
+        by_first_byte.setdefault(needle[0], []).append(needle)
+    for group in by_first_byte.values():
+        for needle, starts in zip(group, _find_all(data, folded, group)):
+            starts += begin
+            mask[_rows_of(column, starts, starts + len(needle))] = True
+    return mask
+
+
+def regex_mask(column: snapshots.StringColumn, regex: str,
+               case_sensitive: bool = False,
+               rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Which rows of column contain a match for regex. Case-insensitive
+    matching only folds ascii letters.
+
+    With no rows given, runs the regex over all the column's bytes in one
+    go, with a NUL between rows so that \\b and lookarounds stop at the
+    edges of a row (^ and $ still don't mean the start and end of a row),
+    and maps matches back to rows with a binary search. Matches that run
+    into the next row don't count; their row and the next one get searched
+    on their own instead. Given rows, it just checks each of those.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    pattern = re.compile(regex.encode('utf-8'), flags)
+    if pattern.search(b'') is not None:
+        raise ValueError(f"Regex {regex!r} can match an empty string, "
+                         "which would match (nearly) every row")
+    offsets = column.offsets
+    mask = np.zeros(len(column), dtype=bool)
+    buf = memoryview(column.data)
+    if rows is None:
+        if not len(column):
+            return mask
+        begin = int(offsets[0])
+        data = column.data[begin:offsets[-1]]
+        scan_pattern = pattern
+        lowered = None if case_sensitive else _lower_regex(regex)
+        if lowered is not None:
+            # re is ~4x slower with IGNORECASE than without, so lowercase
+            # the text once and match it case-sensitively instead
+            data = _ascii_lower(data)
+            scan_pattern = re.compile(lowered.encode('utf-8'))
+        scan = np.insert(data, offsets[1:-1] - begin, 0)
+        # where each row starts in scan; each row but the last has a NUL after it
+        scan_offsets = offsets - begin + np.arange(len(offsets))
+        spans = np.fromiter(itertools.chain.from_iterable(
+            m.span() for m in scan_pattern.finditer(memoryview(scan))),
+            dtype=np.int64).reshape(-1, 2)
+        match_rows = np.searchsorted(scan_offsets, spans[:, 0], side='right') - 1
+        fits = spans[:, 1] < scan_offsets[match_rows + 1]  # stopped before the NUL
+        mask[match_rows[fits]] = True
+        spanned = np.unique(match_rows[~fits])
+        rows = np.union1d(spanned, spanned + 1)
+        rows = rows[(rows < len(column)) & ~mask[np.minimum(rows, len(column) - 1)]]
+    for row in rows.tolist():
+        mask[row] = pattern.search(buf, offsets[row], offsets[row + 1]) is not None
+    return mask
+
+
+def bio_mask(snap: snapshots.FollowerSnapshot, regex: str = '',
+             keywords: Sequence[str] = (), case_sensitive: bool = False,
+             rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Followers whose bio matches regex or contains any of keywords; if
+    rows is given, the regex only gets checked against those rows"""
+    if not regex and not keywords:
+        return np.ones(len(snap), dtype=bool)
+    mask = keyword_mask(snap['description'], keywords, case_sensitive)
+    if regex:
+        mask |= regex_mask(snap['description'], regex, case_sensitive, rows=rows)
+    return mask
+
+
+def _sorted_by(snap: snapshots.FollowerSnapshot, column: str) -> bool:
+    # snapshots saved from crawls are biggest accounts first
+    return snap.meta.get('sorted_by') == '-' + column
+
+
+def top_k(snap: snapshots.FollowerSnapshot, k: int,
+          mask: Optional[np.ndarray] = None,
+          by: str = 'followers_count') -> np.ndarray:
+    """Indices of the k rows with the largest `by`, largest first"""
+    idxs = np.arange(len(snap)) if mask is None else np.flatnonzero(mask)
+    if _sorted_by(snap, by):
+        return idxs[:k]
+    values = snap[by]
+    if k < len(idxs):
+        # argpartition is O(n); only the k winners get fully sorted
+        idxs = idxs[np.argpartition(-values[idxs], k - 1)[:k]]
+    return idxs[np.argsort(-values[idxs], kind='stable')]
+
+
+def reach(snap: snapshots.FollowerSnapshot,
+          mask: Optional[np.ndarray] = None) -> Dict[str, int]:
+    counts = snap['followers_count'] if mask is None else snap['followers_count'][mask]
+    return {'num_followers': int(len(counts)),
+            'total_followers_of_followers': int(counts.sum())}
+
+
+def percentiles(snap: snapshots.FollowerSnapshot, column: str = 'followers_count',
+                qs: Sequence[float] = DEFAULT_PERCENTILES,
+                mask: Optional[np.ndarray] = None) -> Dict[float, float]:
+    values = snap[column] if mask is None else snap[column][mask]
+    if not len(values):
+        return {q: float('nan') for q in qs}
+    if not _sorted_by(snap, column):
+        return dict(zip(qs, np.percentile(values, qs).tolist()))
+    # already sorted (descending), so no need for np.percentile to partition;
+    # this is its default linear interpolation
+    pos = (len(values) - 1) * (1 - np.asarray(qs, dtype=np.float64) / 100)
+    lo, hi = np.floor(pos).astype(np.int64), np.ceil(pos).astype(np.int64)
+    lo_vals, hi_vals = values[lo].astype(np.float64), values[hi].astype(np.float64)
+    return dict(zip(qs, (lo_vals + (hi_vals - lo_vals) * (pos - lo)).tolist()))
+
+
+@dataclass
+class FollowerQuery:
+    k: int = 20
+    min_followers: Optional[int] = None
+    max_followers: Optional[int] = None
+    min_following_ratio: Optional[float] = None
+    max_following_ratio: Optional[float] = None
+    bio_regex: str = ''
+    bio_keywords: Sequence[str] = ()
+    case_sensitive: bool = False
+
+    def mask(self, snap: snapshots.FollowerSnapshot) -> np.ndarray:
+        mask = (count_mask(snap, self.min_followers, self.max_followers)
+                & ratio_mask(snap, self.min_following_ratio, self.max_following_ratio))
+        # regexes run at python speed per matching row, so if the cheap
+        # filters already ruled out most rows, only check the rest
+        rows = None
+        if mask.mean() <= REGEX_PER_ROW_MAX_FRAC:
+            rows = np.flatnonzero(mask)
+        return mask & bio_mask(snap, self.bio_regex, self.bio_keywords,
+                               self.case_sensitive, rows=rows)
+
+
+@dataclass
+class QueryResult:
+    snapshot: snapshots.FollowerSnapshot
+    mask: np.ndarray
+    top: np.ndarray  # indices, biggest accounts first
+    reach: Dict[str, int]
+    percentiles: Dict[float, float]
+    secs: float
+
+    def __str__(self):
+        snap = self.snapshot
+        lines = [f"{snap.meta.get('user', snap.path)}, crawled "
+                 f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(snap.crawled_at))}: "
+                 f"{self.reach['num_followers']} of {len(snap)} followers match, "
+                 f"with {self.reach['total_followers_of_followers']} followers between them",
+                 'follower count percentiles: ' + ', '.join(
+                     f"p{q:g}={v:,.0f}" for q, v in self.percentiles.items())]
+        for row in snap.iter_rows(self.top):
+            bio = ' '.join(row['description'].split())
+            lines.append(f"{row['followers_count']:>10,} {row['friends_count']:>8,} "
+                         f"@{row['screen_name']:<16} {row['name'][:24]:<24} {bio[:80]}")
+        lines.append(f"({self.secs * 1000:.0f}ms)")
+        return '\n'.join(lines)
+
+
+def run_query(snap: snapshots.FollowerSnapshot, query: FollowerQuery) -> QueryResult:
+    t0 = time.perf_counter()
+    mask = query.mask(snap)
+    top = top_k(snap, query.k, mask)
+    ret = QueryResult(snap, mask, top, reach(snap, mask),
+                      percentiles(snap, mask=mask), secs=0)
+    ret.secs = time.perf_counter() - t0
+    return ret
+
+
+def query_followers(id_or_screen_name: Union[int, str], query: FollowerQuery,
+                    which: int = -1, out_path: str = '') -> QueryResult:
+    """Runs query over a saved snapshot, optionally writing every match as
+    a csv, biggest accounts first"""
+    snap = snapshots.load_snapshot(id_or_screen_name, which)
+    result = run_query(snap, query)
+    if out_path:
+        matches = np.flatnonzero(result.mask)
+        order = np.argsort(-snap['followers_count'][matches], kind='stable')
+        snapshots.export_csv(snap, out_path, indices=matches[order])
+    return result
+
+
+# ================================================================ term scoring
+
+@dataclass(frozen=True)
+class Term:
+    text: str
+    weight: float = 1
+    case_sensitive: bool = False
+
+
+def make_terms(terms: Union[Sequence[str], Dict[str, float]],
+               case_sensitive: bool = False) -> List[Term]:
+    """Terms from a list of strings (each worth 1) or a {string: weight} dict"""
+    weights = terms if isinstance(terms, dict) else dict.fromkeys(terms, 1)
+    return [Term(text, weight, case_sensitive) for text, weight in weights.items()]
+
+
+class TermScorer:
+    """Scores bios (or any text) by the total weight of the terms they
+    contain; each term counts once, however many times it shows up.
+
+    The terms get compiled into one table of the (ascii-lowercased) byte
+    pairs they start with, so scoring a batch of bios is one pass over all
+    their bytes to find spots where some term could start, and then each
+    term only gets checked at the spots starting with its pair. Terms that
+    overlap or contain each other all count. Case-insensitive terms only
+    fold ascii letters.
+
+    That pass only pays off for big batches (like a snapshot's bios);
+    score_many on fewer than SCORING_MIN_COMPILED_TEXTS texts just checks
+    each term in each text, with the same results. Use term_scorer() to
+    reuse scorers for the same terms.
+    """
+
+    def __init__(self, terms: Iterable[Union[str, Term]]):
+        self.terms = [t if isinstance(t, Term) else Term(t) for t in terms]
+        if any(not t.text for t in self.terms):
+            raise ValueError("Can't score an empty term; it'd match every bio")
+
+    @functools.cached_property
+    def weights(self) -> np.ndarray:
+        return np.array([t.weight for t in self.terms], dtype=np.float64)
+
+    @functools.cached_property
+    def _needles(self):
+        # (term, weight) for terms to check against the ascii-lowered text,
+        # and for ones to check against it as-is
+        lowered = [(_ascii_lower_str(t.text), t.weight) for t in self.terms
+                   if not t.case_sensitive]
+        raw = [(t.text, t.weight) for t in self.terms if t.case_sensitive]
+        return lowered, raw
+
+    def _score_one_by_one(self, texts: Sequence[str]) -> List[float]:
+        # str `in` is several times faster than on bytes, and code points
+        # match iff their utf-8 does, so this agrees with the compiled pass
+        lowered_needles, raw_needles = self._needles
+        scores = []
+        for text in texts:
+            text = text or ''
+            # inlined _ascii_lower_str; this loop is all overhead
+            lowered = text.lower() if text.isascii() else text.translate(_ASCII_LOWER_TABLE)
+            score = 0
+            for needle, weight in lowered_needles:
+                if needle in lowered:
+                    score += weight
+            for needle, weight in raw_needles:
+                if needle in text:
+                    score += weight
+            scores.append(score)
+        return scores
+
+    @functools.cached_property
+    def _compiled(self):
+        # built on first use, so that defining a scorer at import time
+        # doesn't import numpy
+        first_pairs = np.zeros(1 << 16, dtype=bool)
+        by_first_pair, single_bytes = {}, []
+        for i, term in enumerate(self.terms):
+            needle = term.text.encode('utf-8')
+            if not term.case_sensitive:
+                needle = needle.lower()  # bytes.lower only does ascii
+            if len(needle) == 1:
+                single_bytes.append((i, needle, term.case_sensitive))
+                continue
+            lower = needle.lower()
+            pair = (lower[0] << 8) | lower[1]
+            first_pairs[pair] = True
+            by_first_pair.setdefault(pair, []).append((i, needle, term.case_sensitive))
+        pairs = np.array(sorted(by_first_pair), dtype=np.int64)
+        groups = [by_first_pair[pair] for pair in pairs.tolist()]
+        return first_pairs, pairs, groups, single_bytes
+
+    def _add_hits(self, column: snapshots.StringColumn, hits: np.ndarray):
+        begin, end = int(column.offsets[0]), int(column.offsets[-1])
+        if begin == end:
+            return
+        data = np.asarray(column.data[begin:end])
+        lowered = _ascii_lower(data)
+        first_pairs, group_pairs, groups, single_bytes = self._compiled
+        found_starts, found_ends, found_terms = [], [], []
+
+        def add(i: int, needle: bytes, starts: np.ndarray):
+            found_starts.append(starts)
+            found_ends.append(starts + len(needle))
+            found_terms.append(np.full(len(starts), i))
+
+        # the byte pair starting at each position, and which of those
+        # could be the start of some term
+        pairs = (lowered[:-1].astype(np.uint16) << 8) | lowered[1:]
+        starts = np.flatnonzero(first_pairs[pairs])
+        start_pairs = pairs[starts]
+        order = np.argsort(start_pairs, kind='stable')
+        starts, start_pairs = starts[order], start_pairs[order]
+        group_los = np.searchsorted(start_pairs, group_pairs).tolist()
+        group_his = np.searchsorted(start_pairs, group_pairs + 1).tolist()
+        for group, lo, hi in zip(groups, group_los, group_his):
+            if lo == hi:
+                continue
+            for i, needle, case_sensitive in group:
+                hay = data if case_sensitive else lowered
+                candidates = starts[lo:hi]
+                candidates = candidates[candidates <= len(data) - len(needle)]
+                # the pair already matched case-insensitively
+                for j in range(0 if case_sensitive else 2, len(needle)):
+                    candidates = candidates[hay[candidates + j] == needle[j]]
+                add(i, needle, candidates)
+        for i, needle, case_sensitive in single_bytes:
+            hay = data if case_sensitive else lowered
+            add(i, needle, np.flatnonzero(hay == needle[0]))
+
+        if found_starts:  # same as _rows_of, but for all the terms at once
+            starts, ends = np.concatenate(found_starts) + begin, np.concatenate(found_ends) + begin
+            terms = np.concatenate(found_terms)
+            rows = np.searchsorted(column.offsets, starts, side='right') - 1
+            fits = ends <= column.offsets[rows + 1]
+            hits[rows[fits], terms[fits]] = True
+
+    def hits(self, column: snapshots.StringColumn) -> np.ndarray:
+        """Which terms each row of column contains, as a (rows, terms)
+        bool array. Goes through big columns (like a snapshot's bios)
+        SCORING_CHUNK_BYTES at a time so memory use stays flat."""
+        hits = np.zeros((len(column), len(self.terms)), dtype=bool)
+        offsets = column.offsets
+        row = 0
+        while row < len(column):
+            end_row = int(np.searchsorted(offsets, offsets[row] + SCORING_CHUNK_BYTES,
+                                          side='right')) - 1
+            end_row = min(max(end_row, row + 1), len(column))
+            chunk = snapshots.StringColumn(column.data, offsets[row:end_row + 1])
+            self._add_hits(chunk, hits[row:end_row])
+            row = end_row
+        return hits
+
+    def score_column(self, column: snapshots.StringColumn) -> np.ndarray:
+        return self.hits(column) @ self.weights
+
+    def score_many(self, texts: Sequence[str]) -> np.ndarray:
+        if len(texts) < SCORING_MIN_COMPILED_TEXTS:
+            return np.array(self._score_one_by_one(texts), dtype=np.float64)
+        return self.score_column(_string_column(texts))
+
+    def score(self, text: str) -> float:
+        return float(self._score_one_by_one([text])[0])
+
+    def matched_terms(self, text: str) -> List[Term]:
+        hits = self.hits(_string_column([text]))[0]
+        return [term for term, hit in zip(self.terms, hits) if hit]
+
+
+_ASCII_LOWER_TABLE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def _ascii_lower_str(text: str) -> str:
+    # str.lower also folds non-ascii letters, which the compiled pass doesn't
+    return text.lower() if text.isascii() else text.translate(_ASCII_LOWER_TABLE)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_term_scorer(terms: tuple) -> TermScorer:
+    return TermScorer(terms)
+
+
+def term_scorer(terms: Iterable[Union[str, Term]]) -> TermScorer:
+    """The same scorer (and its compiled tables) for the same terms"""
+    return _cached_term_scorer(tuple(t if isinstance(t, Term) else Term(t) for t in terms))
+
+
+def _string_column(texts: Sequence[str]) -> snapshots.StringColumn:
+    encoded = [(text or '').encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return snapshots.StringColumn(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+# ================================================================ debug
+
+def _brute_force_bio_mask(snap, regex='', keywords=(), case_sensitive=False):
+    ret = []
+    flags = 0 if case_sensitive else re.IGNORECASE
+    for bio in snap['description']:
+        bio = bio.encode('utf-8')
+        folded = bio if case_sensitive else bio.lower()  # bytes.lower only does ascii
+        ret.append(any((kw if case_sensitive else kw.lower()).encode('utf-8') in folded
+                       for kw in keywords)
+                   or bool(regex and re.search(regex.encode('utf-8'), bio, flags)))
+    return np.array(ret, dtype=bool)
+
+
+def test_queries(num_rows: int = 5000):
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        followers = list(snapshots._fake_followers(num_rows))
+        followers[0]['description'] = 'Assistant Professor'
+        followers[1]['description'] = 'at MIT'  # 'professor' + 'at' spans rows 0 and 1
+        followers[2]['description'] = ''
+        snap = snapshots.write_snapshot(iter(followers), os.path.join(d, 'snap'))
+
+        for regex, keywords in (('', ['professor', 'MIT', 'phd']), (r'likes \w+ things', []),
+                                ('', ['ü', '🤖', 'Ümeå']), ('sor ?at', []),
+                                (r'@\w+', ['views my own']), (r'\bPh\.?D\b|PROF\w*\D', []),
+                                (r'[A-Z]{3}[^a-z]', []), (r'(?-i:PhD)|\x40MIT', [])):
+            for case_sensitive in (False, True):
+                expected = _brute_force_bio_mask(snap, regex, keywords, case_sensitive)
+                got = bio_mask(snap, regex, keywords, case_sensitive)
+                assert (got == expected).all(), (regex, keywords, case_sensitive)
+        assert bio_mask(snap, keywords=['professor'])[0]
+        assert not bio_mask(snap, regex='sor ?at')[0]  # would only match across rows
+
+        counts = np.array([f['followers_count'] for f in followers])
+        top = top_k(snap, 10)
+        assert list(counts[top]) == sorted(counts, reverse=True)[:10]
+        mask = ratio_mask(snap, max_ratio=1.) & count_mask(snap, min_followers=100)
+        expected = [i for i, f in enumerate(followers) if f['followers_count'] >= 100
+                    and f['friends_count'] / max(f['followers_count'], 1) <= 1]
+        assert list(np.flatnonzero(mask)) == expected
+        assert reach(snap, mask)['total_followers_of_followers'] == counts[expected].sum()
+
+        order = np.argsort(-counts, kind='stable')
+        sorted_snap = snapshots.write_snapshot((followers[i] for i in order),
+                                               os.path.join(d, 'sorted'),
+                                               sorted_by='-followers_count')
+        mask = bio_mask(sorted_snap, keywords=['phd'])
+        unsorted_top = top_k(snap, 10, bio_mask(snap, keywords=['phd']))
+        assert (sorted_snap['followers_count'][top_k(sorted_snap, 10, mask)]
+                == counts[unsorted_top]).all()
+        got = percentiles(sorted_snap, mask=mask, qs=(0, 12.5, 50, 99, 100))
+        expected = np.percentile(sorted_snap['followers_count'][mask], (0, 12.5, 50, 99, 100))
+        assert np.allclose(list(got.values()), expected)
+
+        result = run_query(snap, FollowerQuery(k=5, bio_keywords=['phd'], min_followers=10))
+        assert len(result.top) == 5
+        assert all('PhD' in snap['description'][i] for i in result.top)
+        str(result)
+
+        # few enough rows left after the count filter to regex them one by one
+        query = FollowerQuery(bio_regex=r'professor|postdoc', min_followers=1000)
+        assert query.mask(snap).sum() == (_brute_force_bio_mask(snap, query.bio_regex)
+                                          & count_mask(snap, min_followers=1000)).sum()
+
+
+def bench_queries(num_rows: int = 2 * 1000 * 1000):
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        snap = snapshots.write_snapshot(snapshots._fake_followers(num_rows, biggest_first=True),
+                                        os.path.join(d, 'snap'), sorted_by='-followers_count')
+        snap = snapshots.FollowerSnapshot(snap.path)  # nothing paged in yet
+        queries = {
+            'top 20': FollowerQuery(),
+            'ratio + count': FollowerQuery(min_followers=1000, max_following_ratio=.5),
+            'bio keywords': FollowerQuery(bio_keywords=['professor', 'phd', 'researcher',
+                                                        'postdoc', 'scientist']),
+            'bio regex': FollowerQuery(bio_regex=r'(ph\.?d|research|postdoc|prof)'),
+            'bio regex + count': FollowerQuery(bio_regex=r'(ph\.?d|research|postdoc|prof)',
+                                               min_followers=100),
+        }
+        for name, query in queries.items():
+            result = run_query(snap, query)
+            print(f"{name}: {result.secs * 1000:.0f}ms, "
+                  f"{result.reach['num_followers']} matches")
+
+        t0 = time.perf_counter()
+        _brute_force_bio_mask(snap, keywords=['professor', 'phd', 'researcher',
+                                              'postdoc', 'scientist'])
+        print(f"bio keywords, one bio at a time: {(time.perf_counter() - t0) * 1000:.0f}ms")
+
+
+_FAKE_CANDIDATE_BIO_PARTS = (
+    'PhD student at Stanford', 'Research scientist @GoogleAI', 'Professor of CS at CMU',
+    'ML engineer', 'opinions my own. dad, runner, coffee', 'Working on NLP and LLMs',
+    'Formerly @Microsoft, @Meta', 'Neural nets go brrr', 'Assistant prof @ Oxford',
+    'I tweet about AI policy', 'Postdoc at MIT CSAIL', 'Founder & CEO', 'he/him',
+    'Music, books, and bad puns', 'Faculty at Harvard', 'Crypto enthusiast 🚀',
+    'DeepMind alum, now at OpenAI', 'Data scientist @Amazon', 'Ümeå Universitet',
+)
+
+
+def _fake_candidate_bios(num_bios: int) -> List[str]:
+    """Bios like the ones user searches for author names turn up"""
+    rng = np.random.default_rng(123)
+    return ['. '.join(rng.choice(_FAKE_CANDIDATE_BIO_PARTS, size=rng.integers(1, 6),
+                                 replace=False)) for _ in range(num_bios)]
+
+
+def _brute_force_scores(terms: Sequence[Term], bios: Sequence[str]) -> np.ndarray:
+    ret = []
+    for bio in bios:
+        bio = bio.encode('utf-8')
+        ret.append(sum(term.weight for term in terms
+                       if (term.text.encode('utf-8') in bio if term.case_sensitive
+                           else term.text.encode('utf-8').lower() in bio.lower())))
+    return np.array(ret)
+
+
+def test_term_scorer():
+    global SCORING_CHUNK_BYTES
+    terms = (make_terms(['research', 'scien', 'phd', 'ph.d', 'p.h.d', 'meta', 'data',
+                         'openai', 'machine learning', 'ümeå', 'x'])
+             + make_terms({'MIT': 2, 'AI': .5, 'FAIR': 3, 'Ü': 1}, case_sensitive=True)
+             + make_terms(['research']))  # same term twice counts twice
+    scorer = TermScorer(terms)
+    bios = _fake_candidate_bios(2000) + [
+        '', 'x', 'AI', 'ai', 'OpenAI at FAIR', 'metadata scientist', 'P.H.D. RESEARCHER',
+        'Ph.D', 'machine learnin', 'g', 'ÜMEÅ', 'Ümeå', 'maCHINE LEARNING']
+    expected = _brute_force_scores(terms, bios)
+    assert np.allclose(scorer.score_many(bios), expected)
+    assert np.allclose(scorer.score_column(_string_column(bios)), expected)  # compiled
+    assert np.allclose(scorer.score_many(bios[-50:]), expected[-50:])  # one by one
+    assert scorer.score('OpenAI at FAIR') == 1 + .5 + 3
+    assert [t.text for t in scorer.matched_terms('metadata')] == ['meta', 'data']
+    assert len(scorer.score_many([])) == 0
+    assert term_scorer(terms) is term_scorer(list(terms))  # compiled once
+    assert term_scorer(terms) is not term_scorer(terms[:-1])
+
+    old_chunk_bytes = SCORING_CHUNK_BYTES
+    try:  # rows split across lots of chunks, and rows bigger than a chunk
+        SCORING_CHUNK_BYTES = 50
+        assert np.allclose(scorer.score_many(bios), expected)
+    finally:
+        SCORING_CHUNK_BYTES = old_chunk_bytes
+
+    # and on snapshot bios
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        snap = snapshots.write_snapshot(snapshots._fake_followers(3000),
+                                        os.path.join(d, 'snap'))
+        got = scorer.score_column(snap['description'])
+        assert np.allclose(got, _brute_force_scores(terms, list(snap['description'])))
+
+
+def bench_term_scorer(num_bios: int = 10 * 1000):
+    import paper_threader as pt
+    bios = _fake_candidate_bios(num_bios)
+    scorer = term_scorer(pt.AUTHOR_BIO_TERMS)
+    scorer.score_column(_string_column(bios[:10]))  # build the tables outside the timing
+
+    anycase = [t.text for t in pt.AUTHOR_BIO_TERMS if not t.case_sensitive]
+    cased = [t.text for t in pt.AUTHOR_BIO_TERMS if t.case_sensitive]
+
+    def one_term_at_a_time(bio: str) -> int:  # what find_authors used to do
+        lowercase_bio = bio.lower()
+        return (sum(substr in lowercase_bio for substr in anycase)
+                + sum(substr in bio for substr in cased))
+
+    def _us_per_bio(f, batches) -> float:
+        t0 = time.perf_counter()
+        for batch in batches:
+            f(batch)
+        return (time.perf_counter() - t0) / num_bios * 1e6
+
+    print(f"{len(pt.AUTHOR_BIO_TERMS)} terms, {num_bios} bios, us per bio:")
+    for batch_size in (10, 50, 100, SCORING_MIN_COMPILED_TEXTS, 1000, num_bios):
+        batches = [bios[i:i + batch_size] for i in range(0, num_bios, batch_size)]
+        scores = np.concatenate([scorer.score_many(batch) for batch in batches])
+        assert (scores == [one_term_at_a_time(bio) for bio in bios]).all()
+        score_many_us = _us_per_bio(scorer.score_many, batches)
+        compiled_us = _us_per_bio(lambda batch: scorer.score_column(_string_column(batch)),
+                                  batches)
+        loop_us = _us_per_bio(lambda batch: [one_term_at_a_time(bio) for bio in batch],
+                              batches)
+        print(f"  batches of {batch_size}:\tscore_many {score_many_us:.1f}\t"
+              f"compiled {compiled_us:.1f}\tone term at a time {loop_us:.1f}")
+
+
+def main():
+    test_queries()
+    test_term_scorer()
+    # bench_queries()
+    # bench_term_scorer()
+
+
+if __name__ == '__main__':
+    main()
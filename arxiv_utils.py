@@ -1,12 +1,21 @@
 
-from typing import List
+from __future__ import annotations
 
-import requests
-from bs4 import BeautifulSoup
+import glob
+import os
+import re
+import time
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Sequence, Tuple, Union
+from xml.etree import ElementTree
 
-import joblib
+import rate_limit_utils as rate_limit
+from cache_utils import cache
+from import_utils import lazy_import
 
-memory = joblib.Memory('.')
+# only needed when we actually hit arxiv or fall back to the bs4 parser
+bs4 = lazy_import('bs4')
+http = lazy_import('http_utils')
 
 # more feature-complete stuff:
 # https://github.com/valayDave/arxiv-miner (handles latex)
@@ -25,23 +34,47 @@ URL_PRUNING_SURVEY = 'https://arxiv.org/abs/2003.03033'
 URL_MADDNESS = 'https://arxiv.org/abs/2106.10860'
 URL_ONE_AUTHOR = 'https://arxiv.org/abs/2205.02803'
 
+ABS_PAGE_CORPUS_DIR = 'arxiv_abs_pages'
 
-@memory.cache
+
+ARXIV_API_URL = 'http://export.arxiv.org/api/query'
+ARXIV_MAX_REQS_PER_SEC = 4
+API_MAX_IDS_PER_REQUEST = 100
+ATOM_NAMESPACES = {'atom': 'http://www.w3.org/2005/Atom'}
+
+# abs pages only change when there's a new version
+ABS_PAGE_CACHE_TTL_SECS = 30 * 24 * 3600
+
+
+# one request at a time, at most ARXIV_MAX_REQS_PER_SEC of them
+arxiv_rate_limiter = rate_limit.TokenBucket(
+    rate=ARXIV_MAX_REQS_PER_SEC,
+    state_path=rate_limit.shared_state_path('arxiv'))
+
+
+# ================================================================ abs pages
+
+@cache.cached(ttl_secs=ABS_PAGE_CACHE_TTL_SECS)
 def _download_html(url: str):
-    return requests.get(url).content
+    arxiv_rate_limiter.acquire()
+    return http.get(url).content
 
 
-def _extract_title(arxiv_abs_soup: BeautifulSoup) -> str:
-    # note: some other crap, like "contact arXiv" is also wrapped in <title>
-    title_elem = arxiv_abs_soup.find('title')
-    title = title_elem.contents[0]
+def _clean_title(title: str) -> str:
     if ']' in title:  # should start with [####.#####]
         title = title[title.find(']') + 1:]
     title = title.strip()
     return title
 
 
-def _extract_authors(arxiv_abs_soup: BeautifulSoup) -> List[str]:
+def _extract_title(arxiv_abs_soup: bs4.BeautifulSoup) -> str:
+    # note: some other crap, like "contact arXiv" is also wrapped in <title>
+    title_elem = arxiv_abs_soup.find('title')
+    title = title_elem.contents[0]
+    return _clean_title(title)
+
+
+def _extract_authors(arxiv_abs_soup: bs4.BeautifulSoup) -> List[str]:
     authors_div = arxiv_abs_soup.find_all(class_='authors')
     assert len(authors_div) == 1  # fail fast if unexpected html structure
     authors_div = authors_div[0]
@@ -49,16 +82,13 @@ def _extract_authors(arxiv_abs_soup: BeautifulSoup) -> List[str]:
     author_names = [anchor.contents[0].strip() for anchor in anchors]
     return author_names
 
-def _extract_abstract(arxiv_abs_soup: BeautifulSoup) -> str:
+def _extract_abstract(arxiv_abs_soup: bs4.BeautifulSoup) -> str:
     abstract_div = arxiv_abs_soup.find('blockquote')
     return abstract_div.contents[-1].strip()
 
 
-def scrape_arxiv_abs_page(url: str):
-    if 'export.arxiv.org' not in url:
-        url = url.replace('arxiv.org', 'export.arxiv.org')
-    html = _download_html(url)
-    soup = BeautifulSoup(html, 'html.parser')
+def _parse_abs_page_bs4(html: Union[str, bytes]) -> Tuple[str, List[str], str]:
+    soup = bs4.BeautifulSoup(html, 'html.parser')
 
     # begin not-officially-supported scraping
 
@@ -72,6 +102,339 @@ def scrape_arxiv_abs_page(url: str):
     return title, authors, abstract
 
 
+class AbsPageFormatError(ValueError):
+    pass
+
+
+class _AbsPageParser(HTMLParser):
+    """Pulls the title, authors, and abstract out of an abs page in one
+    streaming pass, without building a tree.
+
+    Mirrors the bs4 extraction exactly: the title is the first text in
+    the first <title>, the authors are the first text in each <a> in the
+    one element with class 'authors', and the abstract is the last thing
+    directly inside the first <blockquote>.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.authors = []
+        self.abstract = None
+        self.num_authors_elems = 0
+
+        self._in_title = False
+        self._seen_title = False
+        self._authors_tag = None  # tag name of the 'authors' element
+        self._authors_depth = 0  # how many of those we're inside
+        self._in_author_anchor = False
+        self._author_anchor_text = None
+        self._blockquote_depth = 0
+        self._seen_blockquote = False
+        self._blockquote_last_child = None  # str, or None if a tag
+
+    def handle_starttag(self, tag, attrs):
+        if self._blockquote_depth:
+            if self._blockquote_depth == 1:
+                self._blockquote_last_child = None  # last child is a tag
+            if tag == 'blockquote':
+                self._blockquote_depth += 1
+        if tag == 'title' and not self._seen_title:
+            self._in_title = True
+        elif tag == 'blockquote' and not self._seen_blockquote:
+            self._seen_blockquote = True
+            self._blockquote_depth = 1
+
+        if self._authors_depth:
+            if tag == self._authors_tag:
+                self._authors_depth += 1
+            elif tag == 'a':
+                self._in_author_anchor = True
+                self._author_anchor_text = None
+        classes = (dict(attrs).get('class') or '').split()
+        if 'authors' in classes:
+            self.num_authors_elems += 1
+            if self.num_authors_elems == 1:
+                self._authors_tag = tag
+                self._authors_depth = 1
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self._seen_title = True
+        elif tag == 'blockquote' and self._blockquote_depth:
+            self._blockquote_depth -= 1
+            if not self._blockquote_depth:
+                self.abstract = self._blockquote_last_child
+        elif tag == 'a' and self._in_author_anchor:
+            self._in_author_anchor = False
+            if self._author_anchor_text is not None:
+                self.authors.append(self._author_anchor_text.strip())
+        elif tag == self._authors_tag and self._authors_depth:
+            self._authors_depth -= 1
+
+    def handle_data(self, data):
+        if self._in_title and self.title is None:
+            self.title = data
+        if self._in_author_anchor and self._author_anchor_text is None:
+            self._author_anchor_text = data
+        if self._blockquote_depth == 1:
+            self._blockquote_last_child = data
+
+
+def _parse_abs_page_stream(html: Union[str, bytes]) -> Tuple[str, List[str], str]:
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    parser = _AbsPageParser()
+    parser.feed(html)
+    parser.close()
+
+    # fail fast if unexpected html structure
+    if parser.title is None:
+        raise AbsPageFormatError("No <title> in arxiv abs page")
+    if parser.num_authors_elems != 1:
+        raise AbsPageFormatError(
+            f"Expected 1 'authors' element in abs page, found {parser.num_authors_elems}")
+    if parser.abstract is None:
+        raise AbsPageFormatError("No abstract <blockquote> in arxiv abs page")
+
+    return _clean_title(parser.title), parser.authors, parser.abstract.strip()
+
+
+ABS_PAGE_BACKENDS = ('stream', 'bs4')
+
+
+def parse_arxiv_abs_page(html: Union[str, bytes], backend: str = 'stream') -> Tuple[str, List[str], str]:
+    """Returns (title, authors, abstract) from the html of an abs page.
+
+    The 'stream' backend only looks at the bits of the page we need and
+    is several times faster. If it can't make sense of the page, we fall
+    back to the 'bs4' backend, which fails loudly if the page really isn't
+    structured the way we expect.
+    """
+    if backend not in ABS_PAGE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}'; options are {ABS_PAGE_BACKENDS}")
+    if backend == 'stream':
+        try:
+            return _parse_abs_page_stream(html)
+        except AbsPageFormatError as e:
+            print(f"Falling back to bs4 to parse arxiv abs page: {e}")
+    return _parse_abs_page_bs4(html)
+
+
+def scrape_arxiv_abs_page(url: str, backend: str = 'stream'):
+    if 'export.arxiv.org' not in url:
+        url = url.replace('arxiv.org', 'export.arxiv.org')
+    html = _download_html(url)
+    return parse_arxiv_abs_page(html, backend=backend)
+
+
+# ================================================================ export API
+
+def arxiv_id(url_or_id: str) -> str:
+    """'https://arxiv.org/abs/2003.03033v2' -> '2003.03033'"""
+    paper_id = url_or_id.strip().rstrip('/')
+    for marker in ('/abs/', '/pdf/'):
+        if marker in paper_id:
+            paper_id = paper_id.split(marker)[-1]
+    if paper_id.endswith('.pdf'):
+        paper_id = paper_id[:-len('.pdf')]
+    return re.sub('v[\d]+$', '', paper_id)
+
+
+def _parse_api_feed(feed: Union[str, bytes]) -> Dict[str, Tuple[str, List[str], str]]:
+    """Maps arxiv id -> (title, authors, abstract) for each entry"""
+    root = ElementTree.fromstring(feed)
+    papers = {}
+    for entry in root.findall('atom:entry', ATOM_NAMESPACES):
+        entry_id = entry.findtext('atom:id', default='', namespaces=ATOM_NAMESPACES)
+        title = entry.findtext('atom:title', default='', namespaces=ATOM_NAMESPACES)
+        if not entry_id or '/abs/' not in entry_id:
+            # bad ids get an entry titled "Error" with an api.arxiv.org id
+            continue
+        authors = [author.findtext('atom:name', default='', namespaces=ATOM_NAMESPACES).strip()
+                   for author in entry.findall('atom:author', ATOM_NAMESPACES)]
+        abstract = entry.findtext('atom:summary', default='', namespaces=ATOM_NAMESPACES)
+        # the feed wraps long titles across lines
+        title = ' '.join(title.split())
+        papers[arxiv_id(entry_id)] = (title, authors, abstract.strip())
+    return papers
+
+
+def _query_api(url: str, params: Dict[str, Any]) -> bytes:
+    arxiv_rate_limiter.acquire()
+    response = http.get(url, params=params)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_papers(urls_or_ids: Sequence[str],
+                 api_url: str = ARXIV_API_URL,
+                 max_ids_per_request: int = API_MAX_IDS_PER_REQUEST) -> List[Tuple[str, List[str], str]]:
+    """(title, authors, abstract) for each paper, like scrape_arxiv_abs_page.
+
+    Uses arxiv's export API, which can return metadata for many papers per
+    request; this is what they ask us to use for anything beyond one-off
+    lookups. Requests go through the shared arxiv rate limiter.
+    """
+    ids = [arxiv_id(url_or_id) for url_or_id in urls_or_ids]
+    unique_ids = list(dict.fromkeys(ids))
+    papers = {}
+    for start in range(0, len(unique_ids), max_ids_per_request):
+        batch = unique_ids[start:(start + max_ids_per_request)]
+        feed = _query_api(api_url, params={'id_list': ','.join(batch),
+                                           'max_results': len(batch)})
+        papers.update(_parse_api_feed(feed))
+
+    missing = [paper_id for paper_id in unique_ids if paper_id not in papers]
+    if missing:
+        raise ValueError(f"arxiv API returned no papers for ids: {missing}")
+    return [papers[paper_id] for paper_id in ids]
+
+
+def fetch_or_scrape_papers(urls: Sequence[str]) -> List[Tuple[str, List[str], str]]:
+    """Scrapes the abs page for one paper, or uses the API for several"""
+    if len(urls) == 1:
+        return [scrape_arxiv_abs_page(urls[0])]
+    return fetch_papers(urls)
+
+
+# ================================================================ debug
+
+def save_abs_pages(urls: Sequence[str], corpus_dir: str = ABS_PAGE_CORPUS_DIR):
+    """Saves abs page html so we can benchmark parsing without the network"""
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    for url in urls:
+        html = _download_html(url.replace('//arxiv.org', '//export.arxiv.org'))
+        saveas = os.path.join(corpus_dir, url.rstrip('/').split('/')[-1] + '.html')
+        with open(saveas, 'wb') as f:
+            f.write(html)
+
+
+_FEED_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title type="html">ArXiv Query: id_list={id_list}</title>
+{entries}
+</feed>
+"""
+_ENTRY_TEMPLATE = """  <entry>
+    <id>http://arxiv.org/abs/{paper_id}v2</id>
+    <title>Paper number
+      {paper_id}</title>
+    <summary>  Abstract of {paper_id}.
+</summary>
+    <author><name>First Author {paper_id}</name></author>
+    <author><name> Second Author</name></author>
+  </entry>"""
+# what arxiv sends back for ids that don't exist
+_ERROR_ENTRY = """  <entry>
+    <id>http://arxiv.org/api/errors#incorrect_id_format_for_{paper_id}</id>
+    <title>Error</title>
+    <summary>incorrect id format for {paper_id}</summary>
+  </entry>"""
+
+
+class _CountingBucket(rate_limit.TokenBucket):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_acquires = 0
+
+    def acquire(self) -> None:
+        super().acquire()
+        self.num_acquires += 1
+
+
+def test_fetch_papers():
+    import http.server
+    import threading
+    import urllib.parse
+    known_ids = [f'2201.{i:05d}' for i in range(1, 102)]  # > 1 request's worth
+    requested_id_lists = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            ids = query['id_list'][0].split(',')
+            requested_id_lists.append(ids)
+            entries = [(_ENTRY_TEMPLATE if paper_id in known_ids else _ERROR_ENTRY
+                        ).format(paper_id=paper_id) for paper_id in ids[::-1]]
+            body = _FEED_TEMPLATE.format(id_list=','.join(ids),
+                                         entries='\n'.join(entries)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/atom+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    global arxiv_rate_limiter
+    real_limiter = arxiv_rate_limiter
+    # no state file, so we don't use up the real one's budget
+    arxiv_rate_limiter = _CountingBucket(rate=ARXIV_MAX_REQS_PER_SEC)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f'http://127.0.0.1:{server.server_port}/api/query'
+    try:
+        # order, duplicates and url / version forms all come back as asked
+        urls = [f'https://arxiv.org/abs/{known_ids[5]}v1', known_ids[0],
+                f'https://arxiv.org/pdf/{known_ids[5]}.pdf']
+        papers = fetch_papers(urls, api_url=api_url)
+        assert papers[0] == papers[2]
+        title, authors, abstract = papers[1]
+        assert title == f'Paper number {known_ids[0]}', title
+        assert authors == [f'First Author {known_ids[0]}', 'Second Author'], authors
+        assert abstract == f'Abstract of {known_ids[0]}.', abstract
+        assert requested_id_lists == [[known_ids[5], known_ids[0]]]
+
+        # more ids than fit in one request
+        t0 = time.perf_counter()
+        papers = fetch_papers(known_ids[::-1], api_url=api_url)
+        elapsed = time.perf_counter() - t0
+        assert [p[0] for p in papers] == [f'Paper number {i}' for i in known_ids[::-1]]
+        assert [len(ids) for ids in requested_id_lists[1:]] == [API_MAX_IDS_PER_REQUEST, 1]
+
+        try:
+            fetch_papers([known_ids[0], '2201.99999'], api_url=api_url)
+            assert False, "should have complained about the missing id"
+        except ValueError as e:
+            assert '2201.99999' in str(e) and known_ids[0] not in str(e), e
+
+        # every request waited on the limiter, and it held them to 4/s
+        assert arxiv_rate_limiter.num_acquires == len(requested_id_lists) == 4
+        assert elapsed >= .9 / ARXIV_MAX_REQS_PER_SEC, elapsed
+    finally:
+        server.shutdown()
+        arxiv_rate_limiter = real_limiter
+
+
+def bench_abs_page_parsing(corpus_dir: str = ABS_PAGE_CORPUS_DIR, niters: int = 20):
+    paths = sorted(glob.glob(os.path.join(corpus_dir, '*.html')))
+    if not paths:
+        print(f"No saved abs pages in '{corpus_dir}'; try save_abs_pages() first")
+        return
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    for path, html in zip(paths, pages):
+        assert _parse_abs_page_stream(html) == _parse_abs_page_bs4(html), \
+            f"backends disagree on {path}"
+
+    for backend in ABS_PAGE_BACKENDS:
+        t0 = time.perf_counter()
+        for _ in range(niters):
+            for html in pages:
+                parse_arxiv_abs_page(html, backend=backend)
+        secs_per_page = (time.perf_counter() - t0) / (niters * len(pages))
+        print(f'{backend}:\t{secs_per_page * 1e3:.2f}ms per page ({len(pages)} pages)')
+
+
 if __name__ == '__main__':
+    # test_fetch_papers()
     scrape_arxiv_abs_page(URL_PRUNING_SURVEY)
     # scrape_arxiv_abs_page(URL_ONE_AUTHOR)
+    # save_abs_pages([URL_PRUNING_SURVEY, URL_MADDNESS, URL_ONE_AUTHOR])
+    # bench_abs_page_parsing()
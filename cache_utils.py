@@ -0,0 +1,446 @@
+
+import functools
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# one sqlite file for every cached call in the project; sqlite handles the
+# locking, so several processes (e.g. --batch_preview workers) can share it
+CACHE_PATH_ENV_VAR = 'PAPER_THREADER_CACHE_PATH'
+DEFAULT_CACHE_PATH = 'cache.sqlite'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECS = 7 * 24 * 3600
+LOCK_TIMEOUT_SECS = 30
+# get() queues up hit counts and access times and writes them in one
+# transaction once there are this many, or this long after the last write
+STATS_FLUSH_EVERY = 64
+STATS_FLUSH_SECS = 5.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    account TEXT NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    expires REAL NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (namespace, account, key)
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    namespace TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+-- running SUM(size) over entries, so set() doesn't have to scan for it;
+-- only computed here for cache files from before the meta table existed
+INSERT OR IGNORE INTO meta (name, value)
+    SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries;
+"""
+
+
+def _encode(value: Any):
+    if isinstance(value, bytes):
+        return 'bytes', zlib.compress(value)
+    s = json.dumps(value, separators=(',', ':'))
+    return 'json', zlib.compress(s.encode('utf-8'))
+
+
+def _decode(kind: str, payload: bytes) -> Any:
+    raw = zlib.decompress(payload)
+    if kind == 'bytes':
+        return raw
+    return json.loads(raw.decode('utf-8'))
+
+
+@dataclass
+class NamespaceStats:
+    namespace: str
+    num_entries: int = 0
+    num_bytes: int = 0
+    num_expired: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+class Cache:
+    """Key-value cache in a sqlite file, with TTLs and LRU eviction.
+
+    Entries live under a namespace (usually the cached function's name)
+    and an account, so that, e.g., results fetched as one twitter user
+    never get served to another. Values must be bytes or json-able;
+    callers convert API objects to plain dicts themselves.
+    """
+
+    def __init__(self, path: str = '', max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path or os.environ.get(CACHE_PATH_ENV_VAR, DEFAULT_CACHE_PATH)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._pending_lock = threading.Lock()
+        self._pending_pid = None
+        self._reset_pending()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads or forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECS,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE grabs the write lock up front, so concurrent writers
+        # queue up on the busy timeout instead of failing mid-transaction
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _reset_pending(self):
+        self._pending_counts: Dict[str, List[int]] = {}  # ns -> [hits, misses]
+        self._pending_access: Dict[tuple, float] = {}  # (ns, account, key) -> time
+        self._num_pending = 0
+        self._last_flush = time.time()
+
+    def _record_access(self, namespace: str, account: str, key: str,
+                       hit: bool, now: float):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                # fresh process (or a fork, whose pending reads are the
+                # parent's to write), so it needs its own flush at exit
+                self._reset_pending()
+                self._pending_pid = os.getpid()
+                self._flush_at_exit()
+            counts = self._pending_counts.setdefault(namespace, [0, 0])
+            counts[0 if hit else 1] += 1
+            if hit:
+                self._pending_access[(namespace, account, key)] = now
+            self._num_pending += 1
+            should_flush = (self._num_pending >= STATS_FLUSH_EVERY or
+                            now - self._last_flush >= STATS_FLUSH_SECS)
+        if should_flush:
+            self.flush()
+
+    def _flush_at_exit(self):
+        # multiprocessing's exit hook rather than atexit, since pool workers
+        # skip atexit handlers but do run these
+        from multiprocessing import util
+        util.Finalize(self, self._flush_quietly, exitpriority=0)
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except sqlite3.Error:
+            pass  # e.g. a temp cache whose directory is already gone
+
+    def flush(self) -> None:
+        """Writes out the hit counts and access times get() has queued up"""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                return
+            counts, access = self._pending_counts, self._pending_access
+            self._reset_pending()
+        if not counts:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO stats (namespace, hits, misses) VALUES (?, ?, ?) '
+                'ON CONFLICT(namespace) DO UPDATE SET '
+                'hits = hits + excluded.hits, misses = misses + excluded.misses',
+                [(ns, hits, misses) for ns, (hits, misses) in counts.items()])
+            conn.executemany(
+                'UPDATE entries SET last_access = MAX(last_access, ?) '
+                'WHERE namespace = ? AND account = ? AND key = ?',
+                [(t, *k) for k, t in access.items()])
+
+    def close(self) -> None:
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def get(self, namespace: str, key: str, account: str = '',
+            default: Any = None) -> Any:
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            'SELECT kind, payload, expires FROM entries '
+            'WHERE namespace = ? AND account = ? AND key = ?',
+            (namespace, account, key)).fetchone()
+        hit = row is not None and row[2] > now
+        # no write here; parallel readers would all queue on the write lock
+        self._record_access(namespace, account, key, hit, now)
+        if not hit:
+            return default
+        return _decode(row[0], row[1])
+
+    def set(self, namespace: str, key: str, value: Any, account: str = '',
+            ttl_secs: float = DEFAULT_TTL_SECS) -> None:
+        kind, payload = _encode(value)
+        now = time.time()
+        size = len(payload) + len(key)
+        with self._transaction() as conn:
+            old = conn.execute(
+                'SELECT size FROM entries '
+                'WHERE namespace = ? AND account = ? AND key = ?',
+                (namespace, account, key)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (namespace, account, key, kind, '
+                'payload, size, created, expires, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (namespace, account, key, kind, payload,
+                 size, now, now + ttl_secs, now))
+            total = self._add_bytes(conn, size - (old[0] if old else 0))
+        if total > self.max_bytes:
+            self.prune()
+
+    def _add_bytes(self, conn: sqlite3.Connection, delta: int) -> int:
+        # callers hold a transaction, so this stays in step with entries
+        (total, ) = conn.execute(
+            "UPDATE meta SET value = value + ? WHERE name = 'total_bytes' "
+            "RETURNING value", (delta, )).fetchone()
+        return total
+
+    def prune(self, max_bytes: Optional[int] = None) -> int:
+        """Drops expired entries, then least recently used ones until
+        the cache fits in max_bytes. Returns how many entries it dropped."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self.flush()  # so eviction sees the latest access times
+        now = time.time()
+        with self._transaction() as conn:
+            (expired_bytes, ) = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries WHERE expires <= ?',
+                (now, )).fetchone()
+            num_dropped = conn.execute(
+                'DELETE FROM entries WHERE expires <= ?', (now, )).rowcount
+            total = self._add_bytes(conn, -expired_bytes)
+            if total > max_bytes:
+                rows = conn.execute('SELECT rowid, size FROM entries '
+                                    'ORDER BY last_access').fetchall()
+                evict = []
+                for rowid, size in rows:
+                    if total <= max_bytes:
+                        break
+                    evict.append((rowid, ))
+                    total -= size
+                conn.executemany('DELETE FROM entries WHERE rowid = ?', evict)
+                conn.execute("UPDATE meta SET value = ? WHERE name = 'total_bytes'",
+                             (total, ))
+                num_dropped += len(evict)
+        return num_dropped
+
+    def clear(self, namespace: str = '') -> None:
+        self.flush()
+        with self._transaction() as conn:
+            if namespace:
+                (nbytes, ) = conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM entries WHERE namespace = ?',
+                    (namespace, )).fetchone()
+                conn.execute('DELETE FROM entries WHERE namespace = ?', (namespace, ))
+                conn.execute('DELETE FROM stats WHERE namespace = ?', (namespace, ))
+                self._add_bytes(conn, -nbytes)
+            else:
+                conn.execute('DELETE FROM entries')
+                conn.execute('DELETE FROM stats')
+                conn.execute("UPDATE meta SET value = 0 WHERE name = 'total_bytes'")
+
+    def stats(self) -> List[NamespaceStats]:
+        self.flush()
+        conn = self._conn()
+        now = time.time()
+        ret: Dict[str, NamespaceStats] = {}
+        for ns, n, nbytes, nexpired in conn.execute(
+                'SELECT namespace, COUNT(*), SUM(size), SUM(expires <= ?) '
+                'FROM entries GROUP BY namespace', (now, )):
+            ret[ns] = NamespaceStats(ns, num_entries=n, num_bytes=nbytes,
+                                     num_expired=nexpired)
+        for ns, hits, misses in conn.execute(
+                'SELECT namespace, hits, misses FROM stats'):
+            ret.setdefault(ns, NamespaceStats(ns))
+            ret[ns].hits = hits
+            ret[ns].misses = misses
+        return [ret[ns] for ns in sorted(ret)]
+
+    def format_stats(self) -> str:
+        lines = [f'cache: {self.path}']
+        stats = self.stats()
+        if not stats:
+            lines.append('  (empty)')
+        for s in stats:
+            lines.append(f'  {s.namespace}: {s.num_entries} entries '
+                         f'({s.num_bytes / 1024:.1f} KiB, {s.num_expired} expired), '
+                         f'{s.hits} hits / {s.misses} misses '
+                         f'(hit rate {s.hit_rate:.1%})')
+        return '\n'.join(lines)
+
+    def cached(self,
+               ttl_secs: float = DEFAULT_TTL_SECS,
+               ignore: Sequence[str] = (),
+               account: Optional[Callable[[], str]] = None,
+               namespace: str = '',
+               encode: Optional[Callable[[Any], Any]] = None,
+               decode: Optional[Callable[[Any], Any]] = None):
+        """Decorator, roughly like joblib's memory.cache.
+
+        Args:
+            ttl_secs: how long results stay valid
+            ignore: names of args to leave out of the key, like api clients
+            account: returns who we're authenticated as; results are only
+                shared between calls made as the same account
+            namespace: defaults to module.function_name
+            encode: turns the return value into bytes or something json-able
+            decode: inverse of encode
+        """
+        def decorator(f):
+            sig = inspect.signature(f)
+            ns = namespace or f'{f.__module__}.{f.__qualname__}'
+
+            def _key(args, kwargs) -> str:
+                bound = sig.bind(*args, **kwargs)
+                bound.apply_defaults()
+                keep = {k: v for k, v in bound.arguments.items() if k not in ignore}
+                return json.dumps(keep, sort_keys=True, default=str,
+                                  separators=(',', ':'))
+
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                key = _key(args, kwargs)
+                acct = account() if account is not None else ''
+                missing = object()
+                val = self.get(ns, key, account=acct, default=missing)
+                if val is not missing:
+                    return decode(val) if decode is not None else val
+                ret = f(*args, **kwargs)
+                val = encode(ret) if encode is not None else ret
+                self.set(ns, key, val, account=acct, ttl_secs=ttl_secs)
+                return ret
+
+            wrapper.uncached = f
+            wrapper.namespace = ns
+            return wrapper
+        return decorator
+
+
+# everything in the project shares this one
+cache = Cache()
+
+
+# ================================================================ debug
+
+def _sum_size(c: Cache) -> int:
+    return c._conn().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+
+def _total_bytes(c: Cache) -> int:
+    return c._conn().execute(
+        "SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+
+
+def test_cache():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        c = Cache(os.path.join(d, 'cache.sqlite'), max_bytes=10_000)
+        for i in range(20):
+            c.set('ns', f'k{i}', 'x' * 100 * i)
+        c.set('ns', 'k3', 'replaced')  # replacing shouldn't double count
+        c.set('ns', 'gone', 'y', ttl_secs=-1)
+        c.set('other', 'k', {'a': 1})
+        assert _total_bytes(c) == _sum_size(c)
+
+        # reads only get written out in batches
+        assert c.get('ns', 'k3') == 'replaced'
+        assert c.get('ns', 'nope') is None
+        assert c._conn().execute('SELECT COUNT(*) FROM stats').fetchone()[0] == 0
+        for _ in range(STATS_FLUSH_EVERY - 2):
+            c.get('other', 'k')
+        assert c._num_pending == 0
+        hits, misses = c._conn().execute(
+            "SELECT hits, misses FROM stats WHERE namespace = 'ns'").fetchone()
+        assert (hits, misses) == (1, 1), (hits, misses)
+
+        # k3 was read most recently, so it outlives its neighbors
+        c.get('ns', 'k3')
+        c.prune(max_bytes=200)
+        assert _total_bytes(c) == _sum_size(c) <= 200
+        assert c.get('ns', 'k3') == 'replaced'
+        assert c.get('ns', 'gone') is None
+
+        c.clear('other')
+        assert _total_bytes(c) == _sum_size(c)
+        c.clear()
+        assert _total_bytes(c) == 0
+        print(c.format_stats())
+        c.close()
+
+
+def _read_many(path: str, keys: List[str]):
+    c = Cache(path)
+    t0 = time.perf_counter()
+    for key in keys:
+        c.get('bench', key)
+    c.flush()
+    return time.perf_counter() - t0
+
+
+def bench_parallel_reads(num_procs: int = 4, num_reads: int = 2000):
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'cache.sqlite')
+        c = Cache(path)
+        keys = [f'k{i}' for i in range(500)]
+        for key in keys:
+            c.set('bench', key, 'x' * 1000)
+        t0 = time.perf_counter()
+        for key in keys:
+            c.set('bench', key, 'y' * 1000)
+        print(f'set: {(time.perf_counter() - t0) / len(keys) * 1e6:.0f}us each')
+        reads = (keys * (num_reads // len(keys) + 1))[:num_reads]
+        with ProcessPoolExecutor(num_procs) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(_read_many, [path] * num_procs, [reads] * num_procs))
+            elapsed = time.perf_counter() - t0
+        print(f'{num_procs} procs x {num_reads} gets: {elapsed * 1e3:.0f}ms '
+              f'({elapsed / (num_procs * num_reads) * 1e6:.0f}us each)')
+        hits = c.stats()[0].hits
+        assert hits == num_procs * num_reads, hits
+        c.close()
+
+
+def main():
+    test_cache()
+    # bench_parallel_reads()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import tempfile
+import time
+from typing import Iterator, List, Optional, Union
+
+import snapshot_utils as snapshots
+import twitter_utils as twit
+from import_utils import lazy_import
+
+tweepy = lazy_import('tweepy')
+
+# big accounts have hundreds of thousands of followers, which takes hours to
+# crawl at 200 per request and 15 requests per 15min. So the crawl goes
+# straight to disk a page at a time, with a checkpoint after each page so
+# that a crash or ctrl-c doesn't lose it, and the final sort happens on
+# disk too.
+
+FOLLOWER_LISTS_DIR = 'follower_lists'
+CRAWLS_DIR = os.path.join(FOLLOWER_LISTS_DIR, 'crawls')
+FOLLOWERS_PER_PAGE = 200  # the most followers/list allows
+RECRAWL_AFTER_SECS = 24 * 3600  # finished crawls older than this get redone
+SORT_CHUNK_SIZE = 100 * 1000  # followers sorted in memory at a time
+PRINT_EVERY_PAGES = 10
+
+def _follower_record(user: tweepy.User) -> dict:
+    return {k: user._json[k] for k in twit.USER_CACHE_FIELDS if k in user._json}
+
+
+class FollowerCrawl:
+    """One user's followers, crawled into a directory a page at a time.
+
+    Each page gets appended to followers.jsonl and fsynced, and only then
+    does checkpoint.json get (atomically) replaced with the cursor for the
+    next page and how many bytes of followers.jsonl are good. If the crawl
+    dies partway through, crawl() on a new FollowerCrawl for the same dir
+    drops anything past the checkpoint and picks up from that cursor.
+    """
+
+    def __init__(self, crawl_dir: str):
+        self.dir = crawl_dir
+        self.followers_path = os.path.join(crawl_dir, 'followers.jsonl')
+        self.checkpoint_path = os.path.join(crawl_dir, 'checkpoint.json')
+        self._reset()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.__dict__.update(json.load(f))
+
+    def _reset(self):
+        self.next_cursor = -1  # what twitter calls the first page
+        self.num_pages = 0
+        self.num_followers = 0
+        self.num_bytes = 0
+        self.started = time.time()
+        self.finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def _save_checkpoint(self):
+        state = {k: getattr(self, k) for k in ('next_cursor', 'num_pages', 'num_followers',
+                                               'num_bytes', 'started', 'finished')}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def restart(self):
+        for path in (self.followers_path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._reset()
+
+    def crawl(self, api: tweepy.API, user_id: Union[int, str],
+              max_pages: Optional[int] = None, verbose: bool = True) -> 'FollowerCrawl':
+        """Fetches pages until there are no more (or max_pages new ones)"""
+        if self.done:
+            return self
+        os.makedirs(self.dir, exist_ok=True)
+        pages = tweepy.Cursor(api.get_followers, user_id=user_id,
+                              count=FOLLOWERS_PER_PAGE,
+                              cursor=self.next_cursor).pages(max_pages or math.inf)
+        with open(self.followers_path, 'ab') as f:
+            f.truncate(self.num_bytes)  # a page written after the last checkpoint
+            for page in pages:
+                f.write(''.join(json.dumps(_follower_record(user)) + '\n'
+                                for user in page).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+                self.next_cursor = pages.next_cursor
+                self.num_pages += 1
+                self.num_followers += len(page)
+                self.num_bytes = f.tell()
+                self._save_checkpoint()
+                if verbose and self.num_pages % PRINT_EVERY_PAGES == 0:
+                    budget = twit.rate_limits.budget('followers/list')
+                    print(f"crawled {self.num_followers} followers so far "
+                          f"({budget.remaining} followers/list calls left, reset in "
+                          f"{budget.secs_until_reset():.0f}s)...")
+        if pages.next_cursor == 0:
+            self.finished = time.time()
+            self._save_checkpoint()
+        return self
+
+    def iter_lines(self) -> Iterator[bytes]:
+        with open(self.followers_path, 'rb') as f:
+            yield from itertools.islice(f, self.num_followers)
+
+    def iter_followers(self) -> Iterator[dict]:
+        """Followers in the order twitter returned them (newest first)"""
+        return map(json.loads, self.iter_lines())
+
+
+_FOLLOWERS_COUNT_RE = re.compile(rb'"followers_count": (\d+)')
+
+
+def _sort_key(line: bytes) -> int:
+    # pulling out the one number is a lot faster than parsing the whole line
+    match = _FOLLOWERS_COUNT_RE.search(line)
+    return -int(match.group(1)) if match else 0
+
+
+def _write_sorted_runs(lines: Iterator[bytes], chunk_size: int,
+                       tmp_dir: str) -> List[str]:
+    runs = []
+    while True:
+        chunk = sorted(itertools.islice(lines, chunk_size), key=_sort_key)
+        if not chunk:
+            return runs
+        runs.append(os.path.join(tmp_dir, f'run{len(runs)}.jsonl'))
+        with open(runs[-1], 'wb') as f:
+            f.writelines(chunk)
+
+
+def iter_sorted_followers(crawl: FollowerCrawl,
+                          chunk_size: int = SORT_CHUNK_SIZE) -> Iterator[dict]:
+    """Followers in descending order of their follower count.
+
+    External merge sort: sorts chunk_size raw lines at a time into files
+    next to the crawl, then streams a merge of those. Ties stay in crawl
+    order, same as sorting the whole list in memory would do.
+    """
+    if crawl.num_followers <= chunk_size:  # no need to touch the disk
+        for line in sorted(crawl.iter_lines(), key=_sort_key):
+            yield json.loads(line)
+        return
+    with tempfile.TemporaryDirectory(dir=crawl.dir) as tmp_dir:
+        runs = _write_sorted_runs(crawl.iter_lines(), chunk_size, tmp_dir)
+        files = [open(path, 'rb') for path in runs]
+        try:
+            for line in heapq.merge(*files, key=_sort_key):
+                yield json.loads(line)
+        finally:
+            for f in files:
+                f.close()
+
+
+def crawl_dir(user_id: Union[int, str], account: str = '') -> str:
+    # per account, since who can see protected accounts' followers differs
+    return os.path.join(CRAWLS_DIR, f'{account or twit.current_account()}-{user_id}')
+
+
+def crawl_followers(id_or_screen_name: Union[int, str],
+                    restart: bool = False) -> FollowerCrawl:
+    """Crawls (or resumes crawling) all of a user's followers. A finished
+    crawl gets reused for RECRAWL_AFTER_SECS."""
+    api = twit.get_api()
+    user_id = id_or_screen_name
+    if not isinstance(user_id, int) and not str(user_id).isdigit():
+        user_id = twit.get_user(api, id_or_screen_name).id
+    crawl = FollowerCrawl(crawl_dir(user_id))
+    if restart or (crawl.done and time.time() - crawl.finished > RECRAWL_AFTER_SECS):
+        crawl.restart()
+    if not crawl.done and crawl.num_pages:
+        print(f"resuming follower crawl of {id_or_screen_name} after "
+              f"{crawl.num_followers} followers")
+    return crawl.crawl(api, user_id)
+
+
+def snapshot_followers(crawl: FollowerCrawl, id_or_screen_name: Union[int, str],
+                       snapshots_dir: str = snapshots.SNAPSHOTS_DIR) -> snapshots.FollowerSnapshot:
+    """Turns a finished crawl into a snapshot, biggest accounts first"""
+    assert crawl.done, "Can only snapshot finished crawls"
+    path = os.path.join(snapshots.user_snapshots_dir(id_or_screen_name, snapshots_dir),
+                        snapshots.snapshot_name(crawl.finished))
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return snapshots.FollowerSnapshot(path)  # already made from this crawl
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return snapshots.write_snapshot(iter_sorted_followers(crawl), path,
+                                    user=str(id_or_screen_name),
+                                    crawled_at=crawl.finished,
+                                    sorted_by='-followers_count')
+
+
+def save_followers(id_or_screen_name: Union[int, str], restart: bool = False,
+                   write_csv: bool = True):
+    crawl = crawl_followers(id_or_screen_name, restart=restart)
+    snapshot = snapshot_followers(crawl, id_or_screen_name)
+    print(f"saved snapshot {snapshot.path}")
+    if write_csv:
+        os.makedirs(FOLLOWER_LISTS_DIR, exist_ok=True)
+        saveas = os.path.join(FOLLOWER_LISTS_DIR, str(id_or_screen_name) + '.csv')
+        snapshots.export_csv(snapshot, saveas)
+    print("total followers of followers: ", int(snapshot['followers_count'].sum()))
+
+
+# ================================================================ debug
+
+class _FakeFollowersApi:
+    """Just enough of tweepy.API to page through made up followers"""
+
+    def __init__(self, num_followers: int, fail_after_pages: Optional[int] = None):
+        self.users = [{'id': i, 'screen_name': f'user{i}', 'name': f'User {i}',
+                       'description': f'bio, with "quotes"\nand lines {i}',
+                       'followers_count': (i * 7919) % 1000, 'friends_count': i}
+                      for i in range(num_followers)]
+        self.fail_after_pages = fail_after_pages
+        self.cursors_requested = []
+
+    def get_followers(self, user_id=None, count=20, cursor=-1):
+        if self.fail_after_pages is not None and \
+                len(self.cursors_requested) >= self.fail_after_pages:
+            raise ConnectionError("fake crash")
+        self.cursors_requested.append(cursor)
+        start = 0 if cursor == -1 else cursor
+        page = self.users[start:start + count]
+        next_cursor = start + count if start + count < len(self.users) else 0
+        return [tweepy.models.User.parse(None, u) for u in page], (start, next_cursor)
+
+    get_followers.pagination_mode = 'cursor'
+
+
+def test_resume_crawl(num_followers: int = 1234, fail_after_pages: int = 3):
+    with tempfile.TemporaryDirectory() as d:
+        crashy_api = _FakeFollowersApi(num_followers, fail_after_pages=fail_after_pages)
+        try:
+            FollowerCrawl(d).crawl(crashy_api, user_id=1)
+            assert False, "fake api should have crashed"
+        except ConnectionError:
+            pass
+        # half a page that got written after the last checkpoint
+        with open(os.path.join(d, 'followers.jsonl'), 'a') as f:
+            f.write('{"id": 99999, "followers_')
+
+        crawl = FollowerCrawl(d)
+        assert crawl.num_followers == fail_after_pages * FOLLOWERS_PER_PAGE
+        api = _FakeFollowersApi(num_followers)
+        crawl.crawl(api, user_id=1)
+        assert crawl.done
+        assert api.cursors_requested[0] == fail_after_pages * FOLLOWERS_PER_PAGE
+
+        ids = [f['id'] for f in crawl.iter_followers()]
+        assert ids == list(range(num_followers))
+
+        expected = sorted(api.users, key=lambda u: u['followers_count'], reverse=True)
+        got = list(iter_sorted_followers(crawl, chunk_size=100))
+        assert [f['id'] for f in got] == [u['id'] for u in expected]
+
+        snapshot = snapshot_followers(crawl, 'someone', snapshots_dir=d)
+        assert list(snapshot['id']) == [u['id'] for u in expected]
+        assert snapshot['description'][0] == expected[0]['description']
+        assert snapshot_followers(crawl, 'someone', snapshots_dir=d).path == snapshot.path
+
+        # finished crawls don't hit the api again
+        crawl.crawl(crashy_api, user_id=1)
+
+
+def bench_sort(num_followers: int = 300 * 1000, chunk_size: int = SORT_CHUNK_SIZE):
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as d:
+        crawl = FollowerCrawl(d)
+        crawl.crawl(_FakeFollowersApi(num_followers), user_id=1, verbose=False)
+
+        tracemalloc.start()
+        t0 = time.perf_counter()  # what we used to do
+        followers = sorted(crawl.iter_followers(), key=lambda f: f['followers_count'],
+                           reverse=True)
+        in_memory_secs = time.perf_counter() - t0
+        in_memory_peak = tracemalloc.get_traced_memory()[1]
+        del followers
+        tracemalloc.reset_peak()
+
+        t0 = time.perf_counter()
+        for _ in iter_sorted_followers(crawl, chunk_size=chunk_size):
+            pass
+        external_secs = time.perf_counter() - t0
+        external_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print(f"sorting {num_followers} followers: in memory {in_memory_secs:.2f}s, "
+          f"peak {in_memory_peak / 2**20:.0f}MiB; external {external_secs:.2f}s, "
+          f"peak {external_peak / 2**20:.0f}MiB")
+
+
+def main():
+    test_resume_crawl()
+    # bench_sort()
+
+    # save_followers('moinnadeem')
+    # save_followers('AveryLamp')
+    # save_followers('davisblalock')
+
+
+if __name__ == '__main__':
+    main()
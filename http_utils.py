@@ -0,0 +1,332 @@
+
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# one keep-alive session for every http request in the process (arxiv,
+# image downloads, tweepy), so we stop paying for a tcp + tls handshake on
+# every call
+
+DEFAULT_TIMEOUT = (5, 60)  # (connect, read) secs
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_HOSTS = 16  # how many hosts to keep pools around for
+MAX_RETRIES = 4
+BACKOFF_FACTOR = .5  # sleeps .5, 1, 2, ... secs between retries
+MAX_RETRY_AFTER_SECS = 120  # don't let a server park us for an hour
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class _CappedRetry(Retry):
+    # honors Retry-After, but only up to a point
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER_SECS)
+
+
+class _TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout; requests has none,
+    so a stuck server would otherwise hang us forever"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+class _RateLimitedAdapter(_TimeoutAdapter):
+    """Sends each request through a rate_limit_utils.RateLimitScheduler.
+
+    classify(request) says which endpoint a request counts against and
+    its priority. A 429 doesn't get retried right away like other errors;
+    the scheduler learns when the endpoint's window resets from it, and
+    we send the request again once that's passed. Like tweepy's
+    wait_on_rate_limit, that keeps going for as long as it takes, unless
+    max_rate_limited_retries says to hand back the 429 sooner.
+    """
+
+    def __init__(self, scheduler, classify: Callable,
+                 max_rate_limited_retries: Optional[int] = None, **kwargs):
+        self.scheduler = scheduler
+        self.classify = classify
+        self.max_rate_limited_retries = max_rate_limited_retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        endpoint, priority = self.classify(request)
+        num_rate_limited = 0
+        while True:
+            with self.scheduler.request(endpoint, priority) as response_info:
+                response = super().send(request, **kwargs)
+                response_info['headers'] = response.headers
+                response_info['rate_limited'] = response.status_code == 429
+            if response.status_code != 429:
+                return response
+            num_rate_limited += 1
+            if (self.max_rate_limited_retries is not None
+                    and num_rate_limited > self.max_rate_limited_retries):
+                return response
+            response.close()
+
+
+class PooledSession(requests.Session):
+    """Session meant to be shared. Libraries that close their session after
+    each request (tweepy does) would tear down everyone's pooled
+    connections, so close() does nothing; use really_close() instead."""
+
+    def close(self):
+        pass
+
+    def really_close(self):
+        super().close()
+
+
+# url prefix -> (scheduler, classify, max_rate_limited_retries) for hosts
+# whose requests go through a rate limit scheduler; see rate_limit_prefix
+_rate_limited_prefixes: Dict[str, Tuple[object, Callable, Optional[int]]] = {}
+
+
+def _retry(max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+           statuses=RETRY_STATUSES) -> Retry:
+    return _CappedRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=statuses,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,  # no POSTs; not idempotent
+        respect_retry_after_header=True,
+        raise_on_status=False,  # hand back the last response, like no retries would
+    )
+
+
+def _mount_rate_limited(session: requests.Session, prefix: str, scheduler,
+                        classify: Callable, max_rate_limited_retries: Optional[int] = None,
+                        max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+                        max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                        timeout=DEFAULT_TIMEOUT):
+    # the scheduler deals with 429s itself
+    retry = _retry(max_retries, backoff_factor,
+                   statuses=[status for status in RETRY_STATUSES if status != 429])
+    session.mount(prefix, _RateLimitedAdapter(scheduler, classify,
+                                              max_rate_limited_retries=max_rate_limited_retries,
+                                              timeout=timeout,
+                                              pool_connections=MAX_HOSTS,
+                                              pool_maxsize=max_connections_per_host,
+                                              pool_block=True,
+                                              max_retries=retry))
+
+
+def make_session(max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+                 max_retries: int = MAX_RETRIES,
+                 backoff_factor: float = BACKOFF_FACTOR,
+                 timeout=DEFAULT_TIMEOUT) -> PooledSession:
+    adapter = _TimeoutAdapter(timeout=timeout,
+                              pool_connections=MAX_HOSTS,
+                              pool_maxsize=max_connections_per_host,
+                              pool_block=True,  # wait for a free connection past the limit
+                              max_retries=_retry(max_retries, backoff_factor))
+    session = PooledSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for prefix, (scheduler, classify, max_rate_limited_retries) in _rate_limited_prefixes.items():
+        _mount_rate_limited(session, prefix, scheduler, classify,
+                            max_rate_limited_retries=max_rate_limited_retries,
+                            max_connections_per_host=max_connections_per_host,
+                            max_retries=max_retries, backoff_factor=backoff_factor,
+                            timeout=timeout)
+    return session
+
+
+_session: Optional[PooledSession] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> PooledSession:
+    """The process-wide session; child processes get their own, since
+    sockets can't be shared across a fork"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = make_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def rate_limit_prefix(prefix: str, scheduler, classify: Callable,
+                      max_rate_limited_retries: Optional[int] = None) -> None:
+    """Sends requests to urls starting with prefix (in the shared session,
+    now and after forks) through scheduler. classify(request) returns
+    (endpoint, priority) for each request. 429s get waited out until they
+    stop, or until max_rate_limited_retries of them if that's set."""
+    with _session_lock:
+        _rate_limited_prefixes[prefix] = (scheduler, classify, max_rate_limited_retries)
+        if _session is not None and _session_pid == os.getpid():
+            _mount_rate_limited(_session, prefix, scheduler, classify,
+                                max_rate_limited_retries=max_rate_limited_retries)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return get_session().get(url, **kwargs)
+
+
+# ================================================================ debug
+
+def _serve_locally(handler_cls):
+    import http.server
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler_cls)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def _keep_alive_handler(body: bytes = b'x' * 1024, delay_secs: float = 0):
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+        disable_nagle_algorithm = True  # else delayed acks stall keep-alive
+
+        def do_GET(self):
+            # stand in for the tcp + tls handshake a real server costs us
+            if delay_secs and not getattr(self, '_warm', False):
+                time.sleep(delay_secs)
+                self._warm = True
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def test_retry_after():
+    import http.server
+    num_calls = [0]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            num_calls[0] += 1
+            status = 503 if num_calls[0] < 3 else 200
+            self.send_response(status)
+            if status == 503:
+                self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve_locally(Handler)
+    try:
+        t0 = time.perf_counter()
+        response = make_session().get(url)
+        elapsed = time.perf_counter() - t0
+        assert response.status_code == 200
+        assert num_calls[0] == 3
+        assert elapsed >= 2, elapsed  # waited out both Retry-Afters
+    finally:
+        server.shutdown()
+
+
+def test_rate_limited_retry():
+    import http.server
+    import rate_limit_utils as rate_limit
+    num_calls = [0]
+    num_429s = 3  # more than a couple; should still get waited out
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            num_calls[0] += 1
+            status = 429 if num_calls[0] <= num_429s else 200
+            self.send_response(status)
+            self.send_header(rate_limit.LIMIT_HEADER, '15')
+            self.send_header(rate_limit.REMAINING_HEADER, '0' if status == 429 else '14')
+            self.send_header(rate_limit.RESET_HEADER, str(time.time() + .3))
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    def classify(request):
+        return 'test', rate_limit.PRIORITY_INTERACTIVE
+
+    server, url = _serve_locally(Handler)
+    scheduler = rate_limit.RateLimitScheduler()
+    session = make_session()
+    _mount_rate_limited(session, url, scheduler, classify)
+    try:
+        t0 = time.perf_counter()
+        response = session.get(url)
+        elapsed = time.perf_counter() - t0
+        assert response.status_code == 200
+        assert num_calls[0] == num_429s + 1
+        assert .6 <= elapsed < 5, elapsed  # waited for each reset, not the default window
+        budget = scheduler.budget('test')
+        assert (budget.remaining, budget.num_requests, budget.num_rate_limited) == (14, 4, 3)
+
+        # with a cap, the 429 comes back once it's used up
+        num_calls[0] = 0
+        _mount_rate_limited(session, url, rate_limit.RateLimitScheduler(), classify,
+                            max_rate_limited_retries=1)
+        response = session.get(url)
+        assert response.status_code == 429
+        assert num_calls[0] == 2
+    finally:
+        session.really_close()
+        server.shutdown()
+
+
+def bench_session_pooling(num_requests: int = 200, handshake_secs: float = .005):
+    """Sequential GETs against a local keep-alive server, with a fresh
+    connection per request (what bare requests.get does) vs the pooled
+    session. handshake_secs is charged once per connection to stand in
+    for the tcp + tls setup a real remote host costs."""
+    server, url = _serve_locally(_keep_alive_handler(delay_secs=handshake_secs))
+    try:
+        t0 = time.perf_counter()
+        for _ in range(num_requests):
+            requests.get(url, timeout=DEFAULT_TIMEOUT).content
+        unpooled_secs = time.perf_counter() - t0
+
+        session = make_session()
+        t0 = time.perf_counter()
+        for _ in range(num_requests):
+            session.get(url).content
+        pooled_secs = time.perf_counter() - t0
+        session.really_close()
+    finally:
+        server.shutdown()
+
+    print(f"{num_requests} requests: unpooled {unpooled_secs * 1000 / num_requests:.2f}ms "
+          f"each, pooled {pooled_secs * 1000 / num_requests:.2f}ms each "
+          f"({unpooled_secs / pooled_secs:.1f}x speedup)")
+
+
+def main():
+    test_retry_after()
+    test_rate_limited_retry()
+    bench_session_pooling()
+
+
+if __name__ == '__main__':
+    main()
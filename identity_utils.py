@@ -0,0 +1,298 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# Which twitter account each paper author is, once we've confirmed it by
+# posting a thread that tags them. Lives in its own sqlite file rather than
+# the cache, since these aren't cheap to redo and shouldn't get evicted or
+# expire; they come from threads we actually posted (including TAG_USERS
+# lines and --authors_to_mention), so they're as good as hand-checked.
+#
+# Names get matched loosely, since arxiv and twitter both spell them however
+# people typed them: "Jérôme Lê" == "Jerome Le", "D. Blalock" ==
+# "Davis W. Blalock", etc. A loose match only counts if it points to one
+# account, so, e.g., "J. Smith" is a miss if we know two J. Smiths.
+INDEX_PATH_ENV_VAR = 'PAPER_THREADER_AUTHOR_INDEX_PATH'
+DEFAULT_INDEX_PATH = 'author_identities.sqlite'
+LOCK_TIMEOUT_SECS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS identities (
+    name_key TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    name TEXT NOT NULL,
+    screen_name TEXT NOT NULL COLLATE NOCASE,
+    user_id INTEGER,
+    source TEXT NOT NULL,
+    times_confirmed INTEGER NOT NULL,
+    first_confirmed REAL NOT NULL,
+    last_confirmed REAL NOT NULL,
+    PRIMARY KEY (name_key, screen_name)
+);
+CREATE INDEX IF NOT EXISTS identities_last_name ON identities (last_name);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# where a confirmed identity came from
+SOURCE_SEARCH = 'search'  # our own user search, then posted
+SOURCE_TAG_USERS = 'tag_users'
+SOURCE_AUTHORS_TO_MENTION = 'authors_to_mention'
+
+# letters NFKD doesn't split into a base letter + accent
+_LATIN_LOOKALIKES = str.maketrans({'ø': 'o', 'ł': 'l', 'đ': 'd', 'ð': 'd', 'þ': 'th',
+                                   'æ': 'ae', 'œ': 'oe', 'ı': 'i'})
+_NAME_SUFFIXES = {'jr', 'sr', 'ii', 'iii', 'iv', 'phd', 'md'}
+_NAME_PREFIXES = {'dr', 'prof'}
+# stuff people put in their twitter names after their actual name
+_DISPLAY_NAME_JUNK = re.compile(r'\(.*?\)|\[.*?\]|[|@·•].*$')
+_PRONOUNS = {'he', 'him', 'his', 'she', 'her', 'hers', 'they', 'them', 'theirs'}
+
+
+def name_tokens(name: str) -> List[str]:
+    """"Jérôme-Louis O'Brien Jr." -> ['jerome', 'louis', 'obrien']"""
+    if name.count(',') == 1:  # "Last, First"
+        last, first = name.split(',')
+        if first.strip().strip('.').lower() not in _NAME_SUFFIXES:
+            name = f'{first} {last}'
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = name.casefold().translate(_LATIN_LOOKALIKES)
+    name = re.sub(r"['’`]", '', name)
+    tokens = re.findall(r'[^\W_]+', name)
+    while len(tokens) > 1 and tokens[0] in _NAME_PREFIXES:
+        tokens.pop(0)
+    while len(tokens) > 1 and tokens[-1] in _NAME_SUFFIXES:
+        tokens.pop()
+    return tokens
+
+
+def display_name_tokens(display_name: str) -> List[str]:
+    """Like name_tokens, but for twitter names, which tend to have pronouns,
+    emoji, affiliations, etc, tacked on"""
+    tokens = name_tokens(_DISPLAY_NAME_JUNK.sub('', display_name))
+    while len(tokens) > 2 and tokens[-1] in _PRONOUNS:
+        tokens.pop()
+    return tokens
+
+
+def _same_given_name(a: str, b: str) -> bool:
+    # an initial matches any name starting with it
+    return a == b or (min(len(a), len(b)) == 1 and a[0] == b[0])
+
+
+def names_match(a: Sequence[str], b: Sequence[str]) -> bool:
+    """Whether two tokenized names could be the same person: same last name
+    and compatible first names. Middle names get ignored, since people
+    include them on some papers but not others."""
+    if not a or not b or a[-1] != b[-1]:
+        return False
+    if len(a) == 1 or len(b) == 1:
+        return len(a) == len(b)
+    return _same_given_name(a[0], b[0])
+
+
+def match_author(display_name: str, authors: Sequence[str]) -> Optional[str]:
+    """Which of authors a twitter account with this display name is, or None
+    if it doesn't look like any of them (or looks like several)"""
+    tokens = display_name_tokens(display_name)
+    matches = [author for author in authors if names_match(tokens, name_tokens(author))]
+    return matches[0] if len(matches) == 1 else None
+
+
+@dataclass
+class Identity:
+    name: str  # as we last saw it on arxiv
+    screen_name: str
+    user_id: Optional[int]
+    source: str
+    times_confirmed: int
+    last_confirmed: float
+
+
+class IdentityIndex:
+    """Persistent author name -> twitter account mapping; see top of file"""
+
+    def __init__(self, path: str = ''):
+        self.path = path or os.environ.get(INDEX_PATH_ENV_VAR, DEFAULT_INDEX_PATH)
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # same deal as cache_utils.Cache: one connection per thread + process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECS,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _count(self, conn: sqlite3.Connection, stat: str, n: int = 1):
+        conn.execute('INSERT INTO stats (name, value) VALUES (?, ?) '
+                     'ON CONFLICT(name) DO UPDATE SET value = value + ?',
+                     (stat, n, n))
+
+    def _lookup(self, conn: sqlite3.Connection, name: str) -> Optional[Identity]:
+        tokens = name_tokens(name)
+        if not tokens:
+            return None
+        rows = conn.execute(
+            'SELECT name_key, name, screen_name, user_id, source, times_confirmed, '
+            'last_confirmed FROM identities WHERE last_name = ? '
+            'ORDER BY times_confirmed DESC, last_confirmed DESC', (tokens[-1], )).fetchall()
+        rows = [row for row in rows if names_match(tokens, row[0].split())]
+        exact = [row for row in rows if row[0] == ' '.join(tokens)]
+        for candidates in (exact, rows):
+            if len({row[2].lower() for row in candidates}) == 1:
+                return Identity(*candidates[0][1:])
+        return None  # never seen them, or ambiguous
+
+    def lookup(self, name: str) -> Optional[Identity]:
+        return self.lookup_many([name]).get(name)
+
+    def lookup_many(self, names: Iterable[str]) -> Dict[str, Identity]:
+        """name -> identity for each of names we know"""
+        names = list(dict.fromkeys(names))
+        conn = self._conn()
+        ret = {}
+        for name in names:
+            identity = self._lookup(conn, name)
+            if identity is not None:
+                ret[name] = identity
+        with self._transaction():
+            self._count(conn, 'hits', len(ret))
+            self._count(conn, 'misses', len(names) - len(ret))
+        return ret
+
+    def record(self, name: str, screen_name: str, user_id: Optional[int] = None,
+               source: str = SOURCE_SEARCH) -> None:
+        """Notes that name is @screen_name, e.g., because we just posted a
+        thread tagging them as that author"""
+        tokens = name_tokens(name)
+        if not tokens:
+            raise ValueError(f"Can't index author name {name!r}")
+        screen_name = screen_name.lstrip('@')
+        now = time.time()
+        with self._transaction() as conn:
+            if user_id is not None:  # they changed their handle since last time
+                conn.execute('DELETE FROM identities WHERE name_key = ? AND user_id = ? '
+                             'AND screen_name != ?', (' '.join(tokens), user_id, screen_name))
+            conn.execute(
+                'INSERT INTO identities (name_key, last_name, name, screen_name, user_id, '
+                'source, times_confirmed, first_confirmed, last_confirmed) '
+                'VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT(name_key, screen_name) DO UPDATE SET '
+                'name = excluded.name, screen_name = excluded.screen_name, '
+                'user_id = COALESCE(excluded.user_id, user_id), source = excluded.source, '
+                'times_confirmed = times_confirmed + 1, last_confirmed = excluded.last_confirmed',
+                (' '.join(tokens), tokens[-1], name, screen_name, user_id, source, now, now))
+
+    def forget(self, name: str) -> int:
+        """Drops every identity recorded under name (e.g., because one was
+        wrong); returns how many there were"""
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM identities WHERE name_key = ?',
+                                (' '.join(name_tokens(name)), )).rowcount
+
+    def __len__(self) -> int:
+        (n, ) = self._conn().execute('SELECT COUNT(*) FROM identities').fetchone()
+        return n
+
+    def format_stats(self) -> str:
+        stats = dict(self._conn().execute('SELECT name, value FROM stats').fetchall())
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        hit_rate = hits / (hits + misses) if hits + misses else 0.
+        return (f'author index: {self.path}\n  {len(self)} identities, '
+                f'{hits} hits / {misses} misses (hit rate {hit_rate:.1%})')
+
+
+# everything in the project shares this one
+index = IdentityIndex()
+
+
+# ================================================================ debug
+
+def test_name_tokens():
+    assert name_tokens("Jérôme-Louis O'Brien Jr.") == ['jerome', 'louis', 'obrien']
+    assert name_tokens('Blalock, Davis W.') == ['davis', 'w', 'blalock']
+    assert name_tokens('Søren Łukasz Straße') == ['soren', 'lukasz', 'strasse']
+    assert name_tokens('Dr. Jane Doe, PhD') == ['jane', 'doe']
+    assert name_tokens('Prabhat') == ['prabhat']
+    assert display_name_tokens('Jonathan Frankle (he/him) 🦋') == ['jonathan', 'frankle']
+    assert display_name_tokens('Jane Doe | hiring! @MIT') == ['jane', 'doe']
+    assert display_name_tokens('Jane Doe she/her') == ['jane', 'doe']
+
+    assert names_match(name_tokens('D. Blalock'), name_tokens('Davis W. Blalock'))
+    assert names_match(name_tokens('Jerome Le'), name_tokens('Jérôme Lê'))
+    assert not names_match(name_tokens('Daniel Blalock'), name_tokens('Davis Blalock'))
+    assert not names_match(name_tokens('Prabhat'), name_tokens('X Prabhat'))
+
+    authors = ['Davis Blalock', 'Jose Javier Gonzalez Ortiz', 'Jonathan Frankle', 'John Guttag']
+    assert match_author('Davis Blalock 🦋', authors) == 'Davis Blalock'
+    assert match_author('José Javier González Ortiz', authors) == 'Jose Javier Gonzalez Ortiz'
+    assert match_author('MosaicML', authors) is None
+    assert match_author('J. Frankle', authors) == 'Jonathan Frankle'
+
+
+def test_identity_index():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        idx = IdentityIndex(os.path.join(d, 'index.sqlite'))
+        assert idx.lookup('Davis Blalock') is None
+
+        idx.record('Davis W. Blalock', '@davisblalock', 123, SOURCE_TAG_USERS)
+        idx.record('Davis W. Blalock', 'DavisBlalock', None)  # same handle, any case
+        hit = idx.lookup('Davis Blalock')
+        assert hit.screen_name == 'DavisBlalock' and hit.user_id == 123
+        assert hit.times_confirmed == 2 and hit.source == SOURCE_SEARCH
+        assert idx.lookup('D. Blalock').screen_name == 'DavisBlalock'
+        assert idx.lookup('Dávis Blalock') is not None
+        assert idx.lookup('Daniel Blalock') is None
+        assert len(idx) == 1
+
+        # two J. Smiths: full names still work, initials are ambiguous
+        idx.record('John Smith', 'jsmith', 1)
+        idx.record('Jane Smith', 'janesmith', 2)
+        assert idx.lookup('John Smith').screen_name == 'jsmith'
+        assert idx.lookup('J. Smith') is None
+        assert idx.lookup('Jane Q. Smith').screen_name == 'janesmith'
+
+        idx.record('John Smith', 'jsmith_ml', 1)  # changed handles
+        assert idx.lookup('John Smith').screen_name == 'jsmith_ml'
+        assert len(idx) == 3
+
+        assert set(idx.lookup_many(['John Smith', 'Nobody', 'D. Blalock'])) == {
+            'John Smith', 'D. Blalock'}
+        assert idx.forget('Jane Smith') == 1
+        assert idx.lookup('Jane Smith') is None
+        assert 'identities' in idx.format_stats()
+
+
+def main():
+    test_name_tokens()
+    test_identity_index()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+
+import concurrent.futures
+import io
+import os
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from import_utils import lazy_import
+
+try:  # only needed for preprocessing, so only loaded then
+    Image = lazy_import('PIL.Image')
+    ImageOps = lazy_import('PIL.ImageOps')
+except ImportError:
+    Image = None
+
+# twitter shows images at most 2048px on a side in its "large" size, and
+# rejects still images over 5MB
+MAX_IMAGE_DIM = 2048
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+JPEG_QUALITIES = (92, 85, 75, 65)  # tried in order until it fits
+MIN_IMAGE_DIM = 64  # give up shrinking past this
+
+FORMAT_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'GIF': '.gif', 'WEBP': '.webp'}
+
+
+@dataclass
+class PreprocessedImage:
+    data: bytes
+    format: str  # PIL format name, like 'PNG'
+    orig_num_bytes: int
+    orig_size: tuple
+    size: tuple
+
+    @property
+    def num_bytes_saved(self) -> int:
+        return self.orig_num_bytes - len(self.data)
+
+    @property
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS.get(self.format, '')
+
+
+class PreprocessStats:
+    """Running totals of how much preprocessing shrank a thread's images"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_images = 0
+        self.orig_num_bytes = 0
+        self.num_bytes = 0
+
+    def add(self, img: PreprocessedImage):
+        with self._lock:
+            self.num_images += 1
+            self.orig_num_bytes += img.orig_num_bytes
+            self.num_bytes += len(img.data)
+
+    def __str__(self):
+        saved = self.orig_num_bytes - self.num_bytes
+        frac = saved / self.orig_num_bytes if self.orig_num_bytes else 0.
+        return (f"image preprocessing saved {saved / 1024:.0f}KiB of "
+                f"{self.orig_num_bytes / 1024:.0f}KiB ({frac:.0%}) "
+                f"across {self.num_images} images")
+
+
+def _encode(img: 'Image.Image', fmt: str, quality: int = JPEG_QUALITIES[0]) -> bytes:
+    # not passing img.info along is what strips exif, icc profiles, etc
+    buf = io.BytesIO()
+    if fmt == 'PNG':
+        img.save(buf, format='PNG', optimize=True)
+    elif fmt == 'JPEG':
+        img.convert('RGB').save(buf, format='JPEG', quality=quality,
+                                optimize=True, progressive=True)
+    else:
+        raise ValueError(f"Can't encode format '{fmt}'")
+    return buf.getvalue()
+
+
+def _has_alpha(img: 'Image.Image') -> bool:
+    if img.mode in ('RGBA', 'LA'):
+        return img.getextrema()[-1][0] < 255  # any non-opaque pixels?
+    return img.mode == 'P' and 'transparency' in img.info
+
+
+def preprocess_image(data: bytes,
+                     max_dim: int = MAX_IMAGE_DIM,
+                     max_bytes: int = MAX_IMAGE_BYTES) -> PreprocessedImage:
+    """Shrinks an image for twitter.
+
+    Downscales to at most max_dim on a side, drops metadata, and keeps
+    whichever of lossless PNG or high quality JPEG is smaller (only PNG for
+    images with transparency). If that's still over max_bytes, lowers
+    JPEG quality and then resolution until it fits. Animated images are
+    passed through as-is, since re-encoding them tends to make them bigger.
+    """
+    if Image is None:
+        raise ImportError("Image preprocessing needs Pillow; pip install pillow")
+
+    img = Image.open(io.BytesIO(data))
+    orig_size, orig_format = img.size, img.format
+    has_metadata = any(k in img.info for k in ('exif', 'icc_profile', 'xmp', 'comment'))
+    if getattr(img, 'is_animated', False):
+        if len(data) > max_bytes:
+            raise ValueError(f"Animated image is {len(data)} bytes; "
+                             f"can't shrink it below {max_bytes}")
+        return PreprocessedImage(data, orig_format, len(data), orig_size, orig_size)
+
+    img = ImageOps.exif_transpose(img)  # bake in rotation before dropping exif
+    keep_alpha = _has_alpha(img)
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        img = img.convert('RGBA' if keep_alpha else 'RGB')
+    small_img = img.copy()
+    small_img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+    # (bytes, format, image they encode)
+    small_fmt = 'PNG' if keep_alpha else 'JPEG'
+    small_candidate = (_encode(small_img, small_fmt), small_fmt, small_img)
+    candidates = [small_candidate]
+    if not keep_alpha:
+        candidates.append((_encode(small_img, 'PNG'), 'PNG', small_img))
+    if small_img.size != img.size and orig_format == 'PNG':
+        # downscaling antialiases text in screenshots, which can make them
+        # compress worse than the full size original
+        candidates.append((_encode(img, 'PNG'), 'PNG', img))
+    if not has_metadata and orig_format in ('PNG', 'JPEG'):
+        candidates.append((data, orig_format, img))  # already as good as it gets
+    out, fmt, img = min(candidates, key=lambda c: len(c[0]))
+
+    # still too big; trade quality, then resolution, until it fits
+    if len(out) > max_bytes:
+        out, fmt, img = small_candidate
+    qualities = JPEG_QUALITIES[1:] if not keep_alpha else ()
+    for quality in qualities:
+        if len(out) <= max_bytes:
+            break
+        out, fmt = _encode(img, 'JPEG', quality=quality), 'JPEG'
+    while len(out) > max_bytes:
+        w, h = img.size
+        if min(w, h) * 3 // 4 < MIN_IMAGE_DIM:
+            raise ValueError(f"Couldn't shrink image below {max_bytes} bytes")
+        img = img.resize((w * 3 // 4, h * 3 // 4), Image.LANCZOS)
+        fmt = 'PNG' if keep_alpha else 'JPEG'
+        out = _encode(img, fmt, quality=JPEG_QUALITIES[-1])
+
+    return PreprocessedImage(out, fmt, len(data), orig_size, img.size)
+
+
+# ------------------------------------------------ process pool
+
+# decoding and re-encoding is cpu bound, so it happens in other processes;
+# the pool is shared by all the upload threads
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+        return _pool
+
+
+def preprocess_image_in_pool(data: bytes, **kwargs) -> PreprocessedImage:
+    return _get_pool().submit(preprocess_image, data, **kwargs).result()
+
+
+def preprocess_images(datas: Sequence[bytes], **kwargs) -> List[PreprocessedImage]:
+    pool = _get_pool()
+    futures = [pool.submit(preprocess_image, data, **kwargs) for data in datas]
+    return [f.result() for f in futures]
+
+
+# ================================================================ debug
+
+def _screenshot_png(size=(2912, 1600)) -> bytes:
+    from PIL import ImageDraw
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(0, size[1], 24):
+        draw.text((20, y), f'loss {y} accuracy {y / size[1]:.3f} ' * 20, fill='black')
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', compress_level=1)  # like a quick screenshot tool
+    return buf.getvalue()
+
+
+def _photo_jpeg(size=(2000, 1500)) -> bytes:
+    import numpy as np
+    pixels = np.random.default_rng(123).integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='JPEG', quality=98, exif=exif)
+    return buf.getvalue()
+
+
+def test_preprocess_image():
+    screenshot = preprocess_image(_screenshot_png())
+    assert screenshot.num_bytes_saved > 0
+    assert screenshot.format == 'PNG'  # lossless beats jpeg on text
+
+    photo = preprocess_image(_photo_jpeg())
+    assert photo.size == (1500, 2000)  # rotation got applied
+    assert 'exif' not in Image.open(io.BytesIO(photo.data)).info
+    assert len(photo.data) <= MAX_IMAGE_BYTES
+
+    small = preprocess_image(_photo_jpeg(), max_bytes=100 * 1024)
+    assert len(small.data) <= 100 * 1024
+
+
+def main():
+    test_preprocess_image()
+
+
+if __name__ == '__main__':
+    main()
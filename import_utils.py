@@ -0,0 +1,111 @@
+
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+from typing import Dict, Sequence, Tuple
+
+
+class _LazyModule(types.ModuleType):
+    """Stands in for a module until one of its attributes gets used"""
+
+    def __getattr__(self, attr: str):
+        # only called for attributes the stand-in doesn't have, i.e., all of
+        # the real module's. import_module does its own locking, so threads
+        # racing to use the module first are fine, and after that it's just
+        # a sys.modules lookup
+        return getattr(importlib.import_module(self.__name__), attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+    def __repr__(self):
+        return f"<lazy module '{self.__name__}'>"
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns module `name`, but only actually runs its import the first
+    time one of its attributes gets used.
+
+    Lets us keep plain `tweepy.API`-style code in modules without every
+    command paying for every heavy dependency at startup. Raises
+    ModuleNotFoundError right away if the module doesn't exist.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    return _LazyModule(name)
+
+
+# ================================================================ debug
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CREDENTIAL_ENV_VARS = ('API_KEY', 'API_KEY_SECRET', 'ACCESS_TOKEN',
+                       'ACCESS_TOKEN_SECRET', 'BEARER_TOKEN')
+
+# main.py args -> max total time spent importing, in ms. These are ~2x
+# what they take on a laptop; mistletoe alone is ~300ms, since it builds
+# a table of every unicode punctuation character when imported
+IMPORT_TIME_BUDGETS_MS = {
+    ('--help', ): 300,
+    ('--cache_stats', ): 300,
+    ('--markdown_to_thread_preview', '-i', 'cleaned-easy-summary.md',
+     '--authors_to_mention', 'davisblalock'): 1000,
+}
+
+
+def _parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """module -> (self us, cumulative us) from python -X importtime output"""
+    ret = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        ret[name.strip()] = (int(self_us), int(cumulative_us))
+    return ret
+
+
+def measure_import_time(args: Sequence[str]) -> Tuple[float, Dict[str, Tuple[int, int]]]:
+    """Runs main.py with the given args and no twitter credentials, and
+    returns total ms spent importing and the per-module breakdown"""
+    env = {k: v for k, v in os.environ.items() if k not in CREDENTIAL_ENV_VARS}
+    with tempfile.TemporaryDirectory() as d:  # no .env, no cache files left around
+        for arg in args:  # input files; outputs get written next to them
+            if os.path.isfile(os.path.join(REPO_DIR, arg)):
+                shutil.copy(os.path.join(REPO_DIR, arg), d)
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.join(REPO_DIR, 'main.py'), *args],
+            cwd=d, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"main.py {' '.join(args)} failed:\n{proc.stderr[-2000:]}")
+    modules = _parse_importtime(proc.stderr)
+    total_ms = sum(self_us for self_us, _ in modules.values()) / 1000
+    return total_ms, modules
+
+
+def bench_import_times(budgets_ms: Dict[Tuple[str, ...], float] = IMPORT_TIME_BUDGETS_MS,
+                       num_slowest: int = 5):
+    over_budget = []
+    for args, budget_ms in budgets_ms.items():
+        total_ms, modules = measure_import_time(args)
+        status = 'ok' if total_ms <= budget_ms else 'OVER BUDGET'
+        print(f"main.py {' '.join(args)}: {total_ms:.0f}ms of imports "
+              f"(budget {budget_ms:.0f}ms) {status}")
+        slowest = sorted(modules.items(), key=lambda kv: -kv[1][0])[:num_slowest]
+        for name, (self_us, _) in slowest:
+            print(f"    {self_us / 1000:6.1f}ms  {name}")
+        if total_ms > budget_ms:
+            over_budget.append(args)
+    assert not over_budget, f"import time over budget for: {over_budget}"
+
+
+def main():
+    bench_import_times()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 
 import argparse
+import os
 from typing import Dict, List, Sequence
 from unicodedata import name
 
+import analytics_utils as analytics
 import arxiv_utils as arxiv
+import cache_utils
+import follower_utils as followers
+import identity_utils as identity
 import paper_threader as pt
 import twitter_utils as twit
 
@@ -66,7 +71,67 @@ def main() -> None:
         type=str,
         default='',
         help=('a twitter username, without the leading "@" to save the' +
-              f'followers of as a csv in {twit.FOLLOWER_LISTS_DIR}'),
+              f'followers of as a csv in {followers.FOLLOWER_LISTS_DIR}'),
+    )
+    parser.add_argument(
+        '--restart_follower_crawl',
+        default=False,
+        action='store_true',
+        help=('With --save_followers_of_user, start the crawl over instead of '
+              'resuming an unfinished one or reusing one from the past '
+              f'{followers.RECRAWL_AFTER_SECS // 3600} hours'),
+    )
+    parser.add_argument(
+        '--skip_followers_csv',
+        default=False,
+        action='store_true',
+        help=('With --save_followers_of_user, only save the follower snapshot '
+              'and not the csv export'),
+    )
+    parser.add_argument(
+        '--query_followers',
+        type=str,
+        default='',
+        help=('a twitter username (or id) whose saved follower snapshot ' +
+              'to query; prints the biggest matching accounts, their total ' +
+              'reach, and follower count percentiles. With --out_path, ' +
+              'also writes every match as a csv.'),
+    )
+    parser.add_argument(
+        '--snapshot_index',
+        type=int,
+        default=-1,
+        help=('Which snapshot --query_followers uses, oldest first; ' +
+              'defaults to the latest'),
+    )
+    parser.add_argument(
+        '--top_k',
+        type=int,
+        default=analytics.FollowerQuery.k,
+        help='How many of the biggest matching accounts to print',
+    )
+    parser.add_argument('--min_followers', type=int, default=None)
+    parser.add_argument('--max_followers', type=int, default=None)
+    parser.add_argument(
+        '--min_following_ratio',
+        type=float,
+        default=None,
+        help='followers_count / max(1, friends_count) must be at least this',
+    )
+    parser.add_argument('--max_following_ratio', type=float, default=None)
+    parser.add_argument(
+        '--bio_regex',
+        type=str,
+        default='',
+        help='Only accounts whose bio matches this (case-insensitively)',
+    )
+    parser.add_argument(
+        '--bio_keywords',
+        type=str,
+        default=(),
+        nargs='+',
+        help=('Only accounts whose bio contains one of these ' +
+              '(case-insensitively); ORed with --bio_regex'),
     )
     parser.add_argument(
         '--users_for_abstract',
@@ -75,14 +140,52 @@ def main() -> None:
         help=('URL of arxiv abstract; prints info about twitter' +
               f'users that might correspond to the authors'),
     )
+    parser.add_argument(
+        '--report_search_timing',
+        default=False,
+        action='store_true',
+        help=('With --users_for_abstract or --skeleton_for_paper, prints ' +
+              'wall clock time of the twitter user searches vs the sum of ' +
+              'their individual request latencies'),
+    )
     parser.add_argument(
         '--skeleton_for_paper',
         default='',
         type=str,
-        help=('URL of arxiv abstract; writes/prints a markdown file ' +
+        nargs='+',
+        help=('URL(s) of arxiv abstract(s); writes/prints a markdown file ' +
               'with a bare-bones tweet thread to manually work modify; ' +
               'not to be mixed with auto-tweeting due to duplicate ' +
-              'final tweets'),
+              'final tweets. With several URLs, writes one skeleton per ' +
+              'paper, separated by hrules.'),
+    )
+    parser.add_argument(
+        '--cache_stats',
+        default=False,
+        action='store_true',
+        help=('Prints entries, sizes, and hit rates for each kind of ' +
+              f'cached lookup (arxiv pages, user searches, etc) in ' +
+              f'{cache_utils.DEFAULT_CACHE_PATH} or ${cache_utils.CACHE_PATH_ENV_VAR}'),
+    )
+    parser.add_argument(
+        '--prune_cache',
+        default=None,
+        type=float,
+        nargs='?',
+        const=cache_utils.DEFAULT_MAX_BYTES / 2**20,
+        metavar='MAX_MB',
+        help=('Drops expired cache entries, then least recently used ones ' +
+              'until the cache is at most MAX_MB (default ' +
+              f'{cache_utils.DEFAULT_MAX_BYTES // 2**20})'),
+    )
+    parser.add_argument(
+        '--forget_author',
+        default='',
+        type=str,
+        help=('Author name to drop from the author index (in ' +
+              f'{identity.DEFAULT_INDEX_PATH} or ${identity.INDEX_PATH_ENV_VAR}), ' +
+              'e.g., if it has the wrong twitter account for them. The index ' +
+              'gets filled in with the authors each posted thread tags.'),
     )
     parser.add_argument(
         '--pasteboard_to_markdown',
@@ -95,7 +198,23 @@ def main() -> None:
         default=False,
         action='store_true',
         help=('Turns a markdown file into another md file with hrules ' +
-              'where tweet boundaries will be with --tweet_markdown'),
+              'where tweet boundaries will be with --tweet_markdown. ' +
+              'Also accepts an html file (e.g., saved from substack).'),
+    )
+    parser.add_argument(
+        '--batch_preview',
+        default='',
+        type=str,
+        help=('Directory or glob of markdown (or substack html) files to ' +
+              'write thread previews for, in parallel. Previews go next to each ' +
+              'input, or in --out_path if it is given as a directory. ' +
+              'Also writes a summary of per-file timings and tweet counts.'),
+    )
+    parser.add_argument(
+        '--num_workers',
+        default=None,
+        type=int,
+        help='Number of processes for --batch_preview; defaults to one per core',
     )
     parser.add_argument(
         '--tweet_markdown',
@@ -104,6 +223,29 @@ def main() -> None:
         help=('Tweets contents of a markdown file as a thread. Use ' +
               '--markdown_to_thread_preview to check content first.'),
     )
+    parser.add_argument(
+        '--resume',
+        default=False,
+        action='store_true',
+        help=('With --tweet_markdown, continues posting a thread that ' +
+              'failed partway through instead of starting it over'),
+    )
+    parser.add_argument(
+        '--preprocess_images',
+        default=False,
+        action='store_true',
+        help=('With --tweet_markdown, downscales and recompresses images ' +
+              '(and strips their metadata) before uploading them, which ' +
+              'makes uploads faster. Needs pillow.'),
+    )
+    parser.add_argument(
+        '--report_post_timing',
+        default=False,
+        action='store_true',
+        help=('With --tweet_markdown, prints how long each tweet spent ' +
+              'on the critical path, split into waiting on uploads / ' +
+              'lookups and posting'),
+    )
     parser.add_argument(
         '--tag_users_in_image_max_tweets',
         default=2,
@@ -123,6 +265,15 @@ def main() -> None:
               'awkward situations in which only a small fraction of' +
               'authors are on twitter.'),
     )
+    parser.add_argument(
+        '--layout',
+        default='greedy',
+        type=str,
+        choices=pt.LAYOUTS,
+        help=('How to split content into tweets. "greedy" gives each ' +
+              'paragraph its own tweet(s); "optimal" packs paragraphs ' +
+              'and images into as few tweets as possible.'),
+    )
     parser.add_argument(
         '--authors_to_mention',
         default='',
@@ -140,6 +291,13 @@ def main() -> None:
             contents = f.read()
         return contents
 
+    def _thread_from_input_path() -> List[twit.Tweet]:
+        # substack html can skip the markdown step entirely
+        contents = _contents_at_input_path()
+        if args.in_path.endswith(('.html', '.htm')):
+            return pt.html_to_thread(contents, **create_tweets_kwargs)
+        return pt.markdown_to_thread(contents, **create_tweets_kwargs)
+
     def _save_or_print(s: str) -> None:
         if args.out_path:
             with open(args.out_path, 'w') as f:
@@ -148,44 +306,94 @@ def main() -> None:
             print(s)
 
     if args.save_followers_of_user:
-        twit.save_followers(args.save_followers_of_user)
+        followers.save_followers(args.save_followers_of_user,
+                                 restart=args.restart_follower_crawl,
+                                 write_csv=not args.skip_followers_csv)
+        return
+
+    if args.query_followers:
+        query = analytics.FollowerQuery(
+            k=args.top_k,
+            min_followers=args.min_followers,
+            max_followers=args.max_followers,
+            min_following_ratio=args.min_following_ratio,
+            max_following_ratio=args.max_following_ratio,
+            bio_regex=args.bio_regex,
+            bio_keywords=args.bio_keywords)
+        print(analytics.query_followers(args.query_followers, query,
+                                        which=args.snapshot_index,
+                                        out_path=args.out_path))
         return
 
     if args.users_for_abstract:
-        pt.authors_usernames_for_paper(args.users_for_abstract, verbose=True)
+        pt.authors_usernames_for_paper(args.users_for_abstract, verbose=True,
+                                       report_timing=args.report_search_timing)
         return
 
     if args.save_my_twitter_keys:
         twit.authenticate_as_another_account()
         return
 
+    if args.cache_stats or args.prune_cache is not None:
+        if args.prune_cache is not None:
+            num_dropped = cache_utils.cache.prune(
+                max_bytes=int(args.prune_cache * 2**20))
+            print(f"dropped {num_dropped} cache entries")
+        print(cache_utils.cache.format_stats())
+        print(identity.index.format_stats())
+        return
+
+    if args.forget_author:
+        num_dropped = identity.index.forget(args.forget_author)
+        print(f"dropped {num_dropped} identities for '{args.forget_author}'")
+        return
+
     if args.pasteboard_to_markdown:
         markdown = pt.pasteboard_to_markdown()
         _save_or_print(markdown)
         return
 
     if args.skeleton_for_paper:
-        url = args.skeleton_for_paper
-        title, authors, abstract = arxiv.scrape_arxiv_abs_page(url)
-        author_users = pt.find_authors(authors)
-        author_usernames = [user.screen_name for user in author_users]
-        text = pt.skeleton_for_paper(paper_title=title,
-                                     paper_link=url,
-                                     author_usernames=author_usernames,
-                                     abstract=abstract)
-        _save_or_print(text)
+        urls = args.skeleton_for_paper
+        # one API request for all the papers if there are several
+        papers = arxiv.fetch_or_scrape_papers(urls)
+        texts = []
+        for url, (title, authors, abstract) in zip(urls, papers):
+            author_users = pt.find_authors(
+                authors, report_timing=args.report_search_timing)
+            author_usernames = [user.screen_name for user in author_users]
+            texts.append(pt.skeleton_for_paper(paper_title=title,
+                                               paper_link=url,
+                                               author_usernames=author_usernames,
+                                               abstract=abstract))
+        _save_or_print('\n\n----\n\n'.join(texts))
         return
 
     create_tweets_kwargs = dict(
         authors = args.authors_to_mention,
         omit_mention_authors=args.omit_mention_authors,
-        tag_users_in_image_max_tweets=args.tag_users_in_image_max_tweets)
+        tag_users_in_image_max_tweets=args.tag_users_in_image_max_tweets,
+        layout=args.layout)
+
+    if args.batch_preview:
+        in_paths = pt.expand_markdown_paths(args.batch_preview)
+        if not in_paths:
+            print(f"No markdown or html files found at '{args.batch_preview}'")
+            return
+        results = pt.preview_markdown_files(in_paths,
+                                            out_dir=args.out_path,
+                                            num_workers=args.num_workers,
+                                            **create_tweets_kwargs)
+        print(pt.preview_summary_table(results))
+        summary_dir = args.out_path or os.path.dirname(in_paths[0])
+        pt.save_preview_summary(
+            results, os.path.join(summary_dir, pt.PREVIEW_SUMMARY_FILENAME))
+        return
 
     if args.markdown_to_thread_preview:
         if not args.out_path:
-            args.out_path = 'preview-' + args.in_path
-        markdown = _contents_at_input_path()
-        tweets = pt.markdown_to_thread(markdown, **create_tweets_kwargs)
+            args.out_path = pt.PREVIEW_PREFIX + os.path.splitext(args.in_path)[0] + '.md'
+        tweets = _thread_from_input_path()
         # print("================================ tweets")
         # for tweet in tweets:
         #     print("----")
@@ -198,12 +406,22 @@ def main() -> None:
     if args.tweet_markdown:
         if args.user_env:
             twit.override_env(args.user_env)
-        markdown = _contents_at_input_path()
-        tweets = pt.markdown_to_thread(markdown, **create_tweets_kwargs)
+        tweets = _thread_from_input_path()
         # kwargs = {}
         # if len(tweets) > args.tag_users_in_image_max_tweets:
         #     kwargs['tag_users'] = []  # prevent tagging users
-        twit.create_thread(tweets)
+        twit.create_thread(tweets,
+                           report_timing=args.report_post_timing,
+                           resume=args.resume,
+                           preprocess_images=args.preprocess_images)
+        # posting it confirms who the tagged authors are
+        recorded = pt.record_thread_authors(
+            _contents_at_input_path(), tweets,
+            is_html=args.in_path.endswith(('.html', '.htm')),
+            authors=args.authors_to_mention,
+            omit_mention_authors=args.omit_mention_authors)
+        for author, screen_name in recorded.items():
+            print(f"author index: {author} is @{screen_name}")
 
 
 if __name__ == '__main__':
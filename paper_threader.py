@@ -1,35 +1,96 @@
-
+from __future__ import annotations
+
+import bisect
+import collections
+import concurrent.futures
+import copy
+import csv
+import functools
+import glob
 import math
+import os
 import re
+import string
 import subprocess
+import time
+import urllib.parse
 from dataclasses import dataclass, field
-from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple, Union
-
-import bs4
-import mistletoe as mt  # md -> thread
-import numpy as np
-import tweepy  # only imported for type checking of author username lookup
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md  # html -> md
+from html.parser import HTMLParser
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
+import analytics_utils as analytics
 import arxiv_utils as arxiv
+import identity_utils as identity
 import twitter_utils as twit
+from import_utils import lazy_import
+
+# heavy, and each only needed by some commands; mistletoe alone takes ~.3s
+# to import
+bs4 = lazy_import('bs4')
+markdownify = lazy_import('markdownify')  # html -> md
+mt = lazy_import('mistletoe')  # md -> thread
+tweepy = lazy_import('tweepy')  # only for type hints on author username lookup
 
 TEST_HTML_EASY = 'test-summary-easy.html'
 TEST_HTML_HARD = 'test-summary-hard.html'
+TEST_MARKDOWN_EASY = 'cleaned-easy-summary.md'
+TEST_MARKDOWN_HARD = 'cleaned-hard-summary.md'
 FINAL_TWEET_FMT_STRING_PATH_WITH_AUTHORS = 'final-tweet-format-with-authors.txt'
 FINAL_TWEET_FMT_STRING_PATH_ONE_AUTHOR = 'final-tweet-format-one-author.txt'
 FINAL_TWEET_FMT_STRING_PATH_NO_AUTHORS = 'final-tweet-format-no-authors.txt'
+FINAL_TWEET_TEMPLATE_DIR_ENV_VAR = 'FINAL_TWEET_TEMPLATE_DIR'
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
 
 TAG_USERS_MARKER = 'TAG_USERS:'
+PREVIEW_PREFIX = 'preview-'
+PREVIEW_SUMMARY_FILENAME = 'preview-summary.csv'
+HTML_EXTENSIONS = ('.html', '.htm')  # substack posts, vs markdown
 
 
 MAX_TWEET_TEXT_LENGTH = 272  # 280 minus space for " [##/##]"
 ELLIPSIS = '…'
+MAX_IMGS_PER_TWEET = 4
 MAX_TWEET_TEXT_SNIPPET_LENGTH = MAX_TWEET_TEXT_LENGTH - (2 * len(ELLIPSIS))
 
 # ================================================================ author lookup
 
+# bio terms that suggest a candidate is the researcher we're looking for;
+# each one in a bio is worth a point
+AUTHOR_BIO_TERMS = analytics.make_terms([
+    'research',
+    'scien',
+    'university',
+    'phd',
+    'ph.d',
+    'p.h.d',
+    'faculty',
+    'professor',
+    'google',
+    'msr',
+    'microsoft',
+    'deepmind',
+    'facebook',
+    'meta',
+    'openai',
+    'amazon',
+    'stanford',
+    'cmu',
+    'harvard',
+    'oxford',
+    'cambridge',
+    'student',
+    'machine learning',
+    'data',
+    'neural',
+]) + analytics.make_terms([
+    'MIT',
+    'AI',
+    'ML',
+    'NLP',
+    'FAIR',
+], case_sensitive=True)
+AUTHOR_BIO_SCORER = analytics.term_scorer(AUTHOR_BIO_TERMS)
+
 def _print_user(user: tweepy.User):
     user_attrs = [
         # 'id',           # unambiguous int unique to each user
@@ -42,81 +103,102 @@ def _print_user(user: tweepy.User):
         print(f'{attr}:\t{getattr(user, attr)}')
 
 
-def find_authors(authors: Sequence[str],
-                 bonus_terms: Optional[List[str]] = None,
-                 verbose: bool = True,
-                 min_follower_count: int = 20) -> List[tweepy.User]:
-    api = twit.authenticate_v1()
-
-    whitelist_anycase_strings = [
-        'research',
-        'scien',
-        'university',
-        'phd',
-        'ph.d',
-        'p.h.d'
-        'faculty',
-        'professor',
-        'google',
-        'msr',
-        'microsoft',
-        'deepmind',
-        'facebook',
-        'meta',
-        'openai',
-        'amazon',
-        'stanford',
-        'cmu',
-        'harvard',
-        'oxford',
-        'cambridge',
-        'student',
-        'machine learning',
-        'data',
-        'neural',
-    ]
-    whitelist_cased_strings = [
-        'MIT',
-        'AI',
-        'ML',
-        'NLP',
-        'FAIR',
-    ]
-    bonus_terms = bonus_terms or []
-
-    name2scored_users = {}
-    for author in authors:
-        users = twit.search_users(api, q=author, page=0, count=10)
+def _print_known_identity(author: str, known: identity.Identity):
+    print(f'================================ {author}')
+    print(f'------------------------ known (confirmed {known.times_confirmed}x, '
+          f'via {known.source}):')
+    print(f'name:\t{known.name}')
+    print(f'screen_name:\t{known.screen_name}')
+
+
+def _user_from_identity(known: identity.Identity) -> tweepy.User:
+    d = {'name': known.name, 'screen_name': known.screen_name}
+    if known.user_id is not None:
+        d.update(id=known.user_id, id_str=str(known.user_id))
+    return twit._user_from_dict(d)
+
+
+def match_authors(authors: Sequence[str],
+                  bonus_terms: Optional[List[str]] = None,
+                  verbose: bool = True,
+                  min_follower_count: int = 20,
+                  max_workers: int = twit.MAX_SEARCH_WORKERS,
+                  report_timing: bool = False,
+                  scorer: Optional[analytics.TermScorer] = None,
+                  index: Optional[identity.IdentityIndex] = None,
+                  index_stats: Optional[Dict[str, int]] = None) -> Dict[str, tweepy.User]:
+    """author -> best-guess twitter user, for each author who seems to have one.
+
+    Authors we've already confirmed (see identity_utils) come straight from
+    the index; for the rest, candidates are the top few user search results
+    for each name, scored by scorer (AUTHOR_BIO_SCORER by default) on their
+    bio, plus a point for being the top result and one for having exactly
+    the author's name. bonus_terms are extra case-sensitive bio terms worth
+    a point each. If given, index_stats gets how many of the authors the
+    index knew ('hits') and didn't ('misses').
+    """
+    if index is None:
+        index = identity.index
+    distinct_authors = list(dict.fromkeys(authors))
+    author2known = index.lookup_many(distinct_authors)
+    if index_stats is not None:
+        index_stats['hits'] = len(author2known)
+        index_stats['misses'] = len(distinct_authors) - len(author2known)
+    if verbose:
+        num_known = len(author2known)
+        print(f"author index: knew {num_known} of {len(distinct_authors)} authors "
+              f"({num_known / max(len(distinct_authors), 1):.0%}); searching for the rest")
+        for author, known in author2known.items():
+            _print_known_identity(author, known)
+    to_search = [author for author in distinct_authors if author not in author2known]
+
+    author2results, author2latency = {}, {}
+    if to_search:
+        api = twit.get_api()
+        # searches are independent, so overlap them; scoring below still goes
+        # through the authors in order so results don't depend on timing
+        t0 = time.perf_counter()
+        author2results, author2latency = twit.search_many_users(
+            api, to_search, max_workers=max_workers, page=0, count=10)
+        if report_timing:
+            wall_secs = time.perf_counter() - t0
+            summed_secs = sum(author2latency.values())
+            print(f"searched {len(author2results)} distinct authors in "
+                  f"{wall_secs:.2f}s wall clock; requests took {summed_secs:.2f}s "
+                  f"total ({summed_secs / max(wall_secs, 1e-9):.1f}x overlap)")
+
+    scorer = scorer or AUTHOR_BIO_SCORER
+    if bonus_terms:  # same bonus terms -> same scorer, not a new one per call
+        scorer = analytics.term_scorer(
+            scorer.terms + analytics.make_terms(bonus_terms, case_sensitive=True))
+
+    to_score = []  # (author, position in search results, user)
+    for author, users in author2results.items():
         for i, user in enumerate(users):
-            score = 0
             if not user.description:
                 continue  # auto-skip people with no bio
             if user.followers_count < min_follower_count:
                 continue  # auto-skip tiny, inactive accounts
-            if i == 0:
-                score += 1  # twitter top hit is usually right
-            if user.name.lower() == author.lower():
-                score += 1
-            lowercase_bio = user.description.lower()
-            for substr in whitelist_anycase_strings:
-                if substr in lowercase_bio:
-                    score += 1
-            for substr in whitelist_cased_strings:
-                if substr in user.description:
-                    score += 1
-            for s in bonus_terms:
-                if s in user.description:
-                    score += 1
-            if score > 2:  # needs more than just name and 0th position
-                name2scored_users[author] = name2scored_users.get(author, []) + [(score, user)]
-            name2scored_users.get(author)
+            to_score.append((author, i, user))
+    # all the bios at once
+    bio_scores = scorer.score_many([user.description for _, _, user in to_score])
 
-    author2user = {}
+    name2scored_users = {}
+    for (author, i, user), score in zip(to_score, bio_scores.tolist()):
+        if i == 0:
+            score += 1  # twitter top hit is usually right
+        if user.name.lower() == author.lower():
+            score += 1
+        if score > 2:  # needs more than just name and 0th position
+            name2scored_users[author] = name2scored_users.get(author, []) + [(score, user)]
+
+    author2user = {author: _user_from_identity(known)
+                   for author, known in author2known.items()}
     for author, candidates in name2scored_users.items():
         if verbose:
             print(f'================================ {author}')
             for score, user in candidates:
-                print(f'------------------------ candidate (score={score}):')
+                print(f'------------------------ candidate (score={score:g}):')
                 _print_user(user)
         best_user = None
         best_score = -1
@@ -127,20 +209,122 @@ def find_authors(authors: Sequence[str],
         if best_user is not None:
             author2user[author] = best_user
 
-    # return best-guess usernames of authors in order
-    ret = []
-    for author in authors:
-        if author in author2user:
-            ret.append(author2user[author])
-    return ret
+    # in the order the authors were given
+    return {author: author2user[author] for author in distinct_authors
+            if author in author2user}
+
+
+def find_authors(authors: Sequence[str], *args, **kwargs) -> List[tweepy.User]:
+    """Best-guess twitter users for authors, in order, skipping authors who
+    don't seem to have one. Takes the same args as match_authors."""
+    author2user = match_authors(authors, *args, **kwargs)
+    return [author2user[author] for author in authors if author in author2user]
+
+
+# twitter handles are letters, digits and underscores, up to 15 of them
+_MENTION_PATTERN = re.compile(r'(?<![\w@])@(\w{1,15})\b')
+
+
+def _thread_tagged_usernames(tweets: Sequence[twit.Tweet], body: str) -> List[str]:
+    """Who a thread tags: the users tagged in its images, plus @mentions
+    beyond the ones its body text and closing tweet template account for"""
+    def _mentions(text: str) -> collections.Counter:
+        # handles aren't case sensitive
+        return collections.Counter(name.lower() for name in _MENTION_PATTERN.findall(text))
+
+    templates = final_tweet_templates()
+    not_tags = _mentions(body)
+    not_tags += (_mentions(templates.no_authors) | _mentions(templates.one_author) |
+                 _mentions(templates.with_authors))
+    ret = {}  # lowercase -> as written
+    for tweet in tweets:
+        for name in tweet.tag_users + _MENTION_PATTERN.findall(tweet.text):
+            name = name.lstrip('@')
+            if not_tags[name.lower()]:
+                not_tags[name.lower()] -= 1
+                continue
+            ret.setdefault(name.lower(), name)
+    return list(ret.values())
+
+
+def record_thread_authors(contents: str,
+                          tweets: Sequence[twit.Tweet],
+                          is_html: bool = False,
+                          authors: Optional[Sequence[str]] = None,
+                          omit_mention_authors: bool = False,
+                          index: Optional[identity.IdentityIndex] = None) -> Dict[str, str]:
+    """Adds the authors a just-posted thread tagged to the author index.
+
+    Only users the posted thread (`tweets`) actually tagged count, since
+    posting is what confirms them; with omit_mention_authors nobody got
+    tagged, so nothing gets recorded. If the tags were given, via authors
+    (i.e., --authors_to_mention) or TAG_USERS lines, only those count.
+    Each one gets matched to one of the paper's authors by their display
+    name, and skipped if that doesn't work. Returns author -> screen name
+    for everyone it recorded.
+    """
+    if omit_mention_authors:
+        return {}
+    if index is None:
+        index = identity.index
+    if is_html:
+        elems, _, paper_link, tag_users = _html_to_text_img_elems(contents)
+    else:
+        contents, tag_users = _pop_tag_users(contents)
+        elems, _, paper_link = _markdown_to_text_img_elems(contents)
+    # no given tags means they came from our own lookup when building the
+    # thread, and got looked at in the preview before posting
+    source = identity.SOURCE_TAG_USERS if tag_users else identity.SOURCE_SEARCH
+    if authors:
+        tag_users, source = list(authors), identity.SOURCE_AUTHORS_TO_MENTION
+    paper_link = _paper_link_or_first_arxiv_link(contents, paper_link)
+    if not paper_link:
+        return {}  # no idea whose paper it is
+
+    body = '\n'.join(elem.text for elem in elems if isinstance(elem, TextElem))
+    tagged = _thread_tagged_usernames(tweets, body)
+    if tag_users:
+        given = {name.lstrip('@').lower() for name in tag_users}
+        tagged = [name for name in tagged if name.lower() in given]
+    if not tagged:
+        return {}
+    _, paper_authors, _ = arxiv.scrape_arxiv_abs_page(paper_link)
+
+    api = twit.get_api()
+    author2user = {}
+    for username in tagged:
+        user = twit.get_user(api, username)
+        author = identity.match_author(user.name, paper_authors)
+        if author is None:
+            print(f"author index: couldn't tell which author of {paper_link} "
+                  f"@{user.screen_name} ({user.name}) is, so not adding them")
+            continue
+        author2user[author] = user
+
+    for author, user in author2user.items():
+        index.record(author, user.screen_name, getattr(user, 'id', None), source)
+    return {author: user.screen_name for author, user in author2user.items()}
 
 
-def authors_usernames_for_paper(url: str, verbose: bool = True) -> List[str]:
+def authors_usernames_for_paper(url: str, verbose: bool = True,
+                                report_timing: bool = False) -> List[str]:
     _, authors, _ = arxiv.scrape_arxiv_abs_page(url)
-    users = find_authors(authors, verbose=verbose)
+    users = find_authors(authors, verbose=verbose, report_timing=report_timing)
     return [user.screen_name for user in users]
 
 
+def authors_usernames_for_papers(urls: Sequence[str], verbose: bool = True) -> Dict[str, List[str]]:
+    """Like authors_usernames_for_paper, but fetches all the papers' author
+    lists with as few arxiv requests as possible"""
+    urls = list(dict.fromkeys(urls))
+    papers = arxiv.fetch_or_scrape_papers(urls)
+    ret = {}
+    for url, (_, authors, _) in zip(urls, papers):
+        users = find_authors(authors, verbose=verbose)
+        ret[url] = [user.screen_name for user in users]
+    return ret
+
+
 # ======================================= substack pasteboard -> markdown
 
 def _run_cmd(cmd: str, fail_on_stderr_output: bool = True):
@@ -175,7 +359,7 @@ def html_to_markdown(html: str) -> str:
     # html = str(soup.body)
     # print(html)
 
-    ret = md(html, strip=['b', 'i', 'em', 'span', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'ul'])  # wow, markdownify is magic
+    ret = markdownify.markdownify(html, strip=['b', 'i', 'em', 'span', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'ul'])  # wow, markdownify is magic
     # ret = md(html, convert=['p', 'a', 'img', 'ol', 'ul'])  # wow, markdownify is magic
     # ret = md(html, convert=['p', 'a', 'img'])  # wow, markdownify is magic
     ret = ret.replace('⭐', '')
@@ -236,12 +420,17 @@ def _text_in_tag(p: bs4.Tag) -> str:
     return contained_text
 
 
-# def _markdown_to_text_img_elems(markdown: str, paper_title: str = '', paper_link: str = '') -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
-def _markdown_to_text_img_elems(markdown: str) -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
+def _protect_numbered_lines(markdown: str) -> str:
     # string = '1. Input-dependent prompt tuning for multitask learning with many tasks.'
     # markdown = re.sub('^[\s]*(\d*)\.\s', r'\1) ', f'{string}\n{string}', flags=re.MULTILINE)
     # "1. whatever" -> "1): whatever"; avoids mistletoe making it an unordered list
-    markdown = re.sub('^([\s]*)(\d*)\.\s', r'\1\2): ', markdown, flags=re.MULTILINE)
+    return re.sub('^([\s]*)(\d*)\.\s', r'\1\2): ', markdown, flags=re.MULTILINE)
+
+
+# def _markdown_to_text_img_elems(markdown: str, paper_title: str = '', paper_link: str = '') -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
+def _markdown_to_text_img_elems_via_html(markdown: str) -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
+    """Original md -> html -> soup implementation; slow but handles raw html"""
+    markdown = _protect_numbered_lines(markdown)
     # " - whatever" -> whatever
     # markdown = re.sub('^([\s]*)([\+\-\*]*)\s', r'', markdown, flags=re.MULTILINE)
     # print(markdown)
@@ -251,7 +440,7 @@ def _markdown_to_text_img_elems(markdown: str) -> Tuple[List[Union[TextElem, Img
         doc = mt.Document(markdown)              # parse the lines into AST
         html = renderer.render(doc)  # render the AST
     # print(html)
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = bs4.BeautifulSoup(html, 'html.parser')
     # print(soup.prettify())
     # return
     # # print(soup.body)
@@ -361,34 +550,421 @@ def _markdown_to_text_img_elems(markdown: str) -> Tuple[List[Union[TextElem, Img
     return tweet_elems, paper_title, paper_link
 
 
+class _RawHtmlInMarkdown(Exception):
+    pass
+
+
+def _link_target(link: Union[mt.span_token.Link, mt.span_token.AutoLink]) -> str:
+    if isinstance(link, mt.span_token.AutoLink) and link.mailto:
+        return _escape_url('mailto:' + link.target)
+    return _escape_url(link.target)
+
+
+def _collapse_whitespace_node(text: str) -> str:
+    # bs4 squashes text nodes that are entirely whitespace
+    if text.strip(' \n\t\f\r'):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def _link_string(token: mt.span_token.SpanToken) -> Optional[str]:
+    """Mimics bs4's `tag.string` for the <a> the token would render to.
+
+    Adjacent text nodes get merged by the html parser, so e.g. a soft line
+    break between two runs of text still yields a single string.
+    """
+    span = mt.span_token
+    pieces = []  # merged text runs (str) and child tags (tokens)
+    for child in token.children or []:
+        if isinstance(child, span.RawText):
+            text = child.content
+        elif isinstance(child, span.EscapeSequence):
+            text = child.children[0].content
+        elif isinstance(child, span.LineBreak) and child.soft:
+            text = '\n'
+        elif isinstance(child, span.LineBreak):
+            pieces.append(child)  # <br /> followed by a newline
+            text = '\n'
+        else:
+            pieces.append(child)
+            continue
+        if pieces and isinstance(pieces[-1], str):
+            pieces[-1] += text
+        elif text:
+            pieces.append(text)
+    if len(pieces) != 1:
+        return None
+    if isinstance(pieces[0], str):
+        return _collapse_whitespace_node(pieces[0])
+    if isinstance(pieces[0], span.InlineCode):
+        return pieces[0].children[0].content
+    if isinstance(pieces[0], (span.Image, span.LineBreak)):
+        return None
+    return _link_string(pieces[0])
+
+
+def _markdown_to_text_img_elems_via_ast(markdown: str) -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
+    """Single pass over the mistletoe AST; no html rendering or re-parsing.
+
+    Produces the same output as `_markdown_to_text_img_elems_via_html`,
+    including its quirks: only text directly inside a paragraph (or inside
+    a link in a paragraph) is kept, the first link anywhere in the doc is
+    removed and treated as the paper title + link, and paragraphs in
+    tight lists are ignored because they don't render as <p> tags.
+
+    Raises _RawHtmlInMarkdown if the doc has inline or block html, since
+    only the html path knows what to make of that.
+    """
+    markdown = _protect_numbered_lines(markdown)
+    with mt.HTMLRenderer():  # same tokenizer config as the html path
+        doc = mt.Document(markdown)
+    # looked up once, since every attribute access on a lazy module costs
+    # a trip through importlib
+    span, block = mt.span_token, mt.block_token
+
+    tweet_elems = []
+    paper = {}  # title and link of first anchor, once we've found it
+
+    def _walk_inline(token, texts: Optional[List[Optional[str]]], imgs: List[str]):
+        # texts is None once we're inside something other than a link,
+        # since that text wouldn't be a direct child of the <p>; within
+        # texts, None marks where a tag would split the text nodes
+        for child in token.children or []:
+            if isinstance(child, span.HtmlSpan):
+                raise _RawHtmlInMarkdown()
+            if isinstance(child, (span.Link, span.AutoLink)):
+                if not paper:
+                    paper['title'] = _link_string(child)
+                    paper['link'] = _link_target(child)
+                    if texts is not None:
+                        texts.append(None)
+                    continue  # first link gets ripped out entirely
+                if texts is not None:
+                    texts.append(None)
+                _walk_inline(child, texts, imgs)
+                if texts is not None:
+                    texts.append(None)
+            elif isinstance(child, span.Image):
+                imgs.append(_escape_url(child.src))
+                if texts is not None:
+                    texts.append(None)
+            elif texts is None:
+                _walk_inline(child, None, imgs)
+            elif isinstance(child, span.RawText):
+                texts.append(child.content)
+            elif isinstance(child, span.EscapeSequence):
+                texts.append(child.children[0].content)
+            elif isinstance(child, span.LineBreak):
+                if not child.soft:
+                    texts.append(None)  # <br />
+                texts.append('\n')
+            else:
+                texts.append(None)
+                _walk_inline(child, None, imgs)
+                texts.append(None)
+
+    def _walk_block(token, suppress_ptag: bool):
+        if isinstance(token, block.HtmlBlock):
+            raise _RawHtmlInMarkdown()
+        if isinstance(token, block.Paragraph):
+            texts = None if suppress_ptag else []
+            imgs = []
+            _walk_inline(token, texts, imgs)
+            nodes = ['']
+            for t in texts or []:
+                if t is None:
+                    nodes.append('')
+                else:
+                    nodes[-1] += t
+            nodes = [_collapse_whitespace_node(node) for node in nodes if node]
+            text = re.sub('\s', ' ', ''.join(nodes))
+            if text:
+                tweet_elems.append(TextElem(text=text))
+            tweet_elems.extend(ImgElem(url=url) for url in imgs)
+            return
+        if isinstance(token, block.List):
+            suppress_ptag = not token.loose
+        elif isinstance(token, block.Quote):
+            suppress_ptag = False
+        elif isinstance(token, block.Table) and hasattr(token, 'header'):
+            _walk_block(token.header, suppress_ptag)
+        if isinstance(token, (block.Heading,
+                              block.SetextHeading,
+                              block.TableCell)):
+            imgs = []
+            _walk_inline(token, None, imgs)
+            tweet_elems.extend(ImgElem(url=url) for url in imgs)
+            return
+        for child in token.children or []:
+            _walk_block(child, suppress_ptag)
+
+    _walk_block(doc, suppress_ptag=False)
+    return tweet_elems, paper.get('title', ''), paper.get('link', '')
+
+
+# the same doc often gets converted more than once per run (e.g., finding
+# its paper link to look up authors, and then making the thread), so
+# remember the last few
+@functools.lru_cache(maxsize=16)
+def _cached_markdown_to_text_img_elems(markdown: str):
+    try:
+        return _markdown_to_text_img_elems_via_ast(markdown)
+    except _RawHtmlInMarkdown:
+        return _markdown_to_text_img_elems_via_html(markdown)
+
+
+def _markdown_to_text_img_elems(markdown: str) -> Tuple[List[Union[TextElem, ImgElem]], str, str]:
+    tweet_elems, paper_title, paper_link = _cached_markdown_to_text_img_elems(markdown)
+    # callers edit the elems, so they each get their own
+    return [copy.copy(elem) for elem in tweet_elems], paper_title, paper_link
+
+
+# ------------------------------------------------ substack html -> elems
+
+def _escape_url(url: str) -> str:
+    # matches what mistletoe's HTMLRenderer puts in src / href attributes,
+    # after the html parser undoes the entity escaping
+    return urllib.parse.quote(url, safe=mt.html_renderer.URI_SAFE_CHARACTERS)
+
+
+# we ignore everything inside these
+_HTML_SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'svg', 'template'}
+# these end whatever paragraph we're in
+_HTML_BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'body', 'dd', 'div', 'dl',
+    'dt', 'figcaption', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5',
+    'h6', 'header', 'hr', 'html', 'li', 'main', 'nav', 'ol', 'p', 'pre',
+    'section', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+}
+
+
+class _SubstackHtmlParser(HTMLParser):
+    """Streams through (substack) html and collects tweet elems as it goes.
+
+    This is meant to give the same elems as `html_to_markdown` followed by
+    `_markdown_to_text_img_elems`, without building any trees or
+    intermediate documents: formatting tags get dropped but their text
+    kept, headings become regular paragraphs, images wrapped in links
+    are just images, and numbered list items become "1): blah".
+
+    It's not bug-for-bug compatible though. A few things the markdown
+    round trip loses are kept here: bold text, bulleted list items,
+    TAG_USERS lines (markdownify escapes the underscore), and the start
+    number of ordered lists.
+    """
+
+    def __init__(self, pop_tag_users: bool = True):
+        super().__init__(convert_charrefs=True)
+        self.pop_tag_users = pop_tag_users
+        self.tweet_elems = []
+        self.paper_title = ''
+        self.paper_link = ''
+        self.tag_users = []
+        self._text = []  # text in current paragraph
+        self._imgs = []  # images in current paragraph
+        self._anchors = []  # stack of open <a> tags
+        self._list_counters = []  # next item number per open list; None for <ul>
+        self._item_prefix = ''  # list item number, for next paragraph
+        self._skip_depth = 0
+
+    def _add_text(self, text: str):
+        if self._anchors:
+            self._anchors[-1]['text'].append(text)
+        else:
+            self._text.append(text)
+
+    def _end_paragraph(self):
+        text = ''.join(self._text).replace('⭐', '')
+        text = re.sub('\s', ' ', re.sub('[\t \r\n]+', ' ', text)).strip()
+        if text and self._item_prefix:
+            text = self._item_prefix + text
+            self._item_prefix = ''
+        if text and self.pop_tag_users and text.startswith(TAG_USERS_MARKER):
+            self.tag_users += text[len(TAG_USERS_MARKER):].split()
+        elif text:
+            self.tweet_elems.append(TextElem(text=text))
+        self.tweet_elems += [ImgElem(url=url) for url in self._imgs]
+        self._text = []
+        self._imgs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HTML_SKIP_TAGS:
+            self._skip_depth += 1
+        if self._skip_depth:
+            return
+        attrs = dict(attrs)
+        if tag in _HTML_BLOCK_TAGS:
+            self._end_paragraph()
+        if tag == 'ol':
+            self._list_counters.append(int(attrs.get('start') or 1))
+        elif tag == 'ul':
+            self._list_counters.append(None)
+        elif tag == 'li' and self._list_counters and self._list_counters[-1] is not None:
+            self._item_prefix = f'{self._list_counters[-1]}): '
+            self._list_counters[-1] += 1
+        elif tag == 'a':
+            self._anchors.append({'href': attrs.get('href'), 'text': [], 'has_img': False})
+        elif tag == 'img' and attrs.get('src'):
+            self._imgs.append(_escape_url(attrs['src']))
+            for anchor in self._anchors:
+                anchor['has_img'] = True
+        elif tag == 'br':
+            self._add_text('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag == 'a':
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in _HTML_SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+        if self._skip_depth:
+            return
+        if tag in _HTML_BLOCK_TAGS:
+            self._end_paragraph()
+        if tag in ('ol', 'ul') and self._list_counters:
+            self._list_counters.pop()
+        elif tag == 'li':
+            self._item_prefix = ''
+        elif tag == 'a' and self._anchors:
+            anchor = self._anchors.pop()
+            text = ''.join(anchor['text'])
+            title = re.sub('[\t \r\n]+', ' ', text.replace('⭐', '')).strip()
+            # assume first (non-image) link is paper link
+            if (not self.paper_link and anchor['href'] and title
+                    and not anchor['has_img']):
+                self.paper_title = title
+                self.paper_link = _escape_url(anchor['href'])
+            else:
+                self._add_text(text)  # convert other links to raw text
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._add_text(data)
+
+    def close(self):
+        super().close()
+        while self._anchors:
+            self.handle_endtag('a')
+        self._end_paragraph()
+
+
+def _html_to_text_img_elems(html: str, pop_tag_users: bool = True) -> Tuple[List[Union[TextElem, ImgElem]], str, str, List[str]]:
+    """Also returns usernames from any TAG_USERS paragraphs, which get
+    removed if `pop_tag_users`."""
+    parser = _SubstackHtmlParser(pop_tag_users=pop_tag_users)
+    parser.feed(html)
+    parser.close()
+    return parser.tweet_elems, parser.paper_title, parser.paper_link, parser.tag_users
+
+
 # @dataclass
 # class PaperTweetThread:
 #     tweets: List[twit.Tweet]
 #     tag_users: List[str] = field(default_factory=list)
 
 
-def _generate_final_tweet_elem(paper_link: str, author_usernames: Optional[List[str]] = None):
-    if not author_usernames:
-        fmt_path = FINAL_TWEET_FMT_STRING_PATH_NO_AUTHORS
-    elif len(author_usernames) == 1:
-        fmt_path = FINAL_TWEET_FMT_STRING_PATH_ONE_AUTHOR
-    else:
-        fmt_path = FINAL_TWEET_FMT_STRING_PATH_WITH_AUTHORS
+# ------------------------------------------------ closing tweet templates
 
-    with open(fmt_path, 'r') as f:
-        tail_tweet_format_str = f.read()
-    if author_usernames:
-        author_mentions = []
-        for username in author_usernames:
-            if not username:
-                continue
-            if not username.startswith('@'):
-                username = '@' + username
-            author_mentions.append(username)
-        authors_str = ' '.join(author_mentions)
-        text = tail_tweet_format_str.format(link=paper_link, authors=authors_str)
-    else:
-        text = tail_tweet_format_str.format(link=paper_link)
+@dataclass
+class FinalTweetTemplates:
+    """Format strings for the last tweet of a thread.
+
+    There are separate ones for zero, one, and multiple authors so that
+    it doesn't read awkwardly when we didn't find any author usernames.
+    """
+    no_authors: str
+    one_author: str
+    with_authors: str
+    template_dir: str = ''
+
+    def __post_init__(self):
+        # fail at load time rather than in the middle of making a thread
+        where = f" in '{self.template_dir}'" if self.template_dir else ''
+        allowed_fields = [('no_authors', {'link'}),
+                          ('one_author', {'link', 'authors'}),
+                          ('with_authors', {'link', 'authors'})]
+        for attr, allowed in allowed_fields:
+            fmt = getattr(self, attr)
+            try:
+                fields = {name for _, name, _, _ in string.Formatter().parse(fmt)
+                          if name is not None}
+            except ValueError as e:
+                raise ValueError(f"Malformed {attr} template{where}: {e}")
+            if not fields <= allowed:
+                raise ValueError(
+                    f"{attr} template{where} uses fields " +
+                    f"{sorted(fields - allowed)}; only {sorted(allowed)} are allowed")
+
+    def render(self, paper_link: str, author_usernames: Optional[List[str]] = None) -> str:
+        if not author_usernames:
+            fmt = self.no_authors
+        elif len(author_usernames) == 1:
+            fmt = self.one_author
+        else:
+            fmt = self.with_authors
+
+        if author_usernames:
+            author_mentions = []
+            for username in author_usernames:
+                if not username:
+                    continue
+                if not username.startswith('@'):
+                    username = '@' + username
+                author_mentions.append(username)
+            authors_str = ' '.join(author_mentions)
+            return fmt.format(link=paper_link, authors=authors_str)
+        return fmt.format(link=paper_link)
+
+    def rendered_len(self, paper_link: str, author_usernames: Optional[List[str]] = None) -> int:
+        return len(self.render(paper_link, author_usernames).strip())
+
+    def num_tweets(self, paper_link: str, author_usernames: Optional[List[str]] = None) -> int:
+        """How many tweets the closing text will get sharded into"""
+        if self.rendered_len(paper_link, author_usernames) <= MAX_TWEET_TEXT_LENGTH:
+            return 1
+        return len(_shard_text(self.render(paper_link, author_usernames)))
+
+
+# template dir -> (file mtimes, templates)
+_final_tweet_templates_cache: Dict[str, Tuple[Tuple[int, ...], FinalTweetTemplates]] = {}
+
+
+def final_tweet_templates(template_dir: str = '') -> FinalTweetTemplates:
+    """Closing tweet templates for the current account, loaded once.
+
+    Each account can have its own set of templates by setting
+    FINAL_TWEET_TEMPLATE_DIR in its .env file (see `twit.override_env`);
+    otherwise we use the ones in this repo. Relative dirs are relative to
+    this repo, so this works no matter where we're run from. We only
+    re-read the files when one of their mtimes changes.
+    """
+    template_dir = (template_dir or os.environ.get(FINAL_TWEET_TEMPLATE_DIR_ENV_VAR)
+                    or REPO_DIR)
+    template_dir = os.path.join(REPO_DIR, template_dir)
+    paths = [os.path.join(template_dir, filename) for filename in (
+        FINAL_TWEET_FMT_STRING_PATH_NO_AUTHORS,
+        FINAL_TWEET_FMT_STRING_PATH_ONE_AUTHOR,
+        FINAL_TWEET_FMT_STRING_PATH_WITH_AUTHORS)]
+    mtimes = tuple(os.stat(path).st_mtime_ns for path in paths)
+
+    cached = _final_tweet_templates_cache.get(template_dir)
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+
+    fmt_strs = []
+    for path in paths:
+        with open(path, 'r') as f:
+            fmt_strs.append(f.read())
+    templates = FinalTweetTemplates(*fmt_strs, template_dir=template_dir)
+    _final_tweet_templates_cache[template_dir] = (mtimes, templates)
+    return templates
+
+
+def _generate_final_tweet_elem(paper_link: str, author_usernames: Optional[List[str]] = None):
+    text = final_tweet_templates().render(paper_link, author_usernames)
     return TextElem(text=text)
 
 
@@ -412,102 +988,407 @@ def skeleton_for_paper(paper_title: str,
     return text
 
 
+_BREAKPOINT_PATTERN = re.compile(' ')  # where we're allowed to split text
+
+
 def _shard_text(text: str) -> List[str]:
     text = text.strip()
     if len(text) <= MAX_TWEET_TEXT_LENGTH:
         return [text]
+    breakpoints = [m.start() for m in _BREAKPOINT_PATTERN.finditer(text)]
+    return _shard_span(text, 0, len(text), breakpoints, 0)
+
+
+def shard_many(texts: Iterable[str]) -> List[List[str]]:
+    """Equivalent to `[_shard_text(text) for text in texts]`, with the
+    setup done once for the whole batch.
+
+    Texts that fit in one tweet skip the breakpoint scan entirely, and
+    the rest share one breakpoint index built in a single pass over all
+    of them, instead of one per text.
+    """
+    texts = [text.strip() for text in texts]
+    long_texts = [text for text in texts if len(text) > MAX_TWEET_TEXT_LENGTH]
+    if not long_texts:
+        return [[text] for text in texts]
+    # no spaces in the separator, so no text can break at it
+    all_text = '\n'.join(long_texts)
+    breakpoints = [m.start() for m in _BREAKPOINT_PATTERN.finditer(all_text)]
 
-    # text needs to be split up
-    allowed_breakpoints = np.array([m.start() for m in re.finditer(' ', text)])
+    ret = []
+    begin = 0  # where the current long text starts in all_text
+    for text in texts:
+        if len(text) <= MAX_TWEET_TEXT_LENGTH:
+            ret.append([text])
+            continue
+        end = begin + len(text)
+        first_breakpoint = bisect.bisect_left(breakpoints, begin)
+        ret.append(_shard_span(all_text, begin, end, breakpoints, first_breakpoint))
+        begin = end + 1
+    return ret
+
+
+def _shard_span(text: str, begin: int, end: int, breakpoints: List[int],
+                first_breakpoint: int) -> List[str]:
+    """Shards text[begin:end], given the sorted positions of every
+    breakpoint in text and the index of the first one at or after begin"""
+    # we only ever move forward through the text and its breakpoints,
+    # so this is linear in the text length
+    text_len = end - begin
+    last_breakpoint = bisect.bisect_left(breakpoints, end, lo=first_breakpoint)
     output_chunks = []
-    # idx = allowed_breakpoints[0]
     needs_initial_ellipsis = False
 
     # try to split text evenly across tweets so we don't get ugly
     # straggling text
-    target_num_tweets = int(math.ceil(len(text) / MAX_TWEET_TEXT_SNIPPET_LENGTH))
+    target_num_tweets = int(math.ceil(text_len / MAX_TWEET_TEXT_SNIPPET_LENGTH))
     padding = 16
-    target_chunk_length = int(padding + len(text) / target_num_tweets)
+    target_chunk_length = int(padding + text_len / target_num_tweets)
     target_chunk_length = min(target_chunk_length, MAX_TWEET_TEXT_SNIPPET_LENGTH)
 
-    # print(f"sharding text:\n'{text}'")
-    # print('target_chunk_length', target_chunk_length)
-    # print("text length: ", len(text))
-
+    start = begin  # where the current chunk starts in text
+    first_unused_breakpoint = first_breakpoint
     while True:
-        # print('allowed_breakpoints:', allowed_breakpoints)
-        # print("mask:", allowed_breakpoints < target_chunk_length)
-        which_breakpoint = np.where(allowed_breakpoints < target_chunk_length)[0][-1]
-        split_at = allowed_breakpoints[which_breakpoint]
-        allowed_breakpoints = allowed_breakpoints[(which_breakpoint + 1):]
-
-        # print('which_breakpoint', which_breakpoint, 'split_at:', split_at)
-
-        chunk_text = text[:split_at].strip()
+        # last breakpoint within target_chunk_length of the chunk start
+        which_breakpoint = bisect.bisect_left(
+            breakpoints, start + target_chunk_length,
+            lo=first_unused_breakpoint, hi=last_breakpoint) - 1
+        if which_breakpoint < first_unused_breakpoint:
+            raise ValueError("Can't shard text with no spaces in " +
+                             f"{target_chunk_length} chars: '{text[start:end]}'")
+        split_at = breakpoints[which_breakpoint]
+        first_unused_breakpoint = which_breakpoint + 1
+
+        chunk_text = text[start:split_at].strip()
         if chunk_text[-1] not in ('?', '.', '!'):
             chunk_text = chunk_text + ELLIPSIS
         if needs_initial_ellipsis:
             chunk_text = ELLIPSIS + chunk_text
         output_chunks.append(chunk_text)
 
-        text = text[(split_at + 1):]
+        start = split_at + 1
         needs_initial_ellipsis = True
-        allowed_breakpoints -= (split_at + 1)
 
         # whole rest of text fits in one tweet
-        if len(text) < MAX_TWEET_TEXT_SNIPPET_LENGTH:
-            chunk_text = ELLIPSIS + text
+        if end - start < MAX_TWEET_TEXT_SNIPPET_LENGTH:
+            chunk_text = ELLIPSIS + text[start:end]
             output_chunks.append(chunk_text)
             break
 
-    # for chunk in output_chunks:
-    #     print("----", len(chunk))
-    #     print(chunk)
+    return output_chunks
 
-    # import sys; sys.exit()
 
-    return output_chunks
+LAYOUTS = ('greedy', 'optimal')
+
+
+def _layout_tweets_greedy(tweet_elems: List[Union[TextElem, ImgElem]],
+                          hero_img: str = '') -> List[twit.Tweet]:
+    """Every paragraph gets its own tweet(s), with the images after it
+    spread across them."""
+    all_tweets = []
+    all_texts = iter(shard_many(elem.text for elem in tweet_elems
+                                if isinstance(elem, TextElem)))
+    while len(tweet_elems):
+        elem = tweet_elems[0]
+        tweet_elems = tweet_elems[1:]
+
+        # we pop all following img elems after each text elem, so
+        # current elem has to be a text elem
+        assert isinstance(elem, TextElem)
+        texts = next(all_texts)
+        tweets = [twit.Tweet(text=text) for text in texts]
+
+        imgs = []
+        while len(tweet_elems) and isinstance(tweet_elems[0], ImgElem):
+            imgs.append(tweet_elems[0].url)
+            tweet_elems = tweet_elems[1:]
+
+        if not len(all_tweets):  # first tweet or set thereof
+            # # optional header image defaults to first image provided
+            # if len(imgs) and not hero_img:
+            #     hero_img = imgs[0]
+            #     imgs = imgs[1:]
+
+            if hero_img:
+                # give hero image to first tweet, and prevent
+                # other images from getting assigned to this tweet
+                # (desirable so that hero img is big)
+                tweets[0].imgs = [hero_img]
+                all_tweets.append(tweets[0])
+                tweets = tweets[1:]
+
+        # split imgs up across tweets
+        if len(imgs) and not len(tweets):
+            print("Uh oh; no text to attach images to...")
+            print("all_tweets so far:")
+            print(all_tweets)
+        if len(imgs):
+            imgs_per_tweet = int(math.ceil(len(imgs) / len(tweets)))
+            for i, tweet in enumerate(tweets):
+                img_start_idx = i * imgs_per_tweet
+                img_end_idx = img_start_idx + imgs_per_tweet
+                tweet.imgs = imgs[img_start_idx:img_end_idx]
+
+        all_tweets += tweets
+
+    return all_tweets
+
+
+@dataclass
+class _LayoutAtom:
+    text: str  # empty for overflow images that didn't fit on their text
+    imgs: List[str] = field(default_factory=list)
+    # whether this can share a tweet with the atom before it; false for
+    # the 2nd+ shards of a paragraph
+    can_join_prev: bool = True
+
+
+def _layout_atoms(tweet_elems: List[Union[TextElem, ImgElem]],
+                  hero_img: str = '', spill_imgs: bool = True) -> List[_LayoutAtom]:
+    paragraphs = []  # (text, [img urls])
+    for elem in tweet_elems:
+        if isinstance(elem, TextElem):
+            paragraphs.append((elem.text, []))
+        else:
+            paragraphs[-1][1].append(elem.url)
+
+    atoms = []
+    all_shards = shard_many(text for text, _ in paragraphs)
+    for p, ((_, imgs), shards) in enumerate(zip(paragraphs, all_shards)):
+        shard_atoms = [_LayoutAtom(text=shard, can_join_prev=(i == 0))
+                       for i, shard in enumerate(shards)]
+        # same image spreading as the greedy layout, except that (with
+        # spill_imgs) images past MAX_IMGS_PER_TWEET spill over into
+        # image-only atoms
+        img_atoms = shard_atoms
+        if p == 0 and hero_img:
+            img_atoms = shard_atoms[1:]  # keep the hero img big
+        overflow = []
+        if img_atoms and imgs:
+            imgs_per_atom = int(math.ceil(len(imgs) / len(img_atoms)))
+            max_imgs = MAX_IMGS_PER_TWEET if spill_imgs else imgs_per_atom
+            for i, atom in enumerate(img_atoms):
+                atom_imgs = imgs[(i * imgs_per_atom):((i + 1) * imgs_per_atom)]
+                atom.imgs = atom_imgs[:max_imgs]
+                overflow += atom_imgs[max_imgs:]
+        elif spill_imgs:
+            overflow = imgs
+        elif imgs:
+            print("Uh oh; no text to attach images to...")
+        atoms += shard_atoms
+        for i in range(0, len(overflow), MAX_IMGS_PER_TWEET):
+            atoms.append(_LayoutAtom(text='', imgs=overflow[i:(i + MAX_IMGS_PER_TWEET)]))
+    return atoms
+
+
+_LAYOUT_SEP = '\n\n'  # between paragraphs sharing a tweet
+
+
+def _best_tweet_starts(atoms: List[_LayoutAtom], hero_img: str = '') -> Optional[List[int]]:
+    """For each prefix atoms[:i], where its last tweet starts in the best
+    layout, or None if no layout puts text in every tweet with images"""
+    sep = _LAYOUT_SEP
+    inf = (math.inf, math.inf)
+
+    # best_cost[i] = (num tweets, sum of squared lengths) for atoms[:i]
+    best_cost = [(0, 0)] + [inf] * len(atoms)
+    best_start = [0] * (len(atoms) + 1)  # where the last tweet starts
+    for end in range(1, len(atoms) + 1):
+        # grow the last tweet backwards from atoms[end - 1]
+        text_len = 0
+        num_texts = 0
+        num_imgs = 0
+        for start in range(end - 1, -1, -1):
+            atom = atoms[start]
+            if start < end - 1 and not atoms[start + 1].can_join_prev:
+                break
+            if atom.text:
+                text_len += len(atom.text)
+                num_texts += 1
+            num_imgs += len(atom.imgs)
+            length = text_len + len(sep) * max(0, num_texts - 1)
+            if length > MAX_TWEET_TEXT_LENGTH:
+                break
+            # one atom with too many imgs only happens without
+            # spill_imgs; it can't share a tweet though
+            if num_imgs > MAX_IMGS_PER_TWEET and start < end - 1:
+                break
+            if start == 0 and hero_img and num_imgs:
+                continue  # first tweet only gets the hero img
+            if num_imgs and not num_texts:
+                continue  # no tweets that are just images
+            prev_ntweets, prev_sse = best_cost[start]
+            cost = (prev_ntweets + 1, prev_sse + length * length)
+            if cost < best_cost[end]:
+                best_cost[end] = cost
+                best_start[end] = start
+
+    if best_cost[-1] == inf:
+        return None
+    return best_start
+
+
+def _layout_tweets_optimal(tweet_elems: List[Union[TextElem, ImgElem]],
+                           hero_img: str = '') -> List[twit.Tweet]:
+    """Packs paragraphs and images into as few tweets as possible.
+
+    Paragraphs are sharded the same way as in the greedy layout, but
+    consecutive short paragraphs (and their images) can share a tweet.
+    Among layouts with the fewest tweets, we pick the one with the
+    smallest sum of squared tweet lengths, which favors even lengths.
+    This is a dynamic program over where each tweet ends.
+    """
+    atoms = _layout_atoms(tweet_elems, hero_img=hero_img)
+    best_start = _best_tweet_starts(atoms, hero_img)
+    if best_start is None:
+        # some spilled images had no text they could share a tweet with,
+        # so spread each paragraph's images like the greedy layout does
+        atoms = _layout_atoms(tweet_elems, hero_img=hero_img, spill_imgs=False)
+        best_start = _best_tweet_starts(atoms, hero_img)
+
+    # walk back through the tweet boundaries we picked
+    all_tweets = []
+    end = len(atoms)
+    while end > 0:
+        start = best_start[end]
+        tweet_atoms = atoms[start:end]
+        text = _LAYOUT_SEP.join(atom.text for atom in tweet_atoms if atom.text)
+        imgs = [img for atom in tweet_atoms for img in atom.imgs]
+        all_tweets.append(twit.Tweet(text=text, imgs=imgs))
+        end = start
+    all_tweets = all_tweets[::-1]
+    if hero_img:
+        all_tweets[0].imgs = [hero_img]
+    return all_tweets
+
+
+def _pop_tag_users(markdown: str) -> Tuple[str, List[str]]:
+    """Strips out TAG_USERS lines and returns the usernames in them"""
+    tag_users = []
+    keep_lines = []
+    for line in markdown.splitlines():
+        if line.strip().startswith(TAG_USERS_MARKER):
+            names = line[len(TAG_USERS_MARKER):].strip().split()
+            tag_users += names
+            continue
+        keep_lines.append(line)
+    if not tag_users:
+        return markdown, []  # same string, so its parse can get reused
+    return '\n'.join(keep_lines), tag_users
+
+
+def _paper_link_or_first_arxiv_link(markdown: str, paper_link: str) -> str:
+    if not paper_link:
+        # first_paper = markdown.find('https://arxiv.org/abs/')
+        first_paper = re.search('https://arxiv.org/abs/[\d]*.[\d]*', markdown)
+        # print('first paper found: ', first_paper)
+        if first_paper:
+            paper_link = first_paper.group()
+        # print('matching string: ', paper_link)
+    return paper_link
+
+
+def _author_lookup_link(contents: str, is_html: bool = False) -> str:
+    """The paper link _markdown_to_tweet_list (or _html_to_tweet_list)
+    would look up authors for by default, or '' if it wouldn't need to
+    look any up."""
+    if is_html:
+        _, _, paper_link, tag_users = _html_to_text_img_elems(contents)
+    else:
+        contents, tag_users = _pop_tag_users(contents)
+        _, _, paper_link = _markdown_to_text_img_elems(contents)
+    if tag_users:
+        return ''
+    return _paper_link_or_first_arxiv_link(contents, paper_link)
 
 
 def _markdown_to_tweet_list(markdown: str,
                             infer_tag_users_from_text: bool = True,
                             infer_tag_users_from_link: bool = True,
-                            omit_mention_authors: bool = False,
-                            tag_users_in_image_max_tweets: int = 2,
-                            authors: Optional[Sequence[str]] = None) -> Tuple[List[twit.Tweet], str]:
-    """Raw conversion of markdown to tweet objects. No thread features."""
+                            authors: Optional[Sequence[str]] = None,
+                            **kwargs) -> List[twit.Tweet]:
+    """Raw conversion of markdown to tweet objects. No thread features.
 
+    See `_elems_to_tweet_list` for other kwargs.
+    """
     if authors:
-        tag_users = authors
+        tag_users = list(authors)
         infer_tag_users_from_link = False
         infer_tag_users_from_text = False
     else:
         tag_users = []
 
     if infer_tag_users_from_text:
-        keep_lines = []
-        for line in markdown.splitlines():
-            if line.strip().startswith(TAG_USERS_MARKER):
-                names = line[len(TAG_USERS_MARKER):].strip().split()
-                tag_users += names
-                continue
-            keep_lines.append(line)
-        markdown = '\n'.join(keep_lines)
+        markdown, names = _pop_tag_users(markdown)
+        tag_users += names
 
     tweet_elems, paper_title, paper_link = _markdown_to_text_img_elems(markdown)
+    return _elems_to_tweet_list(tweet_elems,
+                                paper_title=paper_title,
+                                paper_link=paper_link,
+                                tag_users=tag_users,
+                                infer_tag_users_from_link=infer_tag_users_from_link,
+                                link_search_text=markdown,
+                                **kwargs)
+
+
+def _html_to_tweet_list(html: str,
+                        infer_tag_users_from_text: bool = True,
+                        infer_tag_users_from_link: bool = True,
+                        authors: Optional[Sequence[str]] = None,
+                        **kwargs) -> List[twit.Tweet]:
+    """Like _markdown_to_tweet_list, but straight from (substack) html"""
+    if authors:
+        tag_users = list(authors)
+        infer_tag_users_from_link = False
+        infer_tag_users_from_text = False
+    else:
+        tag_users = []
+
+    tweet_elems, paper_title, paper_link, names = _html_to_text_img_elems(
+        html, pop_tag_users=infer_tag_users_from_text)
+    tag_users += names
+    return _elems_to_tweet_list(tweet_elems,
+                                paper_title=paper_title,
+                                paper_link=paper_link,
+                                tag_users=tag_users,
+                                infer_tag_users_from_link=infer_tag_users_from_link,
+                                link_search_text=html,
+                                **kwargs)
+
+
+def _elems_to_tweet_list(tweet_elems: List[Union[TextElem, ImgElem]],
+                         paper_title: str,
+                         paper_link: str,
+                         tag_users: List[str],
+                         infer_tag_users_from_link: bool = True,
+                         link_search_text: str = '',
+                         omit_mention_authors: bool = False,
+                         tag_users_in_image_max_tweets: int = 2,
+                         layout: str = 'greedy',
+                         known_paper_authors: Optional[Dict[str, List[str]]] = None) -> List[twit.Tweet]:
+    """Turns text + image elems into numbered tweets with a closing tweet.
+
+    If there's no paper link, we look for an arxiv link in
+    `link_search_text` to infer authors from.
+
+    `layout` is 'greedy' to give each paragraph its own tweet(s), or
+    'optimal' to pack paragraphs + images into as few tweets as possible.
+
+    `known_paper_authors` maps paper links to author usernames that have
+    already been looked up, so we don't hit arxiv + twitter again.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}'; options are {LAYOUTS}")
 
     # only try to infer tagged users if not explicitly specified
     if not tag_users and infer_tag_users_from_link:
-        if not paper_link:
-            # first_paper = markdown.find('https://arxiv.org/abs/')
-            first_paper = re.search('https://arxiv.org/abs/[\d]*.[\d]*', markdown)
-            # print('first paper found: ', first_paper)
-            if first_paper:
-                paper_link = first_paper.group()
-            # print('matching string: ', paper_link)
+        paper_link = _paper_link_or_first_arxiv_link(link_search_text, paper_link)
 
         # print("paper link: ", paper_link)
-        if paper_link:
+        if paper_link and paper_link in (known_paper_authors or {}):
+            tag_users = list(known_paper_authors[paper_link])
+        elif paper_link:
             tag_users = authors_usernames_for_paper(paper_link)
         # import sys; sys.exit()
 
@@ -516,9 +1397,16 @@ def _markdown_to_tweet_list(markdown: str,
     # import sys; sys.exit()
 
     mention_authors = [] if omit_mention_authors else tag_users
-    final_elem = _generate_final_tweet_elem(
-        paper_link, author_usernames=mention_authors)
-    tweet_elems.append(final_elem)
+    templates = final_tweet_templates()
+    tail_text = templates.render(paper_link, mention_authors).strip()
+    # the closing text gets the last tweet(s) to itself, and we know up
+    # front how many, so the layouts only have to fit everything else
+    num_tail_tweets = templates.num_tweets(paper_link, mention_authors)
+    tail_texts = [tail_text] if num_tail_tweets == 1 else _shard_text(tail_text)
+    if not any(isinstance(elem, TextElem) for elem in tweet_elems):
+        # nothing else to put the title + hero img on
+        tweet_elems.append(TextElem(text=tail_text))
+        tail_texts = []
 
     # print("================================ Tweet elems:")
     # for elem in tweet_elems:
@@ -540,50 +1428,11 @@ def _markdown_to_tweet_list(markdown: str,
     assert isinstance(tweet_elems[0], TextElem), "Only one image can come before all the text"
     tweet_elems[0].text = f'"{paper_title}"\n\n{tweet_elems[0].text.strip()}'
 
-    all_tweets = []
-    while len(tweet_elems):
-        elem = tweet_elems[0]
-        tweet_elems = tweet_elems[1:]
-
-        # we pop all following img elems after each text elem, so
-        # current elem has to be a text elem
-        assert isinstance(elem, TextElem)
-        texts = _shard_text(elem.text)
-        tweets = [twit.Tweet(text=text) for text in texts]
-
-        imgs = []
-        while len(tweet_elems) and isinstance(tweet_elems[0], ImgElem):
-            imgs.append(tweet_elems[0].url)
-            tweet_elems = tweet_elems[1:]
-
-        if not len(all_tweets):  # first tweet or set thereof
-            # # optional header image defaults to first image provided
-            # if len(imgs) and not hero_img:
-            #     hero_img = imgs[0]
-            #     imgs = imgs[1:]
-
-            if hero_img:
-                # give hero image to first tweet, and prevent
-                # other images from getting assigned to this tweet
-                # (desirable so that hero img is big)
-                tweets[0].imgs = [hero_img]
-                all_tweets.append(tweets[0])
-                tweets = tweets[1:]
-
-        # split imgs up across tweets
-        if len(imgs) and not len(tweets):
-            print("Uh oh; no text to attach images to...")
-            print("all_tweets so far:")
-            print(all_tweets)
-        if len(imgs):
-            imgs_per_tweet = int(math.ceil(len(imgs) / len(tweets)))
-            for i, tweet in enumerate(tweets):
-                img_start_idx = i * imgs_per_tweet
-                img_end_idx = img_start_idx + imgs_per_tweet
-                tweet.imgs = imgs[img_start_idx:img_end_idx]
-
-        all_tweets += tweets
-
+    if layout == 'greedy':
+        all_tweets = _layout_tweets_greedy(tweet_elems, hero_img=hero_img)
+    else:
+        all_tweets = _layout_tweets_optimal(tweet_elems, hero_img=hero_img)
+    all_tweets += [twit.Tweet(text=text) for text in tail_texts]
 
     def _number_tweets(tweets: Sequence[twit.Tweet], fmt='[{}/{}]') -> None:
         ntweets = len(tweets)
@@ -632,6 +1481,11 @@ def markdown_to_thread(markdown: str, **kwargs) -> List[twit.Tweet]:
     #     twit.create_thread(tweets)
 
 
+def html_to_thread(html: str, **kwargs) -> List[twit.Tweet]:
+    """Same as `markdown_to_thread(html_to_markdown(html))`, but faster"""
+    return _html_to_tweet_list(html, **kwargs)
+
+
 def thread_to_markdown_preview(tweets: Sequence[twit.Tweet]) -> str:
     out = ''
     for i, tweet in enumerate(tweets):
@@ -653,10 +1507,486 @@ def thread_to_markdown_preview(tweets: Sequence[twit.Tweet]) -> str:
     return out
 
 
+# ================================================ batch thread previews
+
+@dataclass
+class PreviewResult:
+    in_path: str
+    out_path: str
+    num_tweets: int = 0
+    secs: float = 0.
+    error: str = ''
+    # how many of its paper's authors the author index already knew
+    index_hits: int = 0
+    index_misses: int = 0
+
+
+def _is_html_path(path: str) -> bool:
+    return path.endswith(HTML_EXTENSIONS)
+
+
+def expand_markdown_paths(dir_or_glob: str) -> List[str]:
+    """All markdown (or substack html) files in a directory, or all files
+    matching a glob.
+
+    Skips files that look like our own previews so that re-running a
+    batch doesn't preview the previews.
+    """
+    if os.path.isdir(dir_or_glob):
+        paths = sorted(path for ext in ('.md', ) + HTML_EXTENSIONS
+                       for path in glob.glob(os.path.join(dir_or_glob, '*' + ext)))
+    else:
+        paths = sorted(glob.glob(dir_or_glob))
+    return [path for path in paths
+            if not os.path.basename(path).startswith(PREVIEW_PREFIX)]
+
+
+def _preview_path(in_path: str, out_dir: str = '') -> str:
+    out_dir = out_dir or os.path.dirname(in_path)
+    name = os.path.splitext(os.path.basename(in_path))[0] + '.md'  # even for html
+    return os.path.join(out_dir, PREVIEW_PREFIX + name)
+
+
+def _write_preview(in_path: str, out_path: str, kwargs: Dict[str, Any]) -> PreviewResult:
+    t0 = time.perf_counter()
+    result = PreviewResult(in_path=in_path, out_path=out_path)
+    try:
+        with open(in_path, 'r') as f:
+            contents = f.read()
+        if _is_html_path(in_path):
+            tweets = html_to_thread(contents, **kwargs)
+        else:
+            tweets = markdown_to_thread(contents, **kwargs)
+        with open(out_path, 'w') as f:
+            f.write(thread_to_markdown_preview(tweets))
+        result.num_tweets = len(tweets)
+    except Exception as e:  # one bad draft shouldn't sink the whole batch
+        result.error = f'{type(e).__name__}: {e}'
+    result.secs = time.perf_counter() - t0
+    return result
+
+
+def _paper_authors_or_errors(links: Sequence[str]) -> Tuple[Dict[str, List[str]], Dict[str, str],
+                                                            Dict[str, Dict[str, int]]]:
+    """Looks up each paper's authors' usernames, returning link -> usernames
+    for the ones that worked, link -> error for the ones that didn't, and
+    link -> author index hits + misses"""
+    link2authors, link2error, link2index_stats = {}, {}, {}
+    try:  # one arxiv request for all of them if we can
+        papers = dict(zip(links, arxiv.fetch_or_scrape_papers(links)))
+    except Exception:  # e.g., a bad id; find out which one(s)
+        papers = {}
+        for link in links:
+            try:
+                papers[link] = arxiv.scrape_arxiv_abs_page(link)
+            except Exception as e:
+                link2error[link] = f'{type(e).__name__}: {e}'
+    for link, (_, authors, _) in papers.items():
+        link2index_stats[link] = {}
+        try:
+            link2authors[link] = [user.screen_name for user in find_authors(
+                authors, verbose=False, index_stats=link2index_stats[link])]
+        except Exception as e:
+            link2error[link] = f'{type(e).__name__}: {e}'
+    return link2authors, link2error, link2index_stats
+
+
+def preview_markdown_files(in_paths: Sequence[str],
+                           out_dir: str = '',
+                           num_workers: Optional[int] = None,
+                           verbose: bool = True,
+                           **kwargs) -> List[PreviewResult]:
+    """Writes a thread preview for each markdown (or html) file, in parallel.
+
+    Author lookups are the slow, network-bound part, so we do each
+    distinct paper's lookup once up front and hand the results to the
+    worker processes, rather than have every worker hit arxiv + twitter.
+    If a paper's lookup fails, just the files about that paper fail.
+    kwargs are passed through to `markdown_to_thread` / `html_to_thread`.
+    """
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    path2error = {}
+    path2link, link2index_stats = {}, {}
+    known_paper_authors = {}
+    if not kwargs.get('authors') and kwargs.get('infer_tag_users_from_link', True):
+        for path in in_paths:
+            try:
+                with open(path, 'r') as f:
+                    path2link[path] = _author_lookup_link(f.read(), is_html=_is_html_path(path))
+            except Exception as e:
+                path2error[path] = f'{type(e).__name__}: {e}'
+        links = sorted(set(link for link in path2link.values() if link))
+        t0 = time.perf_counter()
+        known_paper_authors, link2error, link2index_stats = _paper_authors_or_errors(links)
+        if verbose:
+            hits = sum(stats.get('hits', 0) for stats in link2index_stats.values())
+            total = hits + sum(stats.get('misses', 0) for stats in link2index_stats.values())
+            print(f"looked up authors for {len(links)} papers in " +
+                  f"{time.perf_counter() - t0:.2f}s" +
+                  (f" ({len(link2error)} failed)" if link2error else '') +
+                  f"; author index knew {hits} of {total} authors")
+        for path, link in path2link.items():
+            if link in link2error:
+                path2error[path] = f"author lookup for {link} failed: {link2error[link]}"
+    kwargs['known_paper_authors'] = known_paper_authors
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {path: pool.submit(_write_preview, path, _preview_path(path, out_dir), kwargs)
+                   for path in in_paths if path not in path2error}
+        results = [PreviewResult(in_path=path, out_path=_preview_path(path, out_dir),
+                                 error=path2error[path])
+                   if path in path2error else futures[path].result()
+                   for path in in_paths]
+    for result in results:
+        stats = link2index_stats.get(path2link.get(result.in_path), {})
+        result.index_hits = stats.get('hits', 0)
+        result.index_misses = stats.get('misses', 0)
+    return results
+
+
+def _index_hits_str(hits: int, misses: int) -> str:
+    if not hits + misses:
+        return '-'  # no lookup, e.g. tags were given
+    return f'{hits}/{hits + misses} ({hits / (hits + misses):.0%})'
+
+
+def preview_summary_table(results: Sequence[PreviewResult]) -> str:
+    """One line per file, with its paper's author index hit rate"""
+    width = max([len('file')] + [len(r.in_path) for r in results])
+    index_strs = [_index_hits_str(r.index_hits, r.index_misses) for r in results]
+    index_width = max([len('index hits')] + [len(s) for s in index_strs])
+    lines = [f"{'file':<{width}}  tweets   secs  {'index hits':>{index_width}}  error"]
+    for r, index_str in zip(results, index_strs):
+        lines.append(f'{r.in_path:<{width}}  {r.num_tweets:>6}  {r.secs:>5.2f}  '
+                     f'{index_str:>{index_width}}  {r.error}')
+    total_tweets = sum(r.num_tweets for r in results)
+    total_secs = sum(r.secs for r in results)
+    num_failed = sum(bool(r.error) for r in results)
+    lines.append(f"{'total':<{width}}  {total_tweets:>6}  {total_secs:>5.2f}  "
+                 f"{'':>{index_width}}  " +
+                 (f'{num_failed} failed' if num_failed else ''))
+    return '\n'.join(lines)
+
+
+def save_preview_summary(results: Sequence[PreviewResult], saveas: str) -> None:
+    with open(saveas, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['in_path', 'out_path', 'num_tweets', 'secs',
+                         'index_hits', 'index_misses', 'error'])
+        for r in results:
+            writer.writerow([r.in_path, r.out_path, r.num_tweets, f'{r.secs:.4f}',
+                             r.index_hits, r.index_misses, r.error])
+
+
 # ================================================================ debug
 
+def _time_fn(f, *args, niters: int = 100, **kwargs) -> float:
+    """Returns mean seconds per call"""
+    f(*args, **kwargs)  # warmup
+    t0 = time.perf_counter()
+    for _ in range(niters):
+        f(*args, **kwargs)
+    return (time.perf_counter() - t0) / niters
+
+
+def _test_paragraphs() -> List[str]:
+    texts = []
+    for path in (TEST_MARKDOWN_EASY, TEST_MARKDOWN_HARD):
+        with open(path, 'r') as f:
+            elems, _, _ = _markdown_to_text_img_elems(f.read())
+        texts += [elem.text for elem in elems if isinstance(elem, TextElem)]
+    return texts
+
+
+def test_shard_many():
+    texts = _test_paragraphs()
+    texts += ['', '  padded  ', ' '.join(texts), ' '.join(texts[:3]) + '?',
+              'word ' * 100]
+    assert shard_many(texts) == [_shard_text(text) for text in texts]
+    assert shard_many([]) == []
+    for bad in (['fine', 'x' * 300], ['x' * 300 + ' y', 'fine']):
+        try:
+            shard_many(bad)
+            assert False, f"should have failed on {bad}"
+        except ValueError:
+            pass
+
+
+def bench_shard_many(niters: int = 20):
+    texts = _test_paragraphs()
+    long_texts = [' '.join(texts[i:(i + 5)]) for i in range(len(texts))]
+    for name, batch in [('paragraphs', texts * 100), ('long', long_texts * 100)]:
+        t_each = _time_fn(lambda: [_shard_text(text) for text in batch], niters=niters)
+        t_many = _time_fn(shard_many, batch, niters=niters)
+        print(f'{len(batch)} {name}:\teach: {t_each * 1e3:.2f}ms' +
+              f'\tshard_many: {t_many * 1e3:.2f}ms\tspeedup: {t_each / t_many:.1f}x')
+
+
+def test_optimal_layout():
+    def _check(elems):
+        greedy = _layout_tweets_greedy(list(elems))
+        optimal = _layout_tweets_optimal(list(elems))
+        assert len(optimal) <= len(greedy)
+        for tweet in optimal:
+            assert tweet.text, f"tweet with no text: {tweet}"
+        imgs = [elem.url for elem in elems if isinstance(elem, ImgElem)]
+        assert [img for tweet in optimal for img in tweet.imgs] == imgs
+        return optimal
+
+    short = [TextElem(text=f'Short paragraph {i}.') for i in range(3)]
+    imgs = [ImgElem(url=f'img{i}.png') for i in range(9)]
+    # one-shard paragraph followed by more than 4 images, with another
+    # paragraph after it for the spilled images to go with
+    tweets = _check([short[0]] + imgs[:6] + [short[1]])
+    assert [len(tweet.imgs) for tweet in tweets] == [4, 2]
+    # ...and with nothing after it, so it has to fall back to the greedy
+    # spreading for that paragraph
+    tweets = _check([short[0], short[1]] + imgs[:6])
+    assert [tweet.imgs for tweet in tweets] == [[], [elem.url for elem in imgs[:6]]]
+    # too many spilled images for any one neighbor to take
+    _check([short[0]] + imgs + [short[1], short[2]])
+
+    for path in (TEST_MARKDOWN_EASY, TEST_MARKDOWN_HARD):
+        with open(path, 'r') as f:
+            elems, _, _ = _markdown_to_text_img_elems(f.read())
+        _check(elems)
+
+
+def test_markdown_to_text_img_elems():
+    for path in (TEST_MARKDOWN_EASY, TEST_MARKDOWN_HARD):
+        with open(path, 'r') as f:
+            markdown = f.read()
+        html_out = _markdown_to_text_img_elems_via_html(markdown)
+        ast_out = _markdown_to_text_img_elems_via_ast(markdown)
+        assert html_out == ast_out, f"Different elems for {path}!"
+        # cached copies are the callers' to edit
+        elems, _, _ = _markdown_to_text_img_elems(markdown)
+        elems[0].text = 'edited'
+        assert _markdown_to_text_img_elems(markdown) == ast_out
+
+    # raw html only makes sense to the html path
+    markdown = 'some <b>bold</b> text\n\n<div>a block</div>\n'
+    assert _markdown_to_text_img_elems(markdown) == _markdown_to_text_img_elems_via_html(markdown)
+
+
+def bench_markdown_to_text_img_elems(niters: int = 100):
+    for path in (TEST_MARKDOWN_EASY, TEST_MARKDOWN_HARD):
+        with open(path, 'r') as f:
+            markdown = f.read()
+        # also check that the fast path didn't change anything
+        html_out = _markdown_to_text_img_elems_via_html(markdown)
+        ast_out = _markdown_to_text_img_elems_via_ast(markdown)
+        assert html_out == ast_out, f"Different elems for {path}!"
+        markdown_x10 = '\n\n'.join([markdown] * 10)  # a long weekly summary
+
+        print(f'---- {path}')
+        for name, md_in in [('1x', markdown), ('10x', markdown_x10)]:
+            t_html = _time_fn(_markdown_to_text_img_elems_via_html, md_in, niters=niters)
+            t_ast = _time_fn(_markdown_to_text_img_elems_via_ast, md_in, niters=niters)
+            print(f'{name}:\thtml: {t_html * 1e3:.2f}ms\tast: {t_ast * 1e3:.2f}ms' +
+                  f'\tspeedup: {t_html / t_ast:.1f}x')
+
+
+def bench_final_tweet_templates(niters: int = 100):
+    with open(TEST_MARKDOWN_HARD, 'r') as f:
+        markdown = f.read()
+    kwargs = dict(authors=['davisblalock', 'jefrankle'])
+    link = 'https://arxiv.org/abs/2204.10019'
+
+    def _thread_uncached():
+        _final_tweet_templates_cache.clear()  # what we used to do
+        return markdown_to_thread(markdown, **kwargs)
+
+    def _tail_uncached():
+        _final_tweet_templates_cache.clear()
+        return final_tweet_templates().num_tweets(link, kwargs['authors'])
+
+    def _tail_cached():
+        return final_tweet_templates().num_tweets(link, kwargs['authors'])
+
+    t_tail_uncached = _time_fn(_tail_uncached, niters=niters)
+    t_tail_cached = _time_fn(_tail_cached, niters=niters)
+    t_thread_uncached = _time_fn(_thread_uncached, niters=niters)
+    t_thread_cached = _time_fn(markdown_to_thread, markdown, niters=niters, **kwargs)
+    print(f'closing tweet:\tuncached: {t_tail_uncached * 1e6:.1f}us' +
+          f'\tcached: {t_tail_cached * 1e6:.1f}us')
+    print(f'whole thread:\tuncached: {t_thread_uncached * 1e3:.3f}ms' +
+          f'\tcached: {t_thread_cached * 1e3:.3f}ms')
+
+
+def bench_html_to_thread(niters: int = 20):
+    kwargs = dict(authors=['davisblalock', 'jefrankle'])
+    for path in (TEST_HTML_EASY, TEST_HTML_HARD):
+        with open(path, 'r') as f:
+            html = f.read()
+        via_markdown = markdown_to_thread(html_to_markdown(html), **kwargs)
+        direct = html_to_thread(html, **kwargs)
+        assert via_markdown == direct, f"Different threads for {path}!"
+
+        t_via_markdown = _time_fn(lambda: markdown_to_thread(html_to_markdown(html), **kwargs), niters=niters)
+        t_direct = _time_fn(html_to_thread, html, niters=niters, **kwargs)
+        print(f'{path}:\tvia markdown: {t_via_markdown * 1e3:.2f}ms' +
+              f'\tdirect: {t_direct * 1e3:.2f}ms' +
+              f'\tspeedup: {t_via_markdown / t_direct:.1f}x')
+
+
+def test_author_index():
+    """find_authors only searches for authors the index doesn't know, and
+    posting a thread adds its authors to the index"""
+    import tempfile
+    import types
+
+    paper_link = 'https://arxiv.org/abs/2003.03033'
+    paper_authors = ['Davis Blalock', 'José Javier González Ortiz', 'Jonathan Frankle']
+    users = {
+        'davisblalock': dict(name='Davis Blalock', description='Research scientist. PhD @MIT'),
+        'jjgort': dict(name='José Javier González Ortiz 🧠', description='PhD student @MIT'),
+        'jefrankle': dict(name='Jonathan Frankle', description='Chief Scientist. PhD @MIT'),
+    }
+
+    def _user(screen_name: str) -> tweepy.User:
+        return twit._user_from_dict(dict(users[screen_name], screen_name=screen_name,
+                                         id=hash(screen_name) % 10**9, followers_count=100))
+
+    searched = []
+
+    def _search_many_users(api, queries, **kwargs):
+        searched.extend(queries)
+        by_name = {info['name'].split(' 🧠')[0]: name for name, info in users.items()}
+        return ({q: [_user(by_name[q])] if q in by_name else [] for q in queries},
+                {q: 0. for q in queries})
+
+    fakes = dict(get_api=lambda: None, get_user=lambda api, screen_name: _user(screen_name),
+                 search_many_users=_search_many_users)
+    real = {name: getattr(twit, name) for name in fakes}
+    real_scrape = arxiv.scrape_arxiv_abs_page
+    real_index = identity.index
+    try:
+        for name, f in fakes.items():
+            setattr(twit, name, f)
+        arxiv.scrape_arxiv_abs_page = lambda url: ('Title', paper_authors, 'Abstract')
+        with tempfile.TemporaryDirectory() as d:
+            index = identity.IdentityIndex(os.path.join(d, 'index.sqlite'))
+            markdown = f'[Title]({paper_link})\n\nSome text.\n\n{TAG_USERS_MARKER} @jjgort'
+
+            identity.index = index  # what building the threads looks at
+
+            def _post(markdown: str, omit_mention_authors: bool = False) -> Dict[str, str]:
+                tweets = markdown_to_thread(markdown, omit_mention_authors=omit_mention_authors)
+                return record_thread_authors(markdown, tweets, index=index,
+                                             omit_mention_authors=omit_mention_authors)
+
+            # posting with TAG_USERS records who the tagged users are
+            assert _post(markdown) == {'José Javier González Ortiz': 'jjgort'}
+            assert not searched
+            users_found = find_authors(paper_authors, verbose=False, index=index)
+            assert [u.screen_name for u in users_found] == ['davisblalock', 'jjgort', 'jefrankle']
+            assert searched == ['Davis Blalock', 'Jonathan Frankle']
+
+            # posting without mentioning authors confirms nobody, even
+            # though we looked them up (or they're in the body text)
+            searched.clear()
+            untagged = markdown.split(TAG_USERS_MARKER)[0] + 'Thanks @jefrankle!\n'
+            assert _post(untagged, omit_mention_authors=True) == {}
+            assert index.lookup('Jonathan Frankle') is None
+            assert record_thread_authors(untagged, [twit.Tweet(text='Thanks @jefrankle!')],
+                                         index=index) == {}
+
+            # and with, records the ones we looked up + tagged
+            assert _post(untagged) == {
+                'Davis Blalock': 'davisblalock', 'José Javier González Ortiz': 'jjgort',
+                'Jonathan Frankle': 'jefrankle'}
+            searched.clear()
+            users_found = find_authors(['D. Blalock', 'Jose Javier Gonzalez Ortiz'],
+                                       verbose=False, index=index)
+            assert [u.screen_name for u in users_found] == ['davisblalock', 'jjgort']
+            assert not searched
+
+            # mentioning someone who isn't an author doesn't record them
+            tweets = markdown_to_thread(markdown, authors=['jefrankle', 'davisblalock'])
+            assert record_thread_authors(markdown, tweets, authors=['jefrankle', 'davisblalock'],
+                                         index=index).keys() == {'Jonathan Frankle',
+                                                                 'Davis Blalock'}
+            users = dict(users, mosaicml=dict(name='MosaicML', description=''))
+            tweets = markdown_to_thread(markdown, authors=['mosaicml'])
+            assert record_thread_authors(markdown, tweets, authors=['mosaicml'], index=index) == {}
+            assert index.lookup('Jonathan Frankle').times_confirmed == 2
+            index._conn().close()
+    finally:
+        for name, f in real.items():
+            setattr(twit, name, f)
+        arxiv.scrape_arxiv_abs_page = real_scrape
+        identity.index = real_index
+
+
+def test_batch_preview():
+    """Html drafts get previewed too, and a paper whose author lookup fails
+    only fails the drafts about it"""
+    import tempfile
+    import types
+    global find_authors
+
+    good_link, bad_link = 'https://arxiv.org/abs/2003.03033', 'https://arxiv.org/abs/9999.99999'
+    drafts = {
+        'good.md': f'[Good paper]({good_link})\n\nSome text about it.\n',
+        'bad.md': f'[Bad paper]({bad_link})\n\nSome text about it.\n',
+        'post.html': (f'<html><body><p><a href="{good_link}">Good paper</a></p>'
+                      '<p>Some text about it.</p></body></html>'),
+        'tagged.md': f'[Bad paper]({bad_link})\n\nText.\n\n{TAG_USERS_MARKER} @someone\n',
+    }
+
+    def _scrape(url: str):
+        if url == bad_link:
+            raise ValueError(f"no such paper: {url}")
+        return 'Good paper', ['Davis Blalock', 'Someone Else'], 'Abstract'
+
+    def _fetch(urls: Sequence[str]):
+        return [_scrape(url) for url in urls]  # like the api, all or nothing
+
+    real = (arxiv.fetch_or_scrape_papers, arxiv.scrape_arxiv_abs_page, find_authors)
+    try:
+        arxiv.fetch_or_scrape_papers, arxiv.scrape_arxiv_abs_page = _fetch, _scrape
+
+        def find_authors(authors, index_stats=None, **kwargs):
+            index_stats.update(hits=1, misses=len(authors) - 1)
+            return [types.SimpleNamespace(screen_name='davisblalock')]
+
+        with tempfile.TemporaryDirectory() as d:
+            for name, contents in drafts.items():
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(contents)
+            paths = expand_markdown_paths(d)
+            assert sorted(map(os.path.basename, paths)) == sorted(drafts)
+            results = {os.path.basename(r.in_path): r
+                       for r in preview_markdown_files(paths, num_workers=2, verbose=False)}
+            assert 'author lookup' in results['bad.md'].error and not results['bad.md'].num_tweets
+            for name in ('good.md', 'post.html', 'tagged.md'):
+                assert not results[name].error and results[name].num_tweets, results[name]
+            with open(os.path.join(d, 'preview-post.md')) as f:
+                assert '@davisblalock' in f.read()
+            # each file reports its paper's author index hits
+            assert (results['good.md'].index_hits, results['good.md'].index_misses) == (1, 1)
+            assert (results['tagged.md'].index_hits, results['tagged.md'].index_misses) == (0, 0)
+            table = preview_summary_table(list(results.values()))
+            assert '1/2 (50%)' in table, table
+    finally:
+        arxiv.fetch_or_scrape_papers, arxiv.scrape_arxiv_abs_page, find_authors = real
+
 
 def main():
+    # test_markdown_to_text_img_elems()
+    # test_shard_many()
+    # test_optimal_layout()
+    # test_author_index()
+    # test_batch_preview()
+    # bench_markdown_to_text_img_elems()
+    # bench_shard_many()
+    # bench_html_to_thread()
+    # bench_final_tweet_templates()
+    # return
+
     # markup = '<a href="http://example.com/">I linked to example.com</a>'
     # soup = BeautifulSoup(markup, 'html.parser')
     # print(soup)
@@ -671,8 +2001,8 @@ def main():
     # # with open(TEST_HTML_EASY, 'r') as f:
     #     html = f.read()
     # print(html_to_markdown(html))
-    # with open('cleaned-easy-summary.md', 'r') as f:
-    with open('cleaned-hard-summary.md', 'r') as f:
+    # with open(TEST_MARKDOWN_EASY, 'r') as f:
+    with open(TEST_MARKDOWN_HARD, 'r') as f:
         markdown = f.read()
     markdown_to_thread(markdown)
 
@@ -0,0 +1,356 @@
+
+import dataclasses
+import heapq
+import itertools
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+try:
+    import fcntl  # for sharing rate limits across processes
+except ImportError:
+    fcntl = None
+
+
+# request priorities for RateLimitScheduler; lower goes first
+PRIORITY_POST = 0  # posting a thread
+PRIORITY_INTERACTIVE = 1  # lookups someone's sitting there waiting on
+PRIORITY_BULK = 2  # follower crawls and such
+
+MAX_IN_FLIGHT = 8  # requests at once, across all endpoints
+# if a 429 comes with no reset time, assume the usual 15min window
+DEFAULT_RATE_LIMIT_WINDOW_SECS = 15 * 60
+LONG_WAIT_SECS = 5  # tell the user when we're going to wait longer than this
+
+# what twitter calls its rate limit headers
+LIMIT_HEADER = 'x-rate-limit-limit'
+REMAINING_HEADER = 'x-rate-limit-remaining'
+RESET_HEADER = 'x-rate-limit-reset'  # unix time the window resets at
+
+
+def shared_state_path(name: str) -> str:
+    """Where to keep the state for a rate limit shared across processes"""
+    return os.path.join(tempfile.gettempdir(), f'paper-threader-{name}-rate-limit')
+
+
+class TokenBucket:
+    """Token bucket rate limiter, shared across threads and processes.
+
+    The bucket state lives in a small file guarded by an flock, so every
+    process pointed at the same `state_path` draws from the same budget.
+    Without a state path (or without fcntl, e.g. on windows) it's only
+    shared across threads.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1., state_path: str = ''):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity  # max burst size
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._last_refill = time.time()
+
+    @contextmanager
+    def _locked_state(self):
+        with self._lock:
+            if not (self.state_path and fcntl is not None):
+                yield
+                return
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    contents = f.read().split()
+                    if len(contents) == 2:
+                        self._tokens, self._last_refill = map(float, contents)
+                    yield
+                    f.seek(0)
+                    f.truncate()
+                    f.write(f'{self._tokens} {self._last_refill}')
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _try_take(self) -> float:
+        """Takes a token if there is one; else returns secs until there is"""
+        with self._locked_state():
+            now = time.time()
+            elapsed = max(0., now - self._last_refill)
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Blocks until we're allowed to make a request"""
+        while True:
+            wait_secs = self._try_take()
+            if wait_secs <= 0:
+                return
+            time.sleep(wait_secs)
+
+
+@dataclass
+class EndpointBudget:
+    endpoint: str
+    limit: Optional[int] = None  # None until a response tells us
+    remaining: Optional[int] = None
+    reset: Optional[float] = None  # unix time; remaining goes back to limit then
+    in_flight: int = 0
+    queued: int = 0
+    num_requests: int = 0
+    num_rate_limited: int = 0  # 429s
+
+    def available(self, now: float) -> Optional[int]:
+        """Calls we can start right now, or None if we don't know"""
+        if self.remaining is None or self.reset is None or now >= self.reset:
+            return None
+        return max(0, self.remaining - self.in_flight)
+
+    def secs_until_reset(self, now: Optional[float] = None) -> float:
+        if self.reset is None:
+            return 0.
+        return max(0., self.reset - (time.time() if now is None else now))
+
+
+_priority_override = threading.local()
+
+
+@contextmanager
+def priority(level: int):
+    """Requests made in this thread inside the block get this priority,
+    whatever their endpoint's default is"""
+    previous = getattr(_priority_override, 'level', None)
+    _priority_override.level = level
+    try:
+        yield
+    finally:
+        _priority_override.level = previous
+
+
+def current_priority(default: int) -> int:
+    level = getattr(_priority_override, 'level', None)
+    return default if level is None else level
+
+
+class RateLimitScheduler:
+    """Decides when each request to a rate-limited api gets to go.
+
+    Unlike a token bucket, it doesn't guess at quotas; it keeps a budget
+    per endpoint from the rate limit headers on each response (see
+    `release`). A request to an endpoint that's out of calls waits for that
+    endpoint's window to reset, while requests to other endpoints keep
+    going. At most max_in_flight requests run at once, and whenever
+    requests are waiting, the highest-priority one that can go goes first,
+    so posting a thread never queues behind a follower crawl.
+
+    Budgets only cover this process; use a TokenBucket with a state path
+    to pace requests across processes.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, clock=time.time):
+        self.max_in_flight = max_in_flight
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._budgets: Dict[str, EndpointBudget] = {}
+        self._waiting: List[Tuple[int, int, str]] = []  # heap of (priority, seq, endpoint)
+        self._seq = itertools.count()
+        self._in_flight = 0
+
+    def _budget(self, endpoint: str) -> EndpointBudget:
+        if endpoint not in self._budgets:
+            self._budgets[endpoint] = EndpointBudget(endpoint)
+        return self._budgets[endpoint]
+
+    def _next_up(self, now: float) -> Optional[Tuple[int, int, str]]:
+        """The waiting request that should go next, if any can go now"""
+        if self._in_flight >= self.max_in_flight:
+            return None
+        for entry in sorted(self._waiting):
+            if self._budgets[entry[2]].available(now) != 0:
+                return entry
+        return None
+
+    def _secs_until_some_reset(self, now: float) -> Optional[float]:
+        resets = [self._budgets[endpoint].reset for _, _, endpoint in self._waiting
+                  if self._budgets[endpoint].available(now) == 0]
+        return max(0., min(resets) - now) if resets else None
+
+    def acquire(self, endpoint: str, priority: int = PRIORITY_INTERACTIVE) -> None:
+        """Blocks until a request to endpoint may go; pair with release()"""
+        with self._cond:
+            budget = self._budget(endpoint)
+            entry = (priority, next(self._seq), endpoint)
+            heapq.heappush(self._waiting, entry)
+            budget.queued += 1
+            told_user = False
+            try:
+                while True:
+                    now = self._clock()
+                    if self._next_up(now) == entry:
+                        break
+                    wait_secs = self._secs_until_some_reset(now)
+                    if (not told_user and budget.available(now) == 0
+                            and budget.secs_until_reset(now) > LONG_WAIT_SECS):
+                        print(f"rate limit: out of {endpoint} calls; waiting "
+                              f"{budget.secs_until_reset(now):.0f}s for the window to reset")
+                        told_user = True
+                    self._cond.wait(timeout=wait_secs)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                budget.queued -= 1
+            self._in_flight += 1
+            budget.in_flight += 1
+            budget.num_requests += 1
+            self._cond.notify_all()  # the next one in line might be able to go too
+
+    def release(self, endpoint: str, headers: Optional[Mapping[str, str]] = None,
+                rate_limited: bool = False) -> None:
+        """Marks a request as done, updating the endpoint's budget from its
+        response's headers (or just rate_limited, if it got a 429)"""
+        with self._cond:
+            budget = self._budget(endpoint)
+            self._in_flight -= 1
+            budget.in_flight -= 1
+            self._update(budget, headers or {}, rate_limited)
+            self._cond.notify_all()
+
+    def _update(self, budget: EndpointBudget, headers: Mapping[str, str], rate_limited: bool):
+        try:
+            limit = headers.get(LIMIT_HEADER)
+            remaining = headers.get(REMAINING_HEADER)
+            reset = headers.get(RESET_HEADER)
+            if limit is not None:
+                budget.limit = int(limit)
+            if remaining is not None:
+                budget.remaining = int(remaining)
+            if reset is not None:
+                budget.reset = float(reset)
+        except ValueError:
+            pass  # garbled headers; keep what we had
+        if rate_limited:
+            budget.num_rate_limited += 1
+            budget.remaining = 0
+            now = self._clock()
+            if budget.reset is None or budget.reset <= now:
+                budget.reset = now + DEFAULT_RATE_LIMIT_WINDOW_SECS
+
+    @contextmanager
+    def request(self, endpoint: str, priority: int = PRIORITY_INTERACTIVE) -> Iterator[dict]:
+        """Wraps acquire() + release(); put the response's headers (and
+        whether it was a 429) in the yielded dict to update the budget"""
+        self.acquire(endpoint, priority)
+        response_info = {}
+        try:
+            yield response_info
+        finally:
+            self.release(endpoint, response_info.get('headers'),
+                         rate_limited=response_info.get('rate_limited', False))
+
+    def budget(self, endpoint: str) -> EndpointBudget:
+        with self._cond:
+            return dataclasses.replace(self._budget(endpoint))
+
+    def budgets(self) -> Dict[str, EndpointBudget]:
+        """Copies of every endpoint's budget so far"""
+        with self._cond:
+            return {name: dataclasses.replace(b) for name, b in self._budgets.items()}
+
+    def queue_depth(self, endpoint: str = '') -> int:
+        """How many requests (to endpoint, or to anything) are waiting"""
+        with self._cond:
+            return sum(1 for _, _, e in self._waiting if not endpoint or e == endpoint)
+
+    def format_status(self) -> str:
+        now = self._clock()
+        lines = []
+        for name, b in sorted(self.budgets().items()):
+            avail = b.available(now)
+            if b.remaining is None:
+                left = 'budget unknown'
+            elif avail is None:  # window's reset since we last heard
+                left = f'{b.limit}/{b.limit} left'
+            else:
+                left = f'{avail}/{b.limit} left, resets in {b.secs_until_reset(now):.0f}s'
+            lines.append(f'  {name}: {left}; {b.in_flight} in flight, {b.queued} queued, '
+                         f'{b.num_requests} requests, {b.num_rate_limited} rate limited')
+        return '\n'.join(['rate limits:'] + (lines or ['  (no requests yet)']))
+
+
+# ================================================================ debug
+
+def test_rate_limit_scheduler():
+    # an endpoint that's out of calls doesn't hold up the others
+    sched = RateLimitScheduler()
+    reset = time.time() + 60
+    with sched.request('users/search') as info:
+        info['headers'] = {LIMIT_HEADER: '900', REMAINING_HEADER: '0', RESET_HEADER: str(reset)}
+    assert sched.budget('users/search').available(time.time()) == 0
+
+    blocked = threading.Thread(target=sched.acquire, args=('users/search', ), daemon=True)
+    blocked.start()
+    while sched.queue_depth('users/search') == 0:
+        time.sleep(.001)
+    t0 = time.time()
+    with sched.request('users/show') as info:
+        info['headers'] = {LIMIT_HEADER: '900', REMAINING_HEADER: '899', RESET_HEADER: str(reset)}
+    assert time.time() - t0 < 1
+    assert sched.queue_depth() == 1
+    budgets = sched.budgets()
+    assert budgets['users/show'].remaining == 899
+    assert budgets['users/search'].queued == 1
+    assert budgets['users/search'].in_flight == 0
+
+    # 429s with no headers use up the budget til the default window's over
+    with sched.request('followers/list') as info:
+        info['rate_limited'] = True
+    b = sched.budget('followers/list')
+    assert b.available(time.time()) == 0 and b.num_rate_limited == 1
+    assert b.secs_until_reset() > DEFAULT_RATE_LIMIT_WINDOW_SECS - 5
+
+    # the window resetting lets the stuck request go; fake the clock
+    sched._clock = lambda: reset + 1
+    with sched._cond:
+        sched._cond.notify_all()
+    blocked.join(timeout=5)
+    assert not blocked.is_alive()
+    sched.release('users/search')
+
+    # with one slot, posting goes before crawling, whatever order they asked in
+    sched = RateLimitScheduler(max_in_flight=1)
+    sched.acquire('followers/list')  # hold the only slot
+    order = []
+
+    def _go(endpoint, level):
+        with priority(level):
+            with sched.request(endpoint, current_priority(PRIORITY_BULK)):
+                order.append(endpoint)
+
+    threads = [threading.Thread(target=_go, args=('followers/list', PRIORITY_BULK)),
+               threading.Thread(target=_go, args=('users/show', PRIORITY_INTERACTIVE)),
+               threading.Thread(target=_go, args=('create_tweet', PRIORITY_POST))]
+    for i, thread in enumerate(threads):
+        thread.start()
+        while sched.queue_depth() < i + 1:
+            time.sleep(.001)
+    sched.release('followers/list')
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ['create_tweet', 'users/show', 'followers/list'], order
+    assert sched.queue_depth() == 0
+    print(sched.format_status())
+
+
+def main():
+    test_rate_limit_scheduler()
+
+
+if __name__ == '__main__':
+    main()
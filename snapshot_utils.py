@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import array
+import csv
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+from import_utils import lazy_import
+
+np = lazy_import('numpy')
+
+# Follower snapshots, stored as columns so that opening one is just
+# memory-mapping some files: no parsing, and only the pages you actually
+# touch get read. Each snapshot is a directory:
+#
+#   meta.json                 who, when, how many rows, which columns
+#   <int/bool column>.npy     one plain numpy array per column
+#   <string column>.offsets.npy
+#   strings.bin               utf-8 for every string column, back to back
+#
+# Row i of a string column is strings.bin[offsets[i]:offsets[i + 1]].
+# Snapshots of the same account sit side by side, named by when their
+# crawl finished:
+#
+#   follower_lists/snapshots/<user>/20220614T201500Z/
+
+SNAPSHOTS_DIR = os.path.join('follower_lists', 'snapshots')
+SNAPSHOT_TIME_FMT = '%Y%m%dT%H%M%SZ'  # utc; sorts chronologically
+FORMAT_VERSION = 1
+
+INT_COLUMNS = ('id', 'followers_count', 'friends_count', 'statuses_count')
+BOOL_COLUMNS = ('protected', 'verified')
+STRING_COLUMNS = ('screen_name', 'name', 'description', 'location', 'url')
+
+# (column in the snapshot, column in the csv); matches what save_followers
+# has always written
+CSV_COLUMNS = (
+    ('followers_count', 'followers_count'),
+    ('friends_count', 'following_count'),
+    ('screen_name', 'screen_name'),
+    ('name', 'name'),
+    ('description', 'bio'),
+)
+
+
+class StringColumn:
+    """A column of strings living in a shared (memory-mapped) buffer"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data  # uint8
+        self.offsets = offsets  # int64, one more than the number of rows
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        buf = memoryview(self.data)
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield str(buf[start:end], 'utf-8')
+
+    def take(self, indices: Iterable[int]) -> List[str]:
+        return [self[i] for i in indices]
+
+    def num_bytes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+class FollowerSnapshot:
+    """One crawl of one user's followers; see the top of this file.
+
+    Columns get memory-mapped the first time they're used, so opening a
+    snapshot costs about the same no matter how many rows it has.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"Snapshot {path} has format version "
+                             f"{self.meta['format_version']}, not {FORMAT_VERSION}")
+        self._columns: Dict[str, Union[np.ndarray, StringColumn]] = {}
+        self._strings: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return self.meta['num_rows']
+
+    def __repr__(self):
+        return f"FollowerSnapshot('{self.path}', {len(self)} rows)"
+
+    @property
+    def crawled_at(self) -> float:
+        return self.meta['crawled_at']
+
+    @property
+    def column_names(self) -> List[str]:
+        return list(INT_COLUMNS + BOOL_COLUMNS + STRING_COLUMNS)
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def _strings_buffer(self) -> np.ndarray:
+        if self._strings is None:
+            path = os.path.join(self.path, 'strings.bin')
+            if os.path.getsize(path):
+                self._strings = np.memmap(path, dtype=np.uint8, mode='r')
+            else:  # can't mmap an empty file
+                self._strings = np.zeros(0, dtype=np.uint8)
+        return self._strings
+
+    def __getitem__(self, name: str) -> Union[np.ndarray, StringColumn]:
+        if name not in self._columns:
+            if name in STRING_COLUMNS:
+                self._columns[name] = StringColumn(self._strings_buffer(),
+                                                   self._load(name + '.offsets'))
+            elif name in INT_COLUMNS or name in BOOL_COLUMNS:
+                self._columns[name] = self._load(name)
+            else:
+                raise KeyError(f"No column '{name}'; columns are {self.column_names}")
+        return self._columns[name]
+
+    def row(self, i: int) -> dict:
+        ret = {name: self[name][i] for name in self.column_names}
+        for name in INT_COLUMNS:
+            ret[name] = int(ret[name])
+        for name in BOOL_COLUMNS:
+            ret[name] = bool(ret[name])
+        return ret
+
+    def iter_rows(self, indices: Optional[Iterable[int]] = None) -> Iterator[dict]:
+        for i in (range(len(self)) if indices is None else indices):
+            yield self.row(int(i))
+
+
+def snapshot_name(crawled_at: float) -> str:
+    return time.strftime(SNAPSHOT_TIME_FMT, time.gmtime(crawled_at))
+
+
+def user_snapshots_dir(id_or_screen_name: Union[int, str],
+                       snapshots_dir: str = SNAPSHOTS_DIR) -> str:
+    return os.path.join(snapshots_dir, str(id_or_screen_name).lower())
+
+
+def write_snapshot(followers: Iterable[dict], path: str, **meta) -> FollowerSnapshot:
+    """Writes follower dicts (like USER_CACHE_FIELDS of a v1 user) as a
+    snapshot at path, streaming, so the whole crawl never has to be in
+    memory at once. Extra kwargs end up in meta.json."""
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)  # from a write that died partway through
+    os.makedirs(tmp_path)
+
+    ints = {name: array.array('q') for name in INT_COLUMNS}
+    bools = {name: array.array('b') for name in BOOL_COLUMNS}
+    offsets = {name: array.array('q', [0]) for name in STRING_COLUMNS}
+    # each string column gets its own file while streaming; they're glued
+    # into strings.bin at the end
+    string_files = {name: tempfile.TemporaryFile(dir=tmp_path) for name in STRING_COLUMNS}
+    num_rows = 0
+    try:
+        for follower in followers:
+            for name in INT_COLUMNS:
+                ints[name].append(follower.get(name) or 0)
+            for name in BOOL_COLUMNS:
+                bools[name].append(bool(follower.get(name)))
+            for name in STRING_COLUMNS:
+                encoded = (follower.get(name) or '').encode('utf-8')
+                string_files[name].write(encoded)
+                offsets[name].append(offsets[name][-1] + len(encoded))
+            num_rows += 1
+
+        for name, values in ints.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), np.frombuffer(values, dtype=np.int64))
+        for name, values in bools.items():
+            np.save(os.path.join(tmp_path, name + '.npy'),
+                    np.frombuffer(values, dtype=np.int8).astype(bool))
+        base = 0
+        with open(os.path.join(tmp_path, 'strings.bin'), 'wb') as out:
+            for name in STRING_COLUMNS:
+                f = string_files[name]
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+                np.save(os.path.join(tmp_path, name + '.offsets.npy'),
+                        np.frombuffer(offsets[name], dtype=np.int64) + base)
+                base += offsets[name][-1]
+    finally:
+        for f in string_files.values():
+            f.close()
+
+    meta = dict(meta, format_version=FORMAT_VERSION, num_rows=num_rows)
+    meta.setdefault('crawled_at', time.time())
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return FollowerSnapshot(path)
+
+
+def list_snapshots(id_or_screen_name: Union[int, str],
+                   snapshots_dir: str = SNAPSHOTS_DIR) -> List[str]:
+    """Paths of a user's snapshots, oldest first"""
+    d = user_snapshots_dir(id_or_screen_name, snapshots_dir)
+    if not os.path.isdir(d):
+        return []
+    names = [name for name in os.listdir(d)
+             if not name.endswith('.tmp') and os.path.exists(os.path.join(d, name, 'meta.json'))]
+    return [os.path.join(d, name) for name in sorted(names)]
+
+
+def load_snapshot(id_or_screen_name: Union[int, str], which: int = -1,
+                  snapshots_dir: str = SNAPSHOTS_DIR) -> FollowerSnapshot:
+    """A user's latest snapshot by default; which=0 is their oldest"""
+    paths = list_snapshots(id_or_screen_name, snapshots_dir)
+    if not paths:
+        raise FileNotFoundError(f"No follower snapshots of '{id_or_screen_name}' "
+                                f"in {snapshots_dir}")
+    return FollowerSnapshot(paths[which])
+
+
+def export_csv(snapshot: FollowerSnapshot, path: str,
+               indices: Optional[Sequence[int]] = None):
+    """Writes (some rows of) a snapshot as a csv, in snapshot order"""
+    columns = [snapshot[name] for name, _ in CSV_COLUMNS]
+    rows = range(len(snapshot)) if indices is None else indices
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([col for _, col in CSV_COLUMNS])
+        if indices is None:  # way faster than indexing each row
+            writer.writerows(zip(*[col.tolist() if isinstance(col, np.ndarray) else col
+                                   for col in columns]))
+        else:
+            for i in rows:
+                writer.writerow([col[int(i)] for col in columns])
+    os.replace(tmp_path, path)
+
+
+# ================================================================ debug
+
+# (bio, how often); roughly what a big ML account's followers look like
+_FAKE_BIOS = (
+    ('', 30),
+    ('opinions my own. dad, runner, coffee', 20),
+    ('Building the future of {} @startup 🚀', 15),
+    ('Software engineer. Tweets about {}', 15),
+    ('Data scientist | "ML" person\nlikes {} things 🤖', 10),
+    ('PhD student at Ümeå University working on {}', 4),
+    ('Research Scientist @ SomeLab. Views my own', 3),
+    ('Assistant Professor of CS. {}', 2),
+    ('Postdoc, previously @MIT. {}', 1),
+)
+_FAKE_TOPICS = ('deep learning', 'crypto', 'compilers', 'NLP', 'robots', 'GPUs', '3d printing')
+
+
+def _fake_followers(num_rows: int, biggest_first: bool = False) -> Iterator[dict]:
+    rng = np.random.default_rng(123)
+    counts = rng.zipf(1.5, size=num_rows) % 10_000_000
+    if biggest_first:  # like snapshots of real crawls
+        counts = np.sort(counts)[::-1]
+    weights = np.array([w for _, w in _FAKE_BIOS], dtype=float)
+    bio_idxs = rng.choice(len(_FAKE_BIOS), size=num_rows, p=weights / weights.sum())
+    for i in range(num_rows):
+        bio = _FAKE_BIOS[bio_idxs[i]][0].format(_FAKE_TOPICS[i % len(_FAKE_TOPICS)])
+        yield {'id': 10**12 + i, 'screen_name': f'user{i}', 'name': f'Ümlaut Ü {i}',
+               'description': bio,
+               'location': '' if i % 3 else 'Boston', 'url': None,
+               'protected': i % 11 == 0, 'verified': i % 101 == 0,
+               'followers_count': int(counts[i]), 'friends_count': i % 5000,
+               'statuses_count': i}
+
+
+def test_snapshot_roundtrip(num_rows: int = 1000):
+    followers = list(_fake_followers(num_rows))
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'snap')
+        snap = write_snapshot(iter(followers), path, screen_name='someone')
+        assert len(snap) == num_rows
+        assert snap.meta['screen_name'] == 'someone'
+        for i in (0, 1, num_rows // 2, num_rows - 1):
+            expected = dict(followers[i], url=followers[i]['url'] or '')
+            assert snap.row(i) == expected, (snap.row(i), expected)
+        assert list(snap['description']) == [f['description'] for f in followers]
+        assert snap['followers_count'].dtype == np.int64
+        assert isinstance(snap['followers_count'], np.memmap)
+
+        csv_path = os.path.join(d, 'followers.csv')
+        export_csv(snap, csv_path)
+        with open(csv_path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == num_rows
+        assert rows[5]['bio'] == followers[5]['description']
+        assert rows[5]['following_count'] == str(followers[5]['friends_count'])
+
+        empty = write_snapshot(iter([]), os.path.join(d, 'empty'))
+        assert len(empty) == 0 and list(empty['name']) == []
+
+
+def test_list_snapshots():
+    with tempfile.TemporaryDirectory() as d:
+        user_dir = user_snapshots_dir('SomeOne', d)
+        os.makedirs(user_dir)
+        for t in (2e9, 1e9):
+            write_snapshot(_fake_followers(3), os.path.join(user_dir, snapshot_name(t)),
+                           crawled_at=t)
+        os.makedirs(os.path.join(user_dir, snapshot_name(3e9) + '.tmp'))  # died partway
+        assert len(list_snapshots('someone', d)) == 2
+        assert load_snapshot('someone', snapshots_dir=d).crawled_at == 2e9
+        assert load_snapshot('someone', which=0, snapshots_dir=d).crawled_at == 1e9
+
+
+def bench_open_snapshot(num_rows: int = 2 * 1000 * 1000):
+    """Opening a snapshot and summing a column vs parsing the csv export"""
+    import subprocess
+    import sys
+    with tempfile.TemporaryDirectory() as d:
+        t0 = time.perf_counter()
+        snap = write_snapshot(_fake_followers(num_rows), os.path.join(d, 'snap'))
+        print(f"wrote {num_rows} row snapshot in {time.perf_counter() - t0:.1f}s")
+        csv_path = os.path.join(d, 'followers.csv')
+        export_csv(snap, csv_path)
+
+        # fresh processes, so only the page cache is shared; VmHWM is peak
+        # rss, which, unlike getrusage, doesn't carry over from our fork
+        peak_rss = ("print([l.split()[1] for l in open('/proc/self/status') "
+                    "if l.startswith('VmHWM')][0])")
+        snapshot_code = (f"import snapshot_utils as s; snap = s.FollowerSnapshot({snap.path!r}); "
+                         "print(int(snap['followers_count'].sum()), snap['name'][-1]); "
+                         + peak_rss)
+        csv_code = (f"import csv; rows = list(csv.DictReader(open({csv_path!r}, newline=''))); "
+                    "print(sum(int(r['followers_count']) for r in rows), rows[-1]['name']); "
+                    + peak_rss)
+        for name, code in (('snapshot', snapshot_code), ('csv', csv_code)):
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], check=True,
+                                 capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            secs = time.perf_counter() - t0
+            result, peak_kib = out.strip().split('\n')
+            print(f"{name}: {secs:.2f}s, peak rss {int(peak_kib) / 1024:.0f}MiB -> {result}")
+
+
+def main():
+    test_snapshot_roundtrip()
+    test_list_snapshots()
+    # bench_open_snapshot()
+
+
+if __name__ == '__main__':
+    main()
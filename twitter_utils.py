@@ -1,22 +1,33 @@
+from __future__ import annotations
 
+import concurrent.futures
+import hashlib
+import io
+import json
 import os
 import re
 import shutil
 import tempfile
+import threading
 import time
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 from unicodedata import name
+from urllib.parse import urlsplit
 from uuid import uuid4
 
-import pandas as pd
-import requests
-import tweepy
 from dotenv import load_dotenv
 
-import joblib
+import image_utils
+import rate_limit_utils as rate_limit
+from cache_utils import Cache, cache
+from import_utils import lazy_import
 
-memory = joblib.Memory('.')
+# these take most of a second to import between them, and lots of commands
+# never touch twitter at all
+http = lazy_import('http_utils')
+tweepy = lazy_import('tweepy')
 
 # see https://github.com/theskumar/python-dotenv/blob/master/src/dotenv/main.py for docs
 load_dotenv(dotenv_path='.env')
@@ -25,34 +36,124 @@ DEFAULT_USER_ENV_PATH = '.my.env'
 
 DEBUG_ACCOUNT_ID = 1521314141520027648
 
-FOLLOWER_LISTS_DIR = 'follower_lists'
-
-API_KEY = os.environ["API_KEY"]
-API_KEY_SECRET = os.environ["API_KEY_SECRET"]
-ACCESS_TOKEN = os.environ["ACCESS_TOKEN"]
-ACCESS_TOKEN_SECRET = os.environ["ACCESS_TOKEN_SECRET"]
-BEARER_TOKEN = os.environ["BEARER_TOKEN"]
+THREAD_JOURNAL_DIR = 'thread_journals'
+
+# v1 users/search allows 900 requests per 15min window per user; see
+# https://developer.twitter.com/en/docs/twitter-api/v1/accounts-and-users/follow-search-get-users/api-reference/get-users-search # noqa
+USERS_SEARCH_MAX_REQS_PER_WINDOW = 900
+RATE_LIMIT_WINDOW_SECS = 15 * 60
+MAX_SEARCH_WORKERS = 8
+MAX_UPLOAD_WORKERS = 4
+POST_LOOKAHEAD = 3  # how many tweets ahead to prepare while posting
+
+# media ids are good for a day after upload; leave some slack for posting
+MEDIA_ID_TTL_SECS = 23 * 3600
+MEDIA_ID_CACHE_NAMESPACE = 'twitter_utils.media_ids'
+URL_DIGEST_TTL_SECS = 7 * 24 * 3600  # image urls basically never change
+
+# images get downloaded into memory, so cap how big they can be; this is
+# twitter's limit for gifs (other images have to be under 5MB)
+MAX_DOWNLOAD_BYTES = 15 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+# how long cached lookups stay valid
+SEARCH_CACHE_TTL_SECS = 7 * 24 * 3600
+USER_CACHE_TTL_SECS = 7 * 24 * 3600
+
+# all we ever look at on a user; caching the whole object graph (latest
+# status, profile colors, etc) is most of the bytes for no benefit
+USER_CACHE_FIELDS = (
+    'id',
+    'id_str',
+    'name',
+    'screen_name',
+    'description',
+    'location',
+    'url',
+    'protected',
+    'verified',
+    'followers_count',
+    'friends_count',
+    'statuses_count',
+)
+
+CREDENTIAL_ENV_VARS = {
+    'API_KEY': 'api_key',
+    'API_KEY_SECRET': 'api_key_secret',
+    'ACCESS_TOKEN': 'access_token',
+    'ACCESS_TOKEN_SECRET': 'access_token_secret',
+    'BEARER_TOKEN': 'bearer_token',
+}
 
 
 def override_env(env_path: str = DEFAULT_USER_ENV_PATH):
-    global API_KEY
-    global API_KEY_SECRET
-    global ACCESS_TOKEN
-    global ACCESS_TOKEN_SECRET
-    global BEARER_TOKEN
+    global _credentials
     print(f"overriding default user! Using path '{env_path}'")
-    print("old access token: ", ACCESS_TOKEN)
-    # print(os.environ["ACCESS_TOKEN"])
     load_dotenv(dotenv_path=env_path, override=True)
-    # load_dotenv(dotenv_path='.my.env')
-    # print(os.environ["ACCESS_TOKEN"])
-    API_KEY = os.environ["API_KEY"]
-    API_KEY_SECRET = os.environ["API_KEY_SECRET"]
-    ACCESS_TOKEN = os.environ["ACCESS_TOKEN"]
-    ACCESS_TOKEN_SECRET = os.environ["ACCESS_TOKEN_SECRET"]
-    BEARER_TOKEN = os.environ["BEARER_TOKEN"]
-    print("new access token: ", ACCESS_TOKEN)
-    # import sys; sys.exit()
+    _credentials = None  # re-read from the env on next use
+    print("new access token: ", current_credentials().access_token)
+
+
+@dataclass(frozen=True)
+class Credentials:
+    api_key: str = field(repr=False)
+    api_key_secret: str = field(repr=False)
+    access_token: str = field(repr=False)
+    access_token_secret: str = field(repr=False)
+    bearer_token: str = field(default='', repr=False)
+
+    @property
+    def account(self) -> str:
+        # oauth1 access tokens look like <user id>-<secret stuff>
+        return self.access_token.split('-')[0]
+
+    def __repr__(self):
+        return f'Credentials(account={self.account})'
+
+
+# read from the env on first use rather than at import, so that commands
+# that never talk to twitter work without a .env
+_credentials: Optional[Credentials] = None
+
+
+def current_credentials() -> Credentials:
+    global _credentials
+    if _credentials is None:
+        missing = [var for var in CREDENTIAL_ENV_VARS if var not in os.environ]
+        if missing:
+            raise RuntimeError(f"Missing twitter credentials {missing}; put them "
+                               "in .env or the environment")
+        _credentials = Credentials(**{field_name: os.environ[var]
+                                      for var, field_name in CREDENTIAL_ENV_VARS.items()})
+    return _credentials
+
+
+def __getattr__(name: str):
+    # old code reads twit.API_KEY, etc; keep that working
+    if name in CREDENTIAL_ENV_VARS:
+        return getattr(current_credentials(), CREDENTIAL_ENV_VARS[name])
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def current_account() -> str:
+    """Who API calls are being made as; used to namespace cached results"""
+    return current_credentials().account
+
+
+def _user_to_dict(user: tweepy.User) -> dict:
+    return {k: user._json[k] for k in USER_CACHE_FIELDS if k in user._json}
+
+
+def _user_from_dict(d: dict) -> tweepy.User:
+    return tweepy.models.User.parse(None, d)  # v1 user, like the api returns
+
+
+def _users_to_dicts(users: List[tweepy.User]) -> List[dict]:
+    return [_user_to_dict(user) for user in users]
+
+
+def _users_from_dicts(dicts: List[dict]) -> List[tweepy.User]:
+    return [_user_from_dict(d) for d in dicts]
 
 
 @dataclass
@@ -70,26 +171,103 @@ class Tweet:
         return ret
 
 
-def authenticate_v1():
+# (method, path) -> (endpoint name, priority) for every twitter endpoint we
+# use; see rate_limits below. Other requests get tracked by their path.
+TWITTER_ENDPOINTS = {
+    ('GET', '/1.1/users/search.json'): ('users/search', rate_limit.PRIORITY_INTERACTIVE),
+    ('GET', '/1.1/users/show.json'): ('users/show', rate_limit.PRIORITY_INTERACTIVE),
+    ('GET', '/1.1/followers/list.json'): ('followers/list', rate_limit.PRIORITY_BULK),
+    ('POST', '/1.1/media/upload.json'): ('media/upload', rate_limit.PRIORITY_POST),
+    ('GET', '/1.1/media/upload.json'): ('media/upload', rate_limit.PRIORITY_POST),  # status
+    ('POST', '/2/tweets'): ('create_tweet', rate_limit.PRIORITY_POST),
+}
+TWITTER_URL_PREFIXES = ('https://api.twitter.com/', 'https://upload.twitter.com/')
+
+# every twitter request in the process goes through this, so that running
+# out of one endpoint's quota only holds up requests to that endpoint, and
+# posting goes ahead of crawls. Check on it with rate_limits.budgets(),
+# rate_limits.queue_depth(), or print(rate_limits.format_status()).
+rate_limits = rate_limit.RateLimitScheduler()
+
+
+def _classify_request(request) -> Tuple[str, int]:
+    path = urlsplit(request.url).path
+    endpoint, priority = TWITTER_ENDPOINTS.get(
+        (request.method, path),
+        (f'{request.method} {re.sub(r"(?<!^)/[0-9]+(?=/|$)", "/:id", path)}',  # not the /2/
+         rate_limit.PRIORITY_INTERACTIVE))
+    return endpoint, rate_limit.current_priority(priority)
+
+
+_rate_limits_mounted = False
+_rate_limits_lock = threading.Lock()  # not _clients_lock; get_api holds that
+
+
+def _twitter_session():
+    """The shared http session, with twitter requests going through rate_limits"""
+    global _rate_limits_mounted
+    with _rate_limits_lock:
+        if not _rate_limits_mounted:
+            for prefix in TWITTER_URL_PREFIXES:
+                http.rate_limit_prefix(prefix, rate_limits, _classify_request)
+            _rate_limits_mounted = True
+    return http.get_session()
+
+
+def authenticate_v1(credentials: Optional[Credentials] = None):
+    credentials = credentials or current_credentials()
     print("creating tweepy APIv1 client...")
-    auth = tweepy.OAuthHandler(API_KEY, API_KEY_SECRET)
-    auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-    return tweepy.API(auth, wait_on_rate_limit=True)
+    auth = tweepy.OAuthHandler(credentials.api_key, credentials.api_key_secret)
+    auth.set_access_token(credentials.access_token, credentials.access_token_secret)
+    # no wait_on_rate_limit; rate_limits waits out just the endpoint that's out
+    api = tweepy.API(auth)
+    api.session = _twitter_session()  # share pooled connections
+    return api
 
 
-def authenticate_v2():
+def authenticate_v2(credentials: Optional[Credentials] = None):
+    credentials = credentials or current_credentials()
     print("creating tweepy APIv2 client...")
-    return tweepy.Client(
-        consumer_key=API_KEY,
-        consumer_secret=API_KEY_SECRET,
-        access_token=ACCESS_TOKEN,
-        access_token_secret=ACCESS_TOKEN_SECRET,
+    client = tweepy.Client(
+        consumer_key=credentials.api_key,
+        consumer_secret=credentials.api_key_secret,
+        access_token=credentials.access_token,
+        access_token_secret=credentials.access_token_secret,
     )
+    client.session = _twitter_session()
+    return client
+
+
+# one v1 api and one v2 client per set of credentials, made on first use
+# and shared by every thread after that
+_v1_apis: Dict[Credentials, tweepy.API] = {}
+_v2_clients: Dict[Credentials, tweepy.Client] = {}
+_clients_lock = threading.Lock()
+
+
+def get_api(credentials: Optional[Credentials] = None) -> tweepy.API:
+    """The v1 api for the given (by default, current) credentials"""
+    credentials = credentials or current_credentials()
+    with _clients_lock:
+        if credentials not in _v1_apis:
+            _v1_apis[credentials] = authenticate_v1(credentials)
+        return _v1_apis[credentials]
+
+
+def get_client(credentials: Optional[Credentials] = None) -> tweepy.Client:
+    """The v2 client for the given (by default, current) credentials"""
+    credentials = credentials or current_credentials()
+    with _clients_lock:
+        if credentials not in _v2_clients:
+            _v2_clients[credentials] = authenticate_v2(credentials)
+        return _v2_clients[credentials]
+
 
 def authenticate_as_another_account(write_user_env_path: str = DEFAULT_USER_ENV_PATH):
+    credentials = current_credentials()
     oauth1_user_handler = tweepy.OAuth1UserHandler(
-        API_KEY,
-        API_KEY_SECRET,
+        credentials.api_key,
+        credentials.api_key_secret,
         callback="oob",
     )
     print("Please go to this URL to enable this app for your")
@@ -109,47 +287,239 @@ def authenticate_as_another_account(write_user_env_path: str = DEFAULT_USER_ENV_
     print("before doing twitter stuff, it should now do it as")
     print("the account you logged into.")
 
-    oauth1_user_handler.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-    return tweepy.API(oauth1_user_handler, wait_on_rate_limit=True)
-
+    oauth1_user_handler.set_access_token(credentials.access_token,
+                                         credentials.access_token_secret)
+    api = tweepy.API(oauth1_user_handler)
+    api.session = _twitter_session()
+    return api
 
-@memory.cache(ignore=['api'])
-def search_users(api: tweepy.API, *args, **kwargs):
-    return api.search_users(*args, **kwargs)
 
+# shared across processes so a batch of previews can't blow the quota
+users_search_rate_limiter = rate_limit.TokenBucket(
+    rate=USERS_SEARCH_MAX_REQS_PER_WINDOW / RATE_LIMIT_WINDOW_SECS,
+    capacity=USERS_SEARCH_MAX_REQS_PER_WINDOW,
+    state_path=rate_limit.shared_state_path('users-search'))
 
-def _download_img(url: str, tempdir: str) -> str:
-    response = requests.get(url, stream=True)
-    if response.status_code != 200:
-        raise RuntimeError(f"Failed to load image at url: {url}")
-    response.raw.decode_content = True
 
-    filename = url.split("/")[-1]
-    saveas = os.path.join(tempdir, filename)
-    with open(saveas, 'wb') as f:
-        shutil.copyfileobj(response.raw, f)
+@cache.cached(ttl_secs=SEARCH_CACHE_TTL_SECS, ignore=['api'],
+              account=current_account,
+              encode=_users_to_dicts, decode=_users_from_dicts)
+def search_users(api: tweepy.API, *args, **kwargs):
+    users_search_rate_limiter.acquire()  # only hit on cache misses
+    return api.search_users(*args, **kwargs)
 
-    return saveas
 
+def search_many_users(api: tweepy.API,
+                      queries: Sequence[str],
+                      max_workers: int = MAX_SEARCH_WORKERS,
+                      **kwargs) -> Tuple[Dict[str, List[tweepy.User]], Dict[str, float]]:
+    """Runs search_users for each distinct query on a small thread pool.
+
+    Returns dicts mapping each query to its search results and to how long
+    its request took, so callers can see how much the overlap bought them.
+    """
+    queries = list(dict.fromkeys(queries))  # dedup, keep order
+
+    def _timed_search(q: str):
+        t0 = time.perf_counter()
+        users = search_users(api, q=q, **kwargs)
+        return users, time.perf_counter() - t0
+
+    q2users = {}
+    q2latency = {}
+    if not queries:
+        return q2users, q2latency
+    max_workers = max(1, min(max_workers, len(queries)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for q, (users, latency) in zip(queries, pool.map(_timed_search, queries)):
+            q2users[q] = users
+            q2latency[q] = latency
+    return q2users, q2latency
+
+
+def _download_img(url: str) -> io.BytesIO:
+    """Downloads an image into memory, refusing anything bigger than
+    twitter would take, so memory use per download is bounded"""
+    with http.get(url, stream=True) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to load image at url: {url}")
+        too_big_msg = f"Image at url {url} is over {MAX_DOWNLOAD_BYTES} bytes"
+        if int(response.headers.get('Content-Length') or 0) > MAX_DOWNLOAD_BYTES:
+            raise ValueError(too_big_msg)
+        buf = io.BytesIO()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            buf.write(chunk)
+            if buf.tell() > MAX_DOWNLOAD_BYTES:
+                raise ValueError(too_big_msg)
+    buf.seek(0)
+    return buf
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _media_id_ttl(res) -> float:
+    # twitter tells us how long the id is good for; trust it, with slack
+    expires_after_secs = getattr(res, 'expires_after_secs', None)
+    if expires_after_secs:
+        return min(MEDIA_ID_TTL_SECS, .9 * expires_after_secs)
+    return MEDIA_ID_TTL_SECS
+
+
+# (account, sha256) -> future media id, so that two uploads of the same
+# bytes at the same time (e.g., one image under two urls) only hit twitter once
+_uploads_in_flight: Dict[Tuple[str, str], concurrent.futures.Future] = {}
+_uploads_in_flight_lock = threading.Lock()
+
+
+def _media_cache_key(digest: str, preprocess: bool) -> str:
+    return f'sha256:{digest}:preprocessed' if preprocess else f'sha256:{digest}'
+
+
+def _upload_file_once(api: tweepy.API,
+                      path: str,
+                      cache_key: str,
+                      account: str,
+                      file: Optional[io.BytesIO] = None,
+                      preprocess: bool = False,
+                      preprocess_stats: Optional[image_utils.PreprocessStats] = None) -> int:
+    key = (account, cache_key)
+    with _uploads_in_flight_lock:
+        future = _uploads_in_flight.get(key)
+        is_uploader = future is None
+        if is_uploader:
+            future = concurrent.futures.Future()
+            _uploads_in_flight[key] = future
+    if not is_uploader:
+        return future.result()
 
-# caching breaks when you switch users; uncomment for debugging
-# @memory.cache(ignore=['api'])
-def _upload_media(api: tweepy.API, filename: str):
-    with tempfile.TemporaryDirectory() as d:
-        if filename.startswith('http'):
-            filename = _download_img(filename, tempdir=d)
-        res = api.chunked_upload(filename)
-    return res.media_id
+    try:
+        # might have finished between our cache check and getting here
+        media_id = cache.get(MEDIA_ID_CACHE_NAMESPACE, cache_key, account=account)
+        if media_id is None:
+            if preprocess:
+                if file is None:
+                    with open(path, 'rb') as f:
+                        file = io.BytesIO(f.read())
+                img = image_utils.preprocess_image_in_pool(file.getvalue())
+                if preprocess_stats is not None:
+                    preprocess_stats.add(img)
+                path = os.path.splitext(os.path.basename(path))[0] + img.extension
+                file = io.BytesIO(img.data)
+            res = api.chunked_upload(path, file=file)
+            media_id = res.media_id
+            cache.set(MEDIA_ID_CACHE_NAMESPACE, cache_key, media_id,
+                      account=account, ttl_secs=_media_id_ttl(res))
+        future.set_result(media_id)
+        return media_id
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _uploads_in_flight_lock:
+            _uploads_in_flight.pop(key, None)
+
+
+# media ids are only good for the account that uploaded them and only for
+# a day, so they're cached per account with a short TTL. They're keyed by
+# content hash, since local files can change under the same path. Urls map
+# to the hash of what they served, so we don't have to download them again.
+#
+# With preprocess, images get shrunk (see image_utils) between download and
+# upload, in a process pool; preprocess_stats tallies the bytes saved.
+# account is who api uploads as; by default, whoever the credentials are for.
+def _upload_media(api: tweepy.API,
+                  filename: str,
+                  preprocess: bool = False,
+                  preprocess_stats: Optional[image_utils.PreprocessStats] = None,
+                  account: str = ''):
+    account = account or current_account()
+    is_url = filename.startswith('http')
+    if is_url:
+        digest = cache.get(MEDIA_ID_CACHE_NAMESPACE, f'url:{filename}')
+        if digest is not None:
+            media_id = cache.get(MEDIA_ID_CACHE_NAMESPACE,
+                                 _media_cache_key(digest, preprocess), account=account)
+            if media_id is not None:
+                return media_id
+
+    # local files get uploaded from their path; downloads go straight from
+    # memory to twitter, no temp files
+    path, buf = filename, None
+    if is_url:
+        buf = _download_img(filename)
+        path = filename.split('?')[0].split('/')[-1]  # tweepy wants a name
+        digest = hashlib.sha256(buf.getbuffer()).hexdigest()
+        cache.set(MEDIA_ID_CACHE_NAMESPACE, f'url:{filename}', digest,
+                  ttl_secs=URL_DIGEST_TTL_SECS)
+    else:
+        digest = _sha256_file(path)
+
+    cache_key = _media_cache_key(digest, preprocess)
+    media_id = cache.get(MEDIA_ID_CACHE_NAMESPACE, cache_key, account=account)
+    if media_id is None:
+        media_id = _upload_file_once(api, path, cache_key, account, file=buf,
+                                     preprocess=preprocess,
+                                     preprocess_stats=preprocess_stats)
+    return media_id
+
+
+def _raise_on_failed_upload(img2future: Dict[str, concurrent.futures.Future]):
+    """Waits for all the uploads, or until one of them fails"""
+    future2img = {future: img for img, future in img2future.items()}
+    done, not_done = concurrent.futures.wait(
+        future2img, return_when=concurrent.futures.FIRST_EXCEPTION)
+    for future in not_done:
+        future.cancel()
+    for future in done:
+        e = future.exception()
+        if e is not None:
+            raise RuntimeError(
+                f"Failed to upload image '{future2img[future]}'; not "
+                "posting anything") from e
+
+
+def upload_thread_media(api: tweepy.API,
+                        tweets: Sequence[Tweet],
+                        max_workers: int = MAX_UPLOAD_WORKERS,
+                        preprocess_images: bool = False) -> Dict[str, int]:
+    """Uploads every distinct image in the thread, a few at a time.
+
+    Returns a map from image url or path to media id. If any upload fails,
+    the rest are cancelled and the error is raised, so that we find out
+    before posting anything rather than halfway through the thread.
+    """
+    imgs = list(dict.fromkeys(img for tweet in tweets for img in tweet.imgs))
+    if not imgs:
+        return {}
+    max_workers = max(1, min(max_workers, len(imgs)))
+    stats = image_utils.PreprocessStats()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        img2future = {img: pool.submit(_upload_media, api, img,
+                                       preprocess=preprocess_images,
+                                       preprocess_stats=stats)
+                      for img in imgs}
+        _raise_on_failed_upload(img2future)
+    if preprocess_images:
+        print(stats)
+    return {img: future.result() for img, future in img2future.items()}
 
 
 # api v1 impl
-@memory.cache(ignore=['api'])
+@cache.cached(ttl_secs=USER_CACHE_TTL_SECS, ignore=['api'],
+              account=current_account,
+              encode=_user_to_dict, decode=_user_from_dict)
 def get_user(api: tweepy.API, screen_name: str):
     return api.get_user(screen_name=screen_name)
 
 
 # v2 impl fails with 401 Unauthorized on other people's accounts
-# @memory.cache(ignore=['client'])
+# @cache.cached(ignore=['client'], account=current_account)
 # def get_user(client: tweepy.Client, username: str):
 #     return client.get_user(username=username)
 
@@ -167,25 +537,17 @@ def _ensure_user_id(api: tweepy.API, user: Optional[Union[str, int, tweepy.User]
     # return get_user(client, user).id
 
 
-# we need a v1 client (api) and a v2 client (client) since v1 can't
-# tag people in media and v2 can't upload media
-def create_tweet(api: tweepy.API,
-                 client: tweepy.Client,
-                 tweet: Tweet,
-                 tag_users: Optional[List[tweepy.User]] = None,
-                 in_reply_to_tweet_id: Optional[str] = None,
-                 quote_tweet_id: str = None,
-                 debug_mode: bool = False) -> tweepy.Response:
-
-    media_ids = []
-    for img in tweet.imgs:
-        media_ids.append(_upload_media(api, img))
-    media_ids = media_ids or None
+def _ensure_user_ids(api: tweepy.API, users: Sequence[Union[str, int, tweepy.User]]):
+    return [_ensure_user_id(api, user) for user in users]
 
-    if tag_users:
-        print("tag users: ", tag_users)
-        tag_users = [_ensure_user_id(api, user) for user in tag_users]
 
+def _post_tweet(client: tweepy.Client,
+                tweet: Tweet,
+                media_ids: Optional[List[int]] = None,
+                tag_user_ids: Optional[List[Union[str, int]]] = None,
+                in_reply_to_tweet_id: Optional[str] = None,
+                quote_tweet_id: str = None,
+                debug_mode: bool = False) -> tweepy.Response:
     if debug_mode:
         # ensure that tweet is unique
         tweet.text = f'{tweet.text[:200]} {str(uuid4())[:13]}'
@@ -196,7 +558,7 @@ def create_tweet(api: tweepy.API,
         #   https://developer.twitter.com/en/docs/twitter-api/tweets/manage-tweets/api-reference/post-tweets # noqa
         return client.create_tweet(
             text=tweet.text,
-            media_tagged_user_ids=tag_users,
+            media_tagged_user_ids=tag_user_ids,
             media_ids=media_ids,
             in_reply_to_tweet_id=in_reply_to_tweet_id,
             quote_tweet_id=quote_tweet_id,
@@ -206,9 +568,205 @@ def create_tweet(api: tweepy.API,
         raise(e)
 
 
-def create_thread(tweets: List[Tweet], tag_users: Optional[List[tweepy.User]] = None, quote_first_tweet_at_end: Union[str, bool] = 'auto', debug_mode: bool = False):
-    api = authenticate_v1()
-    client = authenticate_v2()
+# we need a v1 client (api) and a v2 client (client) since v1 can't
+# tag people in media and v2 can't upload media
+def create_tweet(api: tweepy.API,
+                 client: tweepy.Client,
+                 tweet: Tweet,
+                 tag_users: Optional[List[tweepy.User]] = None,
+                 in_reply_to_tweet_id: Optional[str] = None,
+                 quote_tweet_id: str = None,
+                 debug_mode: bool = False,
+                 img2media_id: Optional[Dict[str, int]] = None) -> tweepy.Response:
+
+    img2media_id = img2media_id or {}
+    media_ids = []
+    for img in tweet.imgs:
+        media_id = img2media_id.get(img)
+        if media_id is None:
+            media_id = _upload_media(api, img)
+        media_ids.append(media_id)
+    media_ids = media_ids or None
+
+    if tag_users:
+        print("tag users: ", tag_users)
+        tag_users = _ensure_user_ids(api, tag_users)
+
+    return _post_tweet(client, tweet, media_ids=media_ids, tag_user_ids=tag_users,
+                       in_reply_to_tweet_id=in_reply_to_tweet_id,
+                       quote_tweet_id=quote_tweet_id, debug_mode=debug_mode)
+
+
+class ThreadJournal:
+    """Append-only log of what's been uploaded and posted for a thread.
+
+    Each record is a line of json that gets fsynced before we move on, so
+    if posting dies partway through, the journal says which tweets made it
+    and which media ids can be reused. With no path, it just keeps the
+    records in memory.
+    """
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self._lock = threading.Lock()
+        self.img2media = {}  # img -> (media_id, upload time)
+        self.tweet_ids = {}  # tweet index -> tweet id
+        self.done = False
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            contents = f.read()
+        lines = contents.split('\n')
+        if lines[-1]:
+            # torn write from a crash; drop it so appends start on a new line
+            contents = contents[:len(contents) - len(lines[-1])]
+            with open(self.path, 'w') as f:
+                f.write(contents)
+        for line in lines[:-1]:
+            self._apply(json.loads(line))
+
+    def _apply(self, rec: dict):
+        kind = rec['kind']
+        if kind == 'media':
+            self.img2media[rec['img']] = (rec['media_id'], rec['time'])
+        elif kind == 'tweet':
+            self.tweet_ids[rec['index']] = rec['tweet_id']
+        elif kind == 'restart':
+            self.tweet_ids = {}
+            self.done = False
+        elif kind == 'done':
+            self.done = True
+        else:
+            raise ValueError(f"Unknown journal record kind: '{kind}'")
+
+    def _append(self, **rec):
+        rec['time'] = time.time()
+        with self._lock:
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(rec) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._apply(rec)
+
+    def record_media(self, img: str, media_id: int):
+        self._append(kind='media', img=img, media_id=media_id)
+
+    def record_tweet(self, index: int, tweet_id: str):
+        self._append(kind='tweet', index=index, tweet_id=tweet_id)
+
+    def record_restart(self):
+        self._append(kind='restart')
+
+    def record_done(self):
+        self._append(kind='done')
+
+    def media_id(self, img: str) -> Optional[int]:
+        """The media id from an earlier upload of img, if it's still good"""
+        media_id, uploaded_at = self.img2media.get(img, (None, 0))
+        if time.time() - uploaded_at < MEDIA_ID_TTL_SECS:
+            return media_id
+        return None
+
+    def num_posted(self) -> int:
+        n = 0
+        while n in self.tweet_ids:
+            n += 1
+        return n
+
+
+def thread_journal_path(tweets: Sequence[Tweet],
+                        account: str = '',
+                        journal_dir: str = THREAD_JOURNAL_DIR) -> str:
+    """Same thread posted as the same account -> same journal"""
+    h = hashlib.sha1()
+    for tweet in tweets:
+        h.update(json.dumps([tweet.text, tweet.imgs]).encode('utf-8'))
+    name = f'{account}-{h.hexdigest()[:16]}.jsonl' if account else f'{h.hexdigest()[:16]}.jsonl'
+    return os.path.join(journal_dir, name)
+
+
+@dataclass
+class TweetTiming:
+    index: int
+    wait_secs: float  # blocked on this tweet's media / user ids
+    post_secs: float  # inside client.create_tweet
+
+    @property
+    def critical_path_secs(self) -> float:
+        return self.wait_secs + self.post_secs
+
+
+def print_thread_timings(timings: Sequence[TweetTiming]):
+    for t in timings:
+        print(f"tweet {t.index}: {t.critical_path_secs * 1000:.0f}ms on critical path "
+              f"({t.wait_secs * 1000:.0f}ms waiting on uploads/lookups, "
+              f"{t.post_secs * 1000:.0f}ms posting)")
+    total = sum(t.critical_path_secs for t in timings)
+    waited = sum(t.wait_secs for t in timings)
+    print(f"total: {total:.2f}s on critical path, {waited:.2f}s of it waiting")
+
+
+def create_thread(tweets: List[Tweet],
+                  tag_users: Optional[List[tweepy.User]] = None,
+                  quote_first_tweet_at_end: Union[str, bool] = 'auto',
+                  debug_mode: bool = False,
+                  upload_all_first: bool = True,
+                  lookahead: int = POST_LOOKAHEAD,
+                  report_timing: bool = False,
+                  resume: bool = False,
+                  preprocess_images: bool = False,
+                  journal_dir: str = THREAD_JOURNAL_DIR,
+                  api: Optional[tweepy.API] = None,
+                  client: Optional[tweepy.Client] = None,
+                  account: str = '') -> List[TweetTiming]:
+    """Posts the tweets as a reply chain.
+
+    Each tweet needs the id of the one before it, so the posting itself
+    is sequential. Everything else (image uploads, looking up user ids)
+    happens on a background pool, `lookahead` tweets ahead of the one
+    being posted, so the chain only waits on create_tweet calls.
+
+    With upload_all_first, nothing is posted until every image has
+    uploaded successfully, so a bad image can't leave half a thread.
+    Otherwise the first tweet goes out as soon as its own images are up.
+
+    Uploads and posted tweets get recorded in a journal in journal_dir
+    (pass '' to skip it). If posting fails partway, calling this again
+    with resume=True picks up after the last tweet that made it, reusing
+    any media ids that haven't expired.
+
+    With preprocess_images, images are downscaled / recompressed before
+    uploading (see image_utils.preprocess_image) and the bytes saved
+    across the thread get printed.
+
+    api and client default to ones for the current credentials; account
+    is who they post as (for caching media ids and naming the journal), by
+    default the same.
+    """
+    api = api or get_api()
+    client = client or get_client()
+    account = account or current_account()
+
+    journal = ThreadJournal()
+    if journal_dir:
+        os.makedirs(journal_dir, exist_ok=True)
+        journal = ThreadJournal(thread_journal_path(
+            tweets, account=account, journal_dir=journal_dir))
+    start_idx = 0
+    if resume:
+        if journal.done:
+            print("this thread was already posted in full; nothing to resume")
+            return []
+        start_idx = journal.num_posted()
+        if start_idx:
+            print(f"resuming after the {start_idx} of {len(tweets)} tweets already posted")
+    elif journal.tweet_ids:
+        print(f"an earlier attempt posted {journal.num_posted()} of {len(tweets)} "
+              "tweets of this thread; starting over (use resume to continue it)")
+        journal.record_restart()
 
     if tag_users is None:  # can also attach it to the tweet
         tag_users = tweets[0].tag_users or None
@@ -216,85 +774,108 @@ def create_thread(tweets: List[Tweet], tag_users: Optional[List[tweepy.User]] =
     if quote_first_tweet_at_end == 'auto':
         quote_first_tweet_at_end = len(tweets) > 3
 
-    first_tweet_id = None
-    previous_tweet_id = None
-    for i, tweet in enumerate(tweets):
-        if debug_mode:
-            print("----------- i =", i)
-            print("tryna tweet:\n", tweet)
-
-        quote_tweet_id = None
-        if quote_first_tweet_at_end and i == (len(tweets) - 1) and i > 0:
-            assert first_tweet_id is not None, f"no first tweet for last #{i}"
-            quote_tweet_id = first_tweet_id
-
-        ret = create_tweet(api=api,
-                           client=client,
-                           tweet=tweet,
-                           tag_users=tag_users if i == 0 else None,
-                           in_reply_to_tweet_id=previous_tweet_id,
-                           quote_tweet_id=quote_tweet_id,
-                           debug_mode=debug_mode,
-        )
-        if debug_mode:
-            print("---- tweet creation response:")
-            print(ret)
-        previous_tweet_id = ret.data['id']
-        if i == 0:
-            first_tweet_id = previous_tweet_id
-
-
-# ================================================= simple analytics
-
-@memory.cache
-def get_followers(id_or_screen_name: Union[int, str]) -> List[tweepy.User]:
-    """Returns all followers in descending order of their follower count"""
-    api = authenticate_v1()
-    user_id = _ensure_user_id(api, id_or_screen_name)
-    followers = []
-    cursor = tweepy.Cursor(api.get_followers,
-                           user_id=user_id,
-                           count=200)
-    sleep_secs = 1
-    for page in cursor.pages():
-        try:
-            followers.extend(page)
-            sleep_secs = 1
-        except tweepy.TweepError as e:
-            print("Going to sleep:", e)
-            time.sleep(sleep_secs)
-            sleep_secs = min(60, sleep_secs * 2)
-    return sorted(followers, key=lambda f: f.followers_count, reverse=True)
-
-
-def save_followers(id_or_screen_name: Union[int, str]):
-    followers = get_followers(id_or_screen_name)
-
-    df = pd.DataFrame.from_records([f._json for f in followers])
-    df = df[['followers_count', 'friends_count', 'screen_name', 'name', 'description']]
-    df.rename({'friends_count': 'following_count', 'description': 'bio'}, axis=1, inplace=True)
-    if not os.path.exists(FOLLOWER_LISTS_DIR):
-        os.mkdir(FOLLOWER_LISTS_DIR)
-    saveas = os.path.join(FOLLOWER_LISTS_DIR, str(id_or_screen_name) + '.csv')
-    print("total followers of followers: ", df['followers_count'].sum())
-    df.to_csv(saveas, index=False)
+    timings = []
+    preprocess_stats = image_utils.PreprocessStats()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as pool:
+        img2future = {}
+
+        def _upload_and_record(img: str) -> int:
+            media_id = _upload_media(api, img, preprocess=preprocess_images,
+                                     preprocess_stats=preprocess_stats, account=account)
+            journal.record_media(img, media_id)
+            return media_id
+
+        def _prefetch(tweet_idx: int):
+            if tweet_idx >= len(tweets):
+                return
+            for img in tweets[tweet_idx].imgs:
+                if img in img2future:
+                    continue
+                media_id = journal.media_id(img)
+                if media_id is not None:
+                    img2future[img] = concurrent.futures.Future()
+                    img2future[img].set_result(media_id)
+                else:
+                    img2future[img] = pool.submit(_upload_and_record, img)
+
+        tag_user_ids_future = None
+        if tag_users and start_idx == 0:
+            print("tag users: ", tag_users)
+
+            def _tag_user_ids():
+                with rate_limit.priority(rate_limit.PRIORITY_POST):  # we're posting
+                    return _ensure_user_ids(api, tag_users)
+
+            tag_user_ids_future = pool.submit(_tag_user_ids)
+
+        if upload_all_first:
+            t0 = time.perf_counter()
+            for i in range(start_idx, len(tweets)):
+                _prefetch(i)
+            _raise_on_failed_upload(img2future)
+            if report_timing:
+                print(f"uploaded {len(img2future)} images in "
+                      f"{time.perf_counter() - t0:.2f}s before posting")
+        else:
+            for i in range(start_idx, start_idx + lookahead + 1):
+                _prefetch(i)
+
+        first_tweet_id = journal.tweet_ids.get(0)
+        previous_tweet_id = journal.tweet_ids.get(start_idx - 1)
+        for i in range(start_idx, len(tweets)):
+            tweet = tweets[i]
+            _prefetch(i + lookahead)
+            if debug_mode:
+                print("----------- i =", i)
+                print("tryna tweet:\n", tweet)
+
+            quote_tweet_id = None
+            if quote_first_tweet_at_end and i == (len(tweets) - 1) and i > 0:
+                assert first_tweet_id is not None, f"no first tweet for last #{i}"
+                quote_tweet_id = first_tweet_id
+
+            t0 = time.perf_counter()
+            media_ids = [img2future[img].result() for img in tweet.imgs] or None
+            tag_user_ids = None
+            if i == 0 and tag_user_ids_future is not None:
+                tag_user_ids = tag_user_ids_future.result()
+            t1 = time.perf_counter()
+            ret = _post_tweet(client,
+                              tweet,
+                              media_ids=media_ids,
+                              tag_user_ids=tag_user_ids,
+                              in_reply_to_tweet_id=previous_tweet_id,
+                              quote_tweet_id=quote_tweet_id,
+                              debug_mode=debug_mode)
+            timings.append(TweetTiming(index=i,
+                                       wait_secs=t1 - t0,
+                                       post_secs=time.perf_counter() - t1))
+            if debug_mode:
+                print("---- tweet creation response:")
+                print(ret)
+            previous_tweet_id = ret.data['id']
+            journal.record_tweet(i, previous_tweet_id)
+            if i == 0:
+                first_tweet_id = previous_tweet_id
+        journal.record_done()
+
+    if preprocess_images:
+        print(preprocess_stats)
+    if report_timing:
+        print_thread_timings(timings)
+    return timings
 
 
 # ================================================================ debug
 
 def test_download_image():
-        with tempfile.TemporaryDirectory() as d:
-            path = _download_img('https://i.imgur.com/ExdKOOz.png', tempdir=d)
-            assert os.path.isfile(path)
-            assert os.path.getsize(path) > 0
-
-            # allow manually inspecting the image before it's wiped
-            # print(path)
-            # input()
+    buf = _download_img('https://i.imgur.com/ExdKOOz.png')
+    assert len(buf.getbuffer()) > 0
+    assert buf.tell() == 0  # ready to upload
 
 
 def test_ensure_user_ids():
-    api = authenticate_v1()
+    api = get_api()
     ids = [_ensure_user_id(api, user) for user in ('davisblalock', DEBUG_ACCOUNT_ID)]
 
     # can't use v2 impl due to weird 401 unauthorized
@@ -306,14 +887,207 @@ def test_ensure_user_ids():
     assert str(ids[1]) == str(DEBUG_ACCOUNT_ID)
 
 
+def test_get_clients():
+    # real tweepy objects with dummy credentials; nothing gets sent
+    global _credentials
+    real_credentials = _credentials
+    _credentials = Credentials('key', 'key_secret', '123-token', 'token_secret')
+    try:
+        got = []
+        thread = threading.Thread(target=lambda: got.extend([get_api(), get_client()]),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive(), "get_api / get_client deadlocked"
+        api, client = got
+        assert get_api() is api and get_client() is client  # made once
+        for session in (api.session, client.session):
+            adapter = session.get_adapter('https://api.twitter.com/2/tweets')
+            assert type(adapter).__name__ == '_RateLimitedAdapter'
+            assert adapter.scheduler is rate_limits
+    finally:
+        _v1_apis.pop(_credentials, None)
+        _v2_clients.pop(_credentials, None)
+        _credentials = real_credentials
+
+
+_FAKE_ACCOUNT = '42'  # so tests don't need real credentials
+
+
+class _FakeTwitter:
+    """Stands in for both the v1 api and the v2 client when posting.
+
+    Upload / create_tweet calls whose (0-indexed) call numbers are in
+    fail_uploads / fail_tweets raise a ConnectionError.
+    """
+
+    def __init__(self, fail_uploads: Sequence[int] = (), fail_tweets: Sequence[int] = ()):
+        self.fail_uploads = set(fail_uploads)
+        self.fail_tweets = set(fail_tweets)
+        self.num_uploads = 0
+        self.num_tweet_calls = 0
+        self.tweets = []
+        self.uploaded_bytes = []
+        self._lock = threading.Lock()
+
+    def chunked_upload(self, filename: str, file=None):
+        with self._lock:
+            n = self.num_uploads
+            self.num_uploads += 1
+        if n in self.fail_uploads:
+            raise ConnectionError(f"fake failure uploading '{filename}'")
+        if file is None:
+            with open(filename, 'rb') as f:
+                self.uploaded_bytes.append(f.read())
+        else:
+            self.uploaded_bytes.append(file.read())
+        return tweepy.models.Media.parse(None, {'media_id': 1000 + n})
+
+    def create_tweet(self, text: str, **kwargs):
+        n = self.num_tweet_calls
+        self.num_tweet_calls += 1
+        if n in self.fail_tweets:
+            raise ConnectionError(f"fake failure posting '{text}'")
+        tweet_id = str(len(self.tweets) + 1)
+        self.tweets.append(dict(text=text, id=tweet_id, **kwargs))
+        return tweepy.Response(data={'id': tweet_id}, includes={}, errors=[], meta={})
+
+
+@contextmanager
+def _temporary_cache(d: str):
+    global cache
+    real_cache = cache
+    cache = Cache(os.path.join(d, 'cache.sqlite'))  # keep fake ids out of the real one
+    try:
+        yield
+    finally:
+        cache.close()
+        cache = real_cache
+
+
+def _write_random_imgs(d: str, n: int) -> List[str]:
+    paths = [os.path.join(d, f'img{i}.png') for i in range(n)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(100))
+    return paths
+
+
+def test_media_id_cache():
+    with tempfile.TemporaryDirectory() as d, _temporary_cache(d):
+        img0, img1 = _write_random_imgs(d, 2)
+        img0_copy = os.path.join(d, 'copy.png')
+        shutil.copy(img0, img0_copy)
+        tweets = [Tweet(text='a', imgs=[img0, img1]), Tweet(text='b', imgs=[img0_copy])]
+
+        fake = _FakeTwitter()
+        create_thread(tweets, api=fake, client=fake, journal_dir='',
+                      account=_FAKE_ACCOUNT)
+        assert fake.num_uploads == 2  # copy has the same bytes as img0
+        assert fake.tweets[0]['media_ids'][0] == fake.tweets[1]['media_ids'][0]
+
+        create_thread(tweets, api=fake, client=fake, journal_dir='',
+                      account=_FAKE_ACCOUNT)
+        assert fake.num_uploads == 2  # all cached
+
+        with open(img1, 'ab') as f:
+            f.write(b'edited')
+        create_thread(tweets, api=fake, client=fake, journal_dir='',
+                      account=_FAKE_ACCOUNT)
+        assert fake.num_uploads == 3  # new contents, same path
+
+
+def test_upload_from_url():
+    import http.server
+    img_bytes = os.urandom(3 * DOWNLOAD_CHUNK_BYTES + 17)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = img_bytes if self.path == '/img.png' else b'x' * (MAX_DOWNLOAD_BYTES + 1)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except BrokenPipeError:
+                pass  # client bailed after seeing Content-Length
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        with tempfile.TemporaryDirectory() as d, _temporary_cache(d):
+            fake = _FakeTwitter()
+            _upload_media(fake, f'{url}/img.png', account=_FAKE_ACCOUNT)
+            assert fake.uploaded_bytes == [img_bytes]
+            assert all(f.startswith('cache.sqlite') for f in os.listdir(d))
+            _upload_media(fake, f'{url}/img.png', account=_FAKE_ACCOUNT)
+            assert fake.num_uploads == 1  # cached by url
+            try:
+                _upload_media(fake, f'{url}/huge.png', account=_FAKE_ACCOUNT)
+                assert False, "oversized image should have been rejected"
+            except ValueError:
+                pass
+    finally:
+        server.shutdown()
+
+
+def test_resume_thread():
+    with tempfile.TemporaryDirectory() as d, _temporary_cache(d):
+        imgs = _write_random_imgs(d, 3)
+        tweets = [Tweet(text=f'tweet {i}', imgs=[imgs[i // 2]] if i % 2 else [])
+                  for i in range(6)]
+
+        # failed upload -> nothing posted
+        fake = _FakeTwitter(fail_uploads=[1])
+        try:
+            create_thread(tweets, api=fake, client=fake, journal_dir=d,
+                          account=_FAKE_ACCOUNT)
+            assert False, "upload failure should have raised"
+        except RuntimeError:
+            pass
+        assert not fake.tweets
+
+        # dies partway through posting
+        fake = _FakeTwitter(fail_tweets=[3])
+        try:
+            create_thread(tweets, api=fake, client=fake, journal_dir=d,
+                          account=_FAKE_ACCOUNT)
+            assert False, "posting failure should have raised"
+        except ConnectionError:
+            pass
+        assert len(fake.tweets) == 3
+        num_uploads = fake.num_uploads
+
+        create_thread(tweets, api=fake, client=fake, journal_dir=d, resume=True,
+                      account=_FAKE_ACCOUNT)
+        assert [t['text'] for t in fake.tweets] == [t.text for t in tweets]
+        assert fake.num_uploads == num_uploads  # media ids got reused
+        for prev, tweet in zip(fake.tweets, fake.tweets[1:]):
+            assert tweet['in_reply_to_tweet_id'] == prev['id']
+        assert fake.tweets[-1]['quote_tweet_id'] == fake.tweets[0]['id']
+
+        # nothing left to do
+        create_thread(tweets, api=fake, client=fake, journal_dir=d, resume=True,
+                      account=_FAKE_ACCOUNT)
+        assert len(fake.tweets) == len(tweets)
+
+
 def main():
     # test_download_image()
 
-    # test_ensure_user_ids()
+    test_get_clients()
+
+    test_resume_thread()
+
+    test_media_id_cache()
 
-    # save_followers('moinnadeem')
-    # save_followers('AveryLamp')
-    save_followers('davisblalock')
+    test_upload_from_url()
+
+    # test_ensure_user_ids()
 
     # dbg_tweet0 = Tweet(text='dbg tweet part 1', imgs=['https://i.imgur.com/ExdKOOz.png'])
     # dbg_tweet1 = Tweet(text='dbg tweet part 2', imgs=['sunset.jpg'])